@@ -0,0 +1,620 @@
+# benchmark.py
+"""
+app.py のAPIサーバーと lambda_handler 経由の経路の負荷試験・ベンチマーク
+
+日本語の複数ターンの会話を、指定した並列数または到着率で再生し、
+レイテンシ (p50/p95/p99)、最初のトークンまでの時間、スループットを計測して
+実行間で比較できるJSONに書き出す。
+
+使い方:
+    # 重みをダウンロードせずに、決定的な偽のpipelineを使ったサーバーで計測する (CPUのみの環境でも動作)
+    python benchmark.py --fake --concurrency 8 --conversations 32 --output results.json
+    # 起動済みのサーバー (実モデル) に対して、ストリーミングで一定の到着率で計測する
+    python benchmark.py --url http://localhost:8501 --endpoint stream --rate 0.5 --duration 120 --output real.json
+    # Lambda (lambda/index.py) -> サーバーの経路を計測する
+    python benchmark.py --fake --endpoint lambda --concurrency 4
+    # 2回の結果を比較する
+    python benchmark.py --compare before.json after.json
+"""
+import os
+import sys
+import time
+import json
+import types
+import random
+import socket
+import argparse
+import asyncio
+import threading
+import importlib.util
+import collections
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+import httpx
+
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# 再生する会話 (各要素がユーザーの発言の列。アシスタントの応答はサーバーの出力を使う)
+CONVERSATIONS = [
+    [
+        "こんにちは。週末に京都へ一泊二日で旅行する予定です。おすすめの回り方を教えてください。",
+        "一日目は東山のあたりを中心に回りたいです。混雑を避けるコツはありますか？",
+        "夕食は予算五千円くらいで、京料理を気軽に楽しめるお店の選び方を教えてください。",
+        "二日目の午前中だけで嵐山を回るのは無理がありますか？",
+    ],
+    [
+        "Pythonで大きなCSVファイルを読み込むと、メモリが足りなくなってしまいます。",
+        "pandasを使っています。チャンクごとに読み込む方法を具体的に教えてください。",
+        "集計結果を最後に一つのデータフレームにまとめたいのですが、注意点はありますか？",
+    ],
+    [
+        "最近よく眠れません。寝る前にできることはありますか？",
+        "寝る前にスマートフォンを見てしまうのが習慣になっています。",
+        "朝起きるのもつらいのですが、休日に寝だめするのは良くないのでしょうか？",
+        "昼寝をするなら何分くらいがよいですか？",
+        "ありがとうございます。今日から試してみます。",
+    ],
+    [
+        "新しいプロジェクトのリーダーを任されました。最初の一週間で何をすべきでしょうか。",
+        "メンバーは五人で、半分は初めて一緒に働く人です。",
+        "定例会議の進め方について、時間を無駄にしないための工夫を教えてください。",
+    ],
+    [
+        "小学生の子どもに、分数の割り算をどう説明すればよいでしょうか。",
+        "「ひっくり返してかける」理由を聞かれて、うまく答えられませんでした。",
+        "図を使って説明する例を一つ挙げてください。",
+        "宿題で同じような問題が出たときの声かけのコツはありますか？",
+    ],
+    [
+        "敬語の使い方について質問です。「おっしゃられる」は正しい表現ですか？",
+        "では、取引先へのメールで「ご確認してください」と書くのは失礼でしょうか。",
+        "メールの結びの定型文をいくつか教えてください。",
+    ],
+]
+
+# --- 決定的な偽のpipeline ---
+FAKE_VOCAB_SIZE = 0x10000  # 基本多言語面の文字をそのままトークンIDとして扱う
+FAKE_REPLY = (
+    "ご質問ありがとうございます。順を追って説明しますね。まず前提を整理し、"
+    "次に具体的な手順を示します。最後に注意点をまとめますので、参考にしてください。"
+)
+# 偽のモデルが返すロジットの位置数の上限 (長いプロンプトのprefillでは末尾だけが使われる)
+FAKE_LOGITS_POSITIONS = 16
+
+class FakeTokenizer:
+    """1文字を1トークンとして扱う決定的なトークナイザー (トークンIDは文字のコードポイント)"""
+
+    eos_token_id = 0
+    eos_token = "\x00"
+    pad_token_id = 0
+    pad_token = "\x00"
+    padding_side = "left"
+
+    def __call__(self, text, add_special_tokens=True):
+        return {"input_ids": [min(ord(c), FAKE_VOCAB_SIZE - 1) for c in text]}
+
+    def decode(self, token_ids, skip_special_tokens=False):
+        if hasattr(token_ids, "tolist"):
+            token_ids = token_ids.tolist()
+        return "".join(chr(i) for i in token_ids if not (skip_special_tokens and i == self.eos_token_id))
+
+def _fake_reply_tokens():
+    return [ord(c) for c in FAKE_REPLY]
+
+class FakeModel:
+    """
+    連続バッチングエンジンから呼び出せる決定的な偽のモデル
+
+    位置 p に生成されるトークンは常に FAKE_REPLY[p % len(FAKE_REPLY)] になる。
+    forward 1回ごとにデコードは token_latency 秒、prefillは入力トークン数 × prefill_token_latency 秒待つ
+    (デコードはバッチの大きさによらず一定で、メモリ帯域律速のGPUの振る舞いを模している)。
+    """
+
+    def __init__(self, token_latency, prefill_token_latency):
+        import torch
+        self.torch = torch
+        self.token_latency = token_latency
+        self.prefill_token_latency = prefill_token_latency
+        self.device = torch.device("cpu")
+        self.dtype = torch.float32
+        self.generation_config = types.SimpleNamespace(eos_token_id=FakeTokenizer.eos_token_id)
+        self.reply_ids = torch.tensor(_fake_reply_tokens())
+
+    def parameters(self):
+        return iter(())
+
+    def __call__(self, input_ids, attention_mask=None, position_ids=None, past_key_values=None, use_cache=True, **kwargs):
+        import app as server
+        torch = self.torch
+        batch_size, length = input_ids.shape
+        past = server._cache_to_kv(past_key_values) if past_key_values is not None else None
+        past_length = past[0][0].shape[2] if past else 0
+        time.sleep(self.token_latency if length == 1 else self.prefill_token_latency * batch_size * length)
+
+        if position_ids is None:
+            position_ids = torch.arange(past_length, past_length + length).expand(batch_size, length)
+        rows = min(length, FAKE_LOGITS_POSITIONS)
+        next_tokens = self.reply_ids[(position_ids[:, -rows:] + 1) % len(self.reply_ids)]
+        logits = torch.zeros(batch_size, rows, FAKE_VOCAB_SIZE)
+        logits.scatter_(2, next_tokens.unsqueeze(-1), 30.0)
+
+        # KVの中身は使われないため、長さだけを合わせた小さなテンソルを持つ
+        new_key = torch.zeros(batch_size, 1, length, 1)
+        if past:
+            kv = [(torch.cat([key, new_key], dim=2), torch.cat([value, new_key], dim=2)) for key, value in past]
+        else:
+            kv = [(new_key, new_key.clone())]
+        return types.SimpleNamespace(logits=logits, past_key_values=server._kv_to_cache(kv))
+
+class FakePipeline:
+    """transformersのtext-generation pipelineと同じ呼び出し方ができる決定的な偽のpipeline"""
+
+    def __init__(self, token_latency=0.02, prefill_token_latency=0.0002):
+        self.tokenizer = FakeTokenizer()
+        self.model = FakeModel(token_latency, prefill_token_latency)
+        self.token_latency = token_latency
+        self.prefill_token_latency = prefill_token_latency
+        self.reply_ids = _fake_reply_tokens()
+
+    def __call__(self, text_inputs, max_new_tokens=512, streamer=None, return_full_text=True, stopping_criteria=None,
+                 **kwargs):
+        import torch
+        prompts = text_inputs if isinstance(text_inputs, list) else [text_inputs]
+        prompt_ids = [self.tokenizer(prompt)["input_ids"] for prompt in prompts]
+        if streamer is not None:
+            streamer.put(torch.tensor(prompt_ids[0]))
+        time.sleep(self.prefill_token_latency * sum(len(ids) for ids in prompt_ids))
+        generated = [[] for _ in prompts]
+        for step in range(max_new_tokens):
+            time.sleep(self.token_latency)
+            for ids, tokens in zip(prompt_ids, generated):
+                tokens.append(self.reply_ids[(len(ids) + step) % len(self.reply_ids)])
+            if streamer is not None:
+                streamer.put(torch.tensor([generated[0][-1]]))
+            if stopping_criteria:
+                # 実際のpipelineと同じく左パディングした形で渡し、全行が停止したら打ち切る
+                width = max(len(ids) for ids in prompt_ids)
+                input_ids = torch.tensor([[0] * (width - len(ids)) + ids + tokens for ids, tokens in zip(prompt_ids, generated)])
+                if any(bool(criteria(input_ids, None).all()) for criteria in stopping_criteria):
+                    break
+        if streamer is not None:
+            streamer.end()
+        outputs = [
+            [{"generated_text": (prompt if return_full_text else "") + self.tokenizer.decode(tokens)}]
+            for prompt, tokens in zip(prompts, generated)
+        ]
+        return outputs if isinstance(text_inputs, list) else outputs[0]
+
+def start_fake_server(args):
+    """偽のpipelineを読み込むapp.pyのサーバーを別スレッドで起動し、ベースURLを返す"""
+    import uvicorn
+    sys.path.insert(0, ROOT_DIR)
+    import app as server
+
+    def load_fake_model(model_name=None):
+        entry = server.model_registry.get(model_name)
+        entry.status["source"] = "fake"
+        return FakePipeline(args.token_latency, args.prefill_token_latency)
+
+    server.load_model = load_fake_model
+    server.config.ENABLE_CONTINUOUS_BATCHING = not args.no_batching
+    server.config.MAX_BATCH_SIZE = args.max_batch_size
+    server.config.MAX_QUEUE_SIZE = max(server.config.MAX_QUEUE_SIZE, args.concurrency * 2)
+    server.config.WARMUP_PROMPT_TOKENS = [16]
+    if not args.keep_response_cache:
+        server.response_cache = None
+    server.logger.setLevel("WARNING")
+
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    uvicorn_server = uvicorn.Server(uvicorn.Config(server.app, host="127.0.0.1", port=port, log_level="warning"))
+    threading.Thread(target=uvicorn_server.run, name="benchmark-server", daemon=True).start()
+    while not uvicorn_server.started:
+        time.sleep(0.05)
+    return f"http://127.0.0.1:{port}"
+
+def load_lambda_module(base_url, conversation_store=None):
+    """lambda/index.py を読み込み、APIのベースURLを計測対象のサーバーに向ける"""
+    lambda_dir = os.path.join(ROOT_DIR, "lambda")
+    if lambda_dir not in sys.path:
+        sys.path.insert(0, lambda_dir)
+    spec = importlib.util.spec_from_file_location("lambda_index", os.path.join(lambda_dir, "index.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    # 計測対象のサーバーだけに向けて、lambda/index.py と同じ設定で作り直す
+    module.upstream = module.UpstreamClient(
+        [base_url],
+        timeout=module.UPSTREAM_TIMEOUT,
+        max_attempts=module.UPSTREAM_MAX_ATTEMPTS,
+        hedge_after=module.UPSTREAM_HEDGE_AFTER,
+        failure_threshold=module.UPSTREAM_FAILURE_THRESHOLD,
+        cooldown=module.UPSTREAM_COOLDOWN,
+        pool_size=module.UPSTREAM_POOL_SIZE,
+        server_deadline_margin=module.SERVER_DEADLINE_MARGIN
+    )
+    module.conversation_store = module.create_conversation_store(conversation_store)
+    return module
+
+# --- 計測 ---
+def percentiles(values):
+    """p50/p95/p99 と平均・最大を返す (値がなければNone)"""
+    if not values:
+        return None
+    values = sorted(values)
+
+    def percentile(q):
+        position = (len(values) - 1) * q
+        lower = int(position)
+        upper = min(lower + 1, len(values) - 1)
+        return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+    return {
+        "p50": percentile(0.50),
+        "p95": percentile(0.95),
+        "p99": percentile(0.99),
+        "mean": sum(values) / len(values),
+        "max": values[-1],
+    }
+
+def summarize(records, wall_time):
+    succeeded = [r for r in records if r["status"] == 200]
+    generated_tokens = sum(r["tokens"] or 0 for r in succeeded)
+    return {
+        "requests": len(records),
+        "succeeded": len(succeeded),
+        "failed": len(records) - len(succeeded),
+        "status_counts": dict(collections.Counter(str(r["status"]) for r in records)),
+        "cached": sum(1 for r in succeeded if r.get("cached")),
+        "wall_time": wall_time,
+        "throughput_requests_per_second": len(succeeded) / wall_time if wall_time else 0.0,
+        "throughput_tokens_per_second": generated_tokens / wall_time if wall_time else 0.0,
+        "generated_tokens": generated_tokens,
+        "latency": percentiles([r["latency"] for r in succeeded]),
+        "time_to_first_token": percentiles([r["ttft"] for r in succeeded if r["ttft"] is not None]),
+        # Lambdaの経路で1ターンに送受信した本文のバイト数
+        "request_bytes": percentiles([r["request_bytes"] for r in succeeded if r.get("request_bytes") is not None]),
+        "response_bytes": percentiles([r["response_bytes"] for r in succeeded if r.get("response_bytes") is not None]),
+    }
+
+class BenchmarkRunner:
+    """会話を再生してリクエストごとの計測結果を集める"""
+
+    def __init__(self, args, base_url, lambda_module):
+        self.args = args
+        self.base_url = base_url
+        self.lambda_module = lambda_module
+        self.records = []
+        self.client = httpx.AsyncClient(base_url=base_url, timeout=args.timeout)
+        # Lambdaの経路は同期のrequestsを使うため、並列数分のスレッドで実行する
+        self.executor = ThreadPoolExecutor(max_workers=max(32, args.concurrency * 2))
+
+    def generation_payload(self):
+        return {
+            "max_new_tokens": self.args.max_new_tokens,
+            "do_sample": self.args.do_sample,
+            "temperature": 0.7,
+            "top_p": 0.9,
+        }
+
+    async def send_turn(self, history, message, conversation=None):
+        """
+        1ターン分のリクエストを送り、計測結果とアシスタントの応答を返す
+
+        conversation は会話IDのモード (--conversation-store) で使う {"id", "version"} の辞書で、
+        応答に含まれる会話IDとバージョンで更新する。
+        """
+        endpoint = self.args.endpoint
+        record = {"endpoint": endpoint, "status": None, "latency": None, "ttft": None, "tokens": None,
+                  "cached": False, "error": None}
+        start = time.perf_counter()
+        reply = None
+        try:
+            if endpoint == "lambda":
+                if conversation is not None:
+                    request_body = {"message": message, "conversationId": conversation["id"],
+                                    "version": conversation["version"]}
+                else:
+                    request_body = {"message": message, "conversationHistory": history}
+                request_body["maxNewTokens"] = self.args.max_new_tokens
+                event = {"body": json.dumps(request_body)}
+                result = await asyncio.get_running_loop().run_in_executor(
+                    self.executor, self.lambda_module.lambda_handler, event, None
+                )
+                body = json.loads(result["body"])
+                record["request_bytes"] = len(event["body"].encode("utf-8"))
+                record["response_bytes"] = len(result["body"].encode("utf-8"))
+                record["status"] = 200 if result["statusCode"] == 200 else result["statusCode"]
+                reply, record["tokens"] = body.get("response"), body.get("generatedTokens")
+                if conversation is not None and record["status"] == 200:
+                    conversation.update(id=body["conversationId"], version=body["version"])
+                if record["status"] != 200:
+                    record["error"] = body.get("error")
+            elif endpoint == "chat":
+                response = await self.client.post("/chat", json={
+                    "messages": history + [{"role": "user", "content": message}], **self.generation_payload()
+                })
+                record["status"] = response.status_code
+                if response.status_code == 200:
+                    data = response.json()
+                    reply, record["cached"] = data["generated_text"], data.get("cached", False)
+                    record["tokens"] = data.get("generated_tokens")
+            else:
+                prompt = self.lambda_module.format_prompt_from_history(
+                    history, message, self.lambda_module.PROMPT_TOKEN_BUDGET
+                )
+                payload = {"prompt": prompt, **self.generation_payload()}
+                if endpoint == "stream":
+                    reply = await self.send_stream(payload, record, start)
+                else:
+                    response = await self.client.post("/generate", json=payload)
+                    record["status"] = response.status_code
+                    if response.status_code == 200:
+                        data = response.json()
+                        reply, record["cached"] = data["generated_text"], data.get("cached", False)
+                        record["tokens"] = data.get("generated_tokens")
+            if record["status"] != 200 and record["error"] is None:
+                record["error"] = f"HTTP {record['status']}"
+        except Exception as e:
+            record["status"] = "exception"
+            record["error"] = f"{type(e).__name__}: {e}"
+        # トークン数はサーバーが数えた生成トークン数を使う (キャッシュから返した応答は生成していないため数えない)
+        record["latency"] = time.perf_counter() - start
+        return record, reply
+
+    async def send_stream(self, payload, record, start):
+        """/generate/stream のSSEを読み、最初のトークンまでの時間とトークン数を記録する"""
+        event_name = None
+        async with self.client.stream("POST", "/generate/stream", json=payload) as response:
+            record["status"] = response.status_code
+            if response.status_code != 200:
+                return None
+            async for line in response.aiter_lines():
+                if line.startswith("event: "):
+                    event_name = line[len("event: "):]
+                elif line.startswith("data: "):
+                    data = json.loads(line[len("data: "):])
+                    if event_name == "token" and record["ttft"] is None:
+                        record["ttft"] = time.perf_counter() - start
+                    elif event_name == "done":
+                        record["tokens"] = data.get("token_count")
+                        return data.get("generated_text")
+                    elif event_name == "error":
+                        record["status"] = "stream_error"
+                        record["error"] = data.get("detail")
+                        return None
+        return None
+
+    async def run_conversation(self, index):
+        """1つの会話を最初から最後まで順に再生する"""
+        turns = CONVERSATIONS[index % len(CONVERSATIONS)]
+        history = []
+        conversation = {"id": None, "version": 0} if self.args.conversation_store else None
+        for turn, message in enumerate(turns):
+            if turn == 0 and not self.args.no_unique:
+                # 応答キャッシュに当たらないように、会話ごとに最初の発言を変える
+                message = f"(会話{index}) {message}"
+            record, reply = await self.send_turn(history, message, conversation)
+            record.update({"conversation": index, "turn": turn, "history_messages": len(history)})
+            self.records.append(record)
+            if reply is None:
+                break
+            history = history + [{"role": "user", "content": message}, {"role": "assistant", "content": reply}]
+            if self.args.think_time:
+                await asyncio.sleep(random.expovariate(1.0 / self.args.think_time))
+
+    async def run(self):
+        deadline = time.perf_counter() + self.args.duration if self.args.duration else None
+        next_index = 0
+
+        def has_more():
+            if deadline is not None:
+                return time.perf_counter() < deadline
+            return next_index < self.args.conversations
+
+        if self.args.rate:
+            # オープンループ: ポアソン到着で会話を開始する (前の会話の完了を待たない)
+            tasks = []
+            while has_more():
+                tasks.append(asyncio.create_task(self.run_conversation(next_index)))
+                next_index += 1
+                await asyncio.sleep(random.expovariate(self.args.rate))
+            await asyncio.gather(*tasks)
+        else:
+            # クローズドループ: concurrency 人の利用者がそれぞれ会話を続けて再生する
+            async def user():
+                nonlocal next_index
+                while has_more():
+                    index = next_index
+                    next_index += 1
+                    await self.run_conversation(index)
+
+            await asyncio.gather(*(user() for _ in range(self.args.concurrency)))
+
+    async def fetch_server_stats(self):
+        """計測後のサーバーの状態 (推論ワーカーの統計など) を取得する"""
+        try:
+            health = (await self.client.get("/health")).json()
+        except Exception as e:
+            return {"error": str(e)}
+        models = health.get("models") or []
+        return {
+            "status": health.get("status"),
+            "model": health.get("model"),
+            "inference_stats": models[0].get("inference_stats") if models else None,
+            "prefix_cache": models[0].get("prefix_cache") if models else None,
+            "response_cache": health.get("response_cache"),
+        }
+
+    async def close(self):
+        await self.client.aclose()
+        self.executor.shutdown(wait=False)
+
+async def wait_until_ready(base_url, timeout):
+    """サーバーのモデルの準備が完了するまで待つ"""
+    deadline = time.time() + timeout
+    async with httpx.AsyncClient(base_url=base_url, timeout=10) as client:
+        while time.time() < deadline:
+            try:
+                if (await client.get("/health")).json().get("status") == "ready":
+                    return
+                # 遅延読み込みの場合は、最初のリクエストで読み込みを開始させる
+                await client.post("/generate", json={"prompt": "こんにちは", "max_new_tokens": 1})
+            except (httpx.HTTPError, ValueError):
+                pass
+            await asyncio.sleep(1.0)
+    raise RuntimeError(f"{timeout}秒以内にサーバーの準備が完了しませんでした: {base_url}")
+
+async def run_benchmark(args):
+    random.seed(args.seed)
+    base_url = start_fake_server(args) if args.fake else args.url.rstrip("/")
+    await wait_until_ready(base_url, args.ready_timeout)
+    runner = BenchmarkRunner(args, base_url, load_lambda_module(base_url, args.conversation_store))
+    print(f"計測を開始します: target={'fake' if args.fake else base_url}, endpoint={args.endpoint}, "
+          f"{'rate=' + str(args.rate) + '/秒' if args.rate else 'concurrency=' + str(args.concurrency)}")
+    started_at = datetime.now(timezone.utc).isoformat()
+    start = time.perf_counter()
+    try:
+        await runner.run()
+        wall_time = time.perf_counter() - start
+        server_stats = await runner.fetch_server_stats()
+    finally:
+        await runner.close()
+
+    result = {
+        "benchmark": {
+            "started_at": started_at,
+            "target": "fake" if args.fake else base_url,
+            "endpoint": args.endpoint,
+            "concurrency": None if args.rate else args.concurrency,
+            "rate": args.rate,
+            "conversations": args.conversations,
+            "duration": args.duration,
+            "max_new_tokens": args.max_new_tokens,
+            "do_sample": args.do_sample,
+            "think_time": args.think_time,
+            "seed": args.seed,
+            "conversation_store": args.conversation_store,
+        },
+        "summary": summarize(runner.records, wall_time),
+        "server": server_stats,
+    }
+    if args.fake:
+        result["benchmark"]["fake"] = {
+            "token_latency": args.token_latency,
+            "prefill_token_latency": args.prefill_token_latency,
+            "continuous_batching": not args.no_batching,
+            "max_batch_size": args.max_batch_size,
+        }
+    if args.save_requests:
+        result["requests"] = runner.records
+    return result
+
+# --- 結果の表示と比較 ---
+def format_seconds(value):
+    return "-" if value is None else f"{value * 1000:.1f}ms"
+
+def print_summary(summary):
+    print(f"リクエスト: {summary['requests']}件 (成功 {summary['succeeded']}, 失敗 {summary['failed']}, "
+          f"キャッシュ {summary['cached']}) / {summary['wall_time']:.1f}秒")
+    print(f"スループット: {summary['throughput_requests_per_second']:.2f} req/秒, "
+          f"{summary['throughput_tokens_per_second']:.1f} トークン/秒")
+    for label, key in (("レイテンシ", "latency"), ("最初のトークンまで", "time_to_first_token")):
+        stats = summary.get(key)
+        if stats:
+            print(f"{label}: p50 {format_seconds(stats['p50'])}, p95 {format_seconds(stats['p95'])}, "
+                  f"p99 {format_seconds(stats['p99'])}")
+    for label, key in (("送信バイト数", "request_bytes"), ("受信バイト数", "response_bytes")):
+        stats = summary.get(key)
+        if stats:
+            print(f"{label}: 平均 {stats['mean']:.0f}, p50 {stats['p50']:.0f}, 最大 {stats['max']:.0f}")
+
+COMPARED_METRICS = [
+    ("latency.p50", "レイテンシ p50"),
+    ("latency.p95", "レイテンシ p95"),
+    ("latency.p99", "レイテンシ p99"),
+    ("time_to_first_token.p50", "最初のトークン p50"),
+    ("time_to_first_token.p95", "最初のトークン p95"),
+    ("throughput_requests_per_second", "req/秒"),
+    ("throughput_tokens_per_second", "トークン/秒"),
+    ("request_bytes.mean", "送信バイト数 平均"),
+    ("response_bytes.mean", "受信バイト数 平均"),
+    ("failed", "失敗数"),
+]
+
+def lookup_metric(summary, path):
+    value = summary
+    for key in path.split("."):
+        if not isinstance(value, dict):
+            return None
+        value = value.get(key)
+    return value
+
+def compare_results(before_path, after_path):
+    """2つの結果ファイルの主要な指標と変化率を表示する"""
+    with open(before_path, encoding="utf-8") as f:
+        before = json.load(f)["summary"]
+    with open(after_path, encoding="utf-8") as f:
+        after = json.load(f)["summary"]
+    print(f"{'指標':<20}{'before':>14}{'after':>14}{'変化':>10}")
+    for path, label in COMPARED_METRICS:
+        old, new = lookup_metric(before, path), lookup_metric(after, path)
+        if old is None and new is None:
+            continue
+        change = f"{(new - old) / old * 100:+.1f}%" if old and new is not None else "-"
+        if path.startswith(("latency", "time_to_first_token")):
+            old_text, new_text = format_seconds(old), format_seconds(new)
+        else:
+            old_text = "-" if old is None else f"{old:.2f}"
+            new_text = "-" if new is None else f"{new:.2f}"
+        print(f"{label:<20}{old_text:>14}{new_text:>14}{change:>10}")
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="app.py のAPIサーバーとLambda経由の経路のベンチマーク")
+    target = parser.add_mutually_exclusive_group()
+    target.add_argument("--url", help="計測対象のサーバーのベースURL (実モデル)")
+    target.add_argument("--fake", action="store_true", help="決定的な偽のpipelineを使うサーバーをプロセス内で起動する")
+    target.add_argument("--compare", nargs=2, metavar=("BEFORE", "AFTER"), help="2つの結果ファイルを比較する")
+    parser.add_argument("--endpoint", choices=["generate", "chat", "stream", "lambda"], default="generate",
+                        help="generate/chat/stream はサーバーを直接、lambda は lambda_handler 経由で呼び出す")
+    parser.add_argument("--concurrency", type=int, default=4, help="クローズドループの同時利用者数")
+    parser.add_argument("--rate", type=float, help="オープンループで1秒あたりに開始する会話数 (ポアソン到着)")
+    parser.add_argument("--conversations", type=int, default=16, help="再生する会話の数")
+    parser.add_argument("--duration", type=float, help="指定すると会話数の代わりにこの秒数だけ新しい会話を開始する")
+    parser.add_argument("--think-time", type=float, default=0.0, help="ターン間の平均待ち時間 (秒、指数分布)")
+    parser.add_argument("--max-new-tokens", type=int, default=64)
+    parser.add_argument("--do-sample", action="store_true", help="サンプリングで生成する (既定は貪欲法)")
+    parser.add_argument("--no-unique", action="store_true", help="会話ごとに最初の発言を変えない (応答キャッシュに当たる)")
+    parser.add_argument("--timeout", type=float, default=120.0, help="1リクエストのタイムアウト (秒)")
+    parser.add_argument("--ready-timeout", type=float, default=600.0, help="サーバーの準備完了を待つ最大秒数")
+    parser.add_argument("--conversation-store", nargs="?", const="memory",
+                        help="lambda の経路で会話IDのモードを使う (履歴をサーバー側に保存し、差分だけを送る)。"
+                             "値は memory / sqlite:<パス> (省略時は memory)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="結果を書き出すJSONファイル")
+    parser.add_argument("--save-requests", action="store_true", help="リクエストごとの計測結果もJSONに含める")
+    fake = parser.add_argument_group("偽のpipelineの設定 (--fake)")
+    fake.add_argument("--token-latency", type=float, default=0.02, help="デコード1ステップの秒数")
+    fake.add_argument("--prefill-token-latency", type=float, default=0.0002, help="prefillの1トークンあたりの秒数")
+    fake.add_argument("--no-batching", action="store_true", help="連続バッチングを使わず逐次ワーカーで処理する")
+    fake.add_argument("--max-batch-size", type=int, default=8)
+    fake.add_argument("--keep-response-cache", action="store_true", help="サーバーの応答キャッシュを有効のままにする")
+    args = parser.parse_args(argv)
+    if not (args.url or args.fake or args.compare):
+        parser.error("--url、--fake、--compare のいずれかを指定してください")
+    return args
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.compare:
+        compare_results(*args.compare)
+        return
+    result = asyncio.run(run_benchmark(args))
+    print_summary(result["summary"])
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+        print(f"結果を書き出しました: {args.output}")
+
+if __name__ == "__main__":
+    main()
@@ -6,8 +6,9 @@ import { BedrockChatbotStack } from '../lib/bedrock-chatbot-stack';
 const app = new cdk.App();
 new BedrockChatbotStack(app, 'BedrockChatbotStack', {
   // モデルIDをオプションで指定可能
-  modelId: 'us.amazon.nova-lite-v1:0',
-  //modelId: 'us.amazon.nova-micro-v1:0',
+  // 'local-model' の場合はFastAPIサーバーの既定モデル、それ以外はサーバーの MODEL_NAMES に登録したモデル名
+  modelId: 'local-model',
+  //modelId: 'google/gemma-2-2b-jpn-it',
   
   // 環境変数から取得したリージョンを使用、またはデフォルトとしてus-east-1を使用
   env: { 
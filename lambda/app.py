@@ -1,10 +1,39 @@
 import os
 import torch
-from transformers import pipeline
+from transformers import pipeline, AutoModel, AutoModelForCausalLM, AutoTokenizer, StoppingCriteria, StoppingCriteriaList
+from transformers import (LogitsProcessorList, MinPLogitsWarper, TemperatureLogitsWarper, TopKLogitsWarper,
+                          TopPLogitsWarper, TypicalLogitsWarper)
 import time
 import traceback
-from fastapi import FastAPI, HTTPException, BackgroundTasks
+import asyncio
+import threading
+import collections
+import json
+import functools
+import heapq
+import itertools
+import hashlib
+import sqlite3
+import unicodedata
+import gc
+import copy
+import sys
+import shutil
+import fcntl
+import subprocess
+import logging
+import argparse
+import contextvars
+import uuid
+from concurrent.futures import Future
+import numpy as np
+import httpx
+from fastapi import FastAPI, HTTPException, BackgroundTasks, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse, Response
+from starlette.background import BackgroundTask
+from starlette.datastructures import MutableHeaders
+from prometheus_client import Counter, Gauge, Histogram, generate_latest, CONTENT_TYPE_LATEST
 from pydantic import BaseModel
 from typing import Optional, List, Dict, Any
 import uvicorn
@@ -16,13 +45,263 @@ from pyngrok import ngrok
 MODEL_NAME = "google/gemma-2-2b-jpn-it"  # お好みのモデルに変更可能です
 print(f"モデル名を設定: {MODEL_NAME}")
 
+# リクエストごとに選択できる追加のモデル (カンマ区切り)。既定のモデルは常に利用可能
+MODEL_NAMES = [name.strip() for name in os.environ.get("MODEL_NAMES", "").split(",") if name.strip()]
+# 読み込んだモデルの常駐メモリの合計の上限 (GB)。0の場合は無制限
+MODEL_MEMORY_BUDGET_GB = float(os.environ.get("MODEL_MEMORY_BUDGET_GB", "0"))
+
+# 連続バッチングの設定 (環境変数で上書き可能)
+ENABLE_CONTINUOUS_BATCHING = os.environ.get("ENABLE_CONTINUOUS_BATCHING", "1") == "1"
+MAX_BATCH_SIZE = int(os.environ.get("MAX_BATCH_SIZE", "8"))  # 同時にデコードする最大シーケンス数
+MAX_BATCHED_TOKENS = int(os.environ.get("MAX_BATCHED_TOKENS", "8192"))  # バッチ内の (プロンプト + 最大生成) トークン数の上限
+
+# 推論待ち行列の設定 (満杯の場合は429を即座に返す)
+MAX_QUEUE_SIZE = int(os.environ.get("MAX_QUEUE_SIZE", "32"))
+QUEUE_RETRY_AFTER = int(os.environ.get("QUEUE_RETRY_AFTER", "5"))  # Retry-Afterヘッダーの秒数
+
+# /generate/batch の設定
+MAX_BATCH_REQUESTS = int(os.environ.get("MAX_BATCH_REQUESTS", "256"))  # 1回の呼び出しで受け付ける最大件数
+BATCH_RETRY_TIMEOUT = float(os.environ.get("BATCH_RETRY_TIMEOUT", "60"))  # 待ち行列の満杯やモデルの読み込み中に再試行する最大秒数
+
+# プロンプト先頭部分のKVキャッシュ再利用の設定 (連続バッチング時のみ有効)
+ENABLE_PREFIX_CACHE = os.environ.get("ENABLE_PREFIX_CACHE", "1") == "1"
+PREFIX_CACHE_MAX_BYTES = int(os.environ.get("PREFIX_CACHE_MAX_BYTES", str(1024 ** 3)))  # 保持するKVテンソルの合計サイズの上限
+PREFIX_CACHE_BLOCK_SIZE = int(os.environ.get("PREFIX_CACHE_BLOCK_SIZE", "16"))  # 先頭一致を判定するトークンの単位
+
+# 同一リクエストに対する応答キャッシュの設定
+ENABLE_RESPONSE_CACHE = os.environ.get("ENABLE_RESPONSE_CACHE", "1") == "1"
+RESPONSE_CACHE_MAX_ENTRIES = int(os.environ.get("RESPONSE_CACHE_MAX_ENTRIES", "1024"))
+RESPONSE_CACHE_TTL = float(os.environ.get("RESPONSE_CACHE_TTL", "300"))  # 秒
+RESPONSE_CACHE_INCLUDE_SAMPLED = os.environ.get("RESPONSE_CACHE_INCLUDE_SAMPLED", "0") == "1"  # "1" で do_sample=True の応答もキャッシュする (既定では毎回生成する)
+RESPONSE_CACHE_DIR = os.environ.get("RESPONSE_CACHE_DIR")  # 指定すると再起動後も残るディスクキャッシュを併用する
+
+# 言い回しだけが異なる質問に応答を再利用する意味的キャッシュの設定 (1ターン目の質問のみが対象)
+ENABLE_SEMANTIC_CACHE = os.environ.get("ENABLE_SEMANTIC_CACHE", "0") == "1"
+SEMANTIC_CACHE_MODEL = os.environ.get("SEMANTIC_CACHE_MODEL", "intfloat/multilingual-e5-small")  # 質問を埋め込む小さな埋め込みモデル
+SEMANTIC_CACHE_THRESHOLD = float(os.environ.get("SEMANTIC_CACHE_THRESHOLD", "0.92"))  # キャッシュを返すコサイン類似度の下限
+SEMANTIC_CACHE_MAX_ENTRIES = int(os.environ.get("SEMANTIC_CACHE_MAX_ENTRIES", "4096"))
+SEMANTIC_CACHE_TTL = float(os.environ.get("SEMANTIC_CACHE_TTL", "3600"))  # 秒
+
+# 実行中の同一リクエストへの相乗り (single-flight) の設定
+# do_sample=False のリクエストは常に、do_sample=True のリクエストは coalesce=True を指定した場合だけ相乗りする
+ENABLE_COALESCING = os.environ.get("ENABLE_COALESCING", "1") == "1"
+
+# ユーザーごとの公平なスケジューリングと利用量の上限 (ユーザーはリクエストの user で識別する)
+ENABLE_FAIR_SCHEDULING = os.environ.get("ENABLE_FAIR_SCHEDULING", "1") == "1"
+USER_WEIGHTS = {  # "alice=2,bob=0.5" の形式。省略したユーザーの重みは1
+    name.strip(): float(value)
+    for name, value in (item.split("=", 1) for item in os.environ.get("USER_WEIGHTS", "").split(",") if "=" in item)
+}
+USER_TOKENS_PER_MINUTE = int(os.environ.get("USER_TOKENS_PER_MINUTE", "0"))  # 1ユーザーの1分あたりのトークン数の上限 (0は無制限)
+USER_TOKENS_PER_MINUTE_OVERRIDES = {  # "alice=100000,bob=5000" の形式でユーザーごとに上限を変える
+    name.strip(): int(value)
+    for name, value in (item.split("=", 1) for item in os.environ.get("USER_TOKENS_PER_MINUTE_OVERRIDES", "").split(",") if "=" in item)
+}
+USER_USAGE_MAX_USERS = int(os.environ.get("USER_USAGE_MAX_USERS", "10000"))  # 利用量の累計を保持するユーザー数の上限 (古いものから捨てる)
+
+# 起動時の読み込みとウォームアップの設定
+MODEL_SNAPSHOT_DIR = os.environ.get("MODEL_SNAPSHOT_DIR")  # 指定するとsafetensorsのローカルスナップショットから読み込む
+WARMUP_PROMPT_TOKENS = [int(n) for n in os.environ.get("WARMUP_PROMPT_TOKENS", "16,128,512").split(",") if n.strip()]
+WARMUP_NEW_TOKENS = int(os.environ.get("WARMUP_NEW_TOKENS", "8"))
+
+# CPU推論の設定 (CUDAが使えない場合のみ有効)
+# CPU_INFERENCE_MODE: auto (CPUの対応状況からdtypeを選択) / fp32 / bf16 / int8 (動的量子化) / benchmark (起動時に最速の構成を計測して選択)
+CPU_INFERENCE_MODE = os.environ.get("CPU_INFERENCE_MODE", "auto")
+CPU_THREADS = int(os.environ.get("CPU_THREADS", "0"))  # intra-opスレッド数。0の場合は割り当てられたコア数
+CPU_INTEROP_THREADS = int(os.environ.get("CPU_INTEROP_THREADS", "1"))
+CPU_CORES = os.environ.get("CPU_CORES", "")  # プロセスを固定するコア (例: "0-7,16-23")。空の場合は固定しない
+CPU_BENCHMARK_THREADS = [int(n) for n in os.environ.get("CPU_BENCHMARK_THREADS", "").split(",") if n.strip()]  # benchmarkで比較するスレッド数
+CPU_BENCHMARK_NEW_TOKENS = int(os.environ.get("CPU_BENCHMARK_NEW_TOKENS", "32"))
+
+# 投機的デコードの設定 (リクエストの speculative で "draft" または "prompt_lookup" を指定した場合に使用)
+DRAFT_MODEL_NAME = os.environ.get("DRAFT_MODEL_NAME", "")  # 既定のモデルと一緒に読み込む小さなdraftモデル (語彙が同じもの)
+SPECULATIVE_NUM_TOKENS = int(os.environ.get("SPECULATIVE_NUM_TOKENS", "4"))  # 1回の検証で提案する候補トークン数の既定値
+PROMPT_LOOKUP_MAX_NGRAM = int(os.environ.get("PROMPT_LOOKUP_MAX_NGRAM", "3"))  # prompt_lookupで文脈から探す末尾n-gramの最大長
+
+# クライアントの切断を確認する間隔 (秒)。切断した場合は実行中の生成を中止する
+DISCONNECT_POLL_INTERVAL = float(os.environ.get("DISCONNECT_POLL_INTERVAL", "0.25"))
+
+# 静的な形状でコンパイルした生成 (有効にすると連続バッチングの代わりに逐次ワーカーで使う)
+# 1リクエストのデコードは速くなるが、リクエストを1件ずつ処理するため、同時に多くのリクエストが来る場合は
+# 連続バッチングより全体のスループットが下がる (起動時に警告を出す)。同時実行の少ない環境向け。
+ENABLE_COMPILED_GENERATION = os.environ.get("ENABLE_COMPILED_GENERATION", "0") == "1"
+COMPILED_PROMPT_BUCKETS = [int(n) for n in os.environ.get("COMPILED_PROMPT_BUCKETS", "128,512,1024").split(",") if n.strip()]  # パディング後のプロンプト長
+COMPILED_MAX_NEW_TOKENS = int(os.environ.get("COMPILED_MAX_NEW_TOKENS", "512"))  # 静的なKVキャッシュに確保する生成トークン数
+COMPILE_MODE = os.environ.get("COMPILE_MODE", "default")  # torch.compile の mode (CUDAでは "reduce-overhead" でCUDA Graphsを使う)
+
+# リクエストごとのログのレベル (DEBUGの場合のみプロンプトと出力の内容を出力する)
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+
+# マルチプロセスのレプリカプールの設定 (REPLICA_COUNTが2以上の場合にルーター経由で起動する)
+REPLICA_COUNT = int(os.environ.get("REPLICA_COUNT", "1"))
+REPLICA_BASE_PORT = int(os.environ.get("REPLICA_BASE_PORT", "8600"))  # ワーカープロセスが使うポートの先頭
+REPLICA_HEALTH_INTERVAL = float(os.environ.get("REPLICA_HEALTH_INTERVAL", "2"))  # ワーカーの死活監視の間隔 (秒)
+
 # --- モデル設定クラス ---
 class Config:
-    def __init__(self, model_name=MODEL_NAME):
+    def __init__(self, model_name=MODEL_NAME,
+                 model_names=MODEL_NAMES,
+                 model_memory_budget_gb=MODEL_MEMORY_BUDGET_GB,
+                 enable_continuous_batching=ENABLE_CONTINUOUS_BATCHING,
+                 max_batch_size=MAX_BATCH_SIZE,
+                 max_batched_tokens=MAX_BATCHED_TOKENS,
+                 max_queue_size=MAX_QUEUE_SIZE,
+                 queue_retry_after=QUEUE_RETRY_AFTER,
+                 max_batch_requests=MAX_BATCH_REQUESTS,
+                 batch_retry_timeout=BATCH_RETRY_TIMEOUT,
+                 enable_prefix_cache=ENABLE_PREFIX_CACHE,
+                 prefix_cache_max_bytes=PREFIX_CACHE_MAX_BYTES,
+                 prefix_cache_block_size=PREFIX_CACHE_BLOCK_SIZE,
+                 enable_response_cache=ENABLE_RESPONSE_CACHE,
+                 response_cache_max_entries=RESPONSE_CACHE_MAX_ENTRIES,
+                 response_cache_ttl=RESPONSE_CACHE_TTL,
+                 response_cache_include_sampled=RESPONSE_CACHE_INCLUDE_SAMPLED,
+                 response_cache_dir=RESPONSE_CACHE_DIR,
+                 enable_semantic_cache=ENABLE_SEMANTIC_CACHE,
+                 semantic_cache_model=SEMANTIC_CACHE_MODEL,
+                 semantic_cache_threshold=SEMANTIC_CACHE_THRESHOLD,
+                 semantic_cache_max_entries=SEMANTIC_CACHE_MAX_ENTRIES,
+                 semantic_cache_ttl=SEMANTIC_CACHE_TTL,
+                 enable_coalescing=ENABLE_COALESCING,
+                 enable_fair_scheduling=ENABLE_FAIR_SCHEDULING,
+                 user_weights=USER_WEIGHTS,
+                 user_tokens_per_minute=USER_TOKENS_PER_MINUTE,
+                 user_tokens_per_minute_overrides=USER_TOKENS_PER_MINUTE_OVERRIDES,
+                 user_usage_max_users=USER_USAGE_MAX_USERS,
+                 model_snapshot_dir=MODEL_SNAPSHOT_DIR,
+                 warmup_prompt_tokens=WARMUP_PROMPT_TOKENS,
+                 warmup_new_tokens=WARMUP_NEW_TOKENS,
+                 cpu_inference_mode=CPU_INFERENCE_MODE,
+                 cpu_threads=CPU_THREADS,
+                 cpu_interop_threads=CPU_INTEROP_THREADS,
+                 cpu_cores=CPU_CORES,
+                 cpu_benchmark_threads=CPU_BENCHMARK_THREADS,
+                 cpu_benchmark_new_tokens=CPU_BENCHMARK_NEW_TOKENS,
+                 draft_model_name=DRAFT_MODEL_NAME,
+                 speculative_num_tokens=SPECULATIVE_NUM_TOKENS,
+                 prompt_lookup_max_ngram=PROMPT_LOOKUP_MAX_NGRAM,
+                 disconnect_poll_interval=DISCONNECT_POLL_INTERVAL,
+                 enable_compiled_generation=ENABLE_COMPILED_GENERATION,
+                 compiled_prompt_buckets=COMPILED_PROMPT_BUCKETS,
+                 compiled_max_new_tokens=COMPILED_MAX_NEW_TOKENS,
+                 compile_mode=COMPILE_MODE,
+                 log_level=LOG_LEVEL,
+                 replica_count=REPLICA_COUNT,
+                 replica_base_port=REPLICA_BASE_PORT,
+                 replica_health_interval=REPLICA_HEALTH_INTERVAL):
         self.MODEL_NAME = model_name
+        self.MODEL_NAMES = model_names
+        self.MODEL_MEMORY_BUDGET_GB = model_memory_budget_gb
+        self.ENABLE_CONTINUOUS_BATCHING = enable_continuous_batching
+        self.MAX_BATCH_SIZE = max_batch_size
+        self.MAX_BATCHED_TOKENS = max_batched_tokens
+        self.MAX_QUEUE_SIZE = max_queue_size
+        self.QUEUE_RETRY_AFTER = queue_retry_after
+        self.MAX_BATCH_REQUESTS = max_batch_requests
+        self.BATCH_RETRY_TIMEOUT = batch_retry_timeout
+        self.ENABLE_PREFIX_CACHE = enable_prefix_cache
+        self.PREFIX_CACHE_MAX_BYTES = prefix_cache_max_bytes
+        self.PREFIX_CACHE_BLOCK_SIZE = prefix_cache_block_size
+        self.ENABLE_RESPONSE_CACHE = enable_response_cache
+        self.RESPONSE_CACHE_MAX_ENTRIES = response_cache_max_entries
+        self.RESPONSE_CACHE_TTL = response_cache_ttl
+        self.RESPONSE_CACHE_INCLUDE_SAMPLED = response_cache_include_sampled
+        self.RESPONSE_CACHE_DIR = response_cache_dir
+        self.ENABLE_SEMANTIC_CACHE = enable_semantic_cache
+        self.SEMANTIC_CACHE_MODEL = semantic_cache_model
+        self.SEMANTIC_CACHE_THRESHOLD = semantic_cache_threshold
+        self.SEMANTIC_CACHE_MAX_ENTRIES = semantic_cache_max_entries
+        self.SEMANTIC_CACHE_TTL = semantic_cache_ttl
+        self.ENABLE_COALESCING = enable_coalescing
+        self.ENABLE_FAIR_SCHEDULING = enable_fair_scheduling
+        self.USER_WEIGHTS = user_weights
+        self.USER_TOKENS_PER_MINUTE = user_tokens_per_minute
+        self.USER_TOKENS_PER_MINUTE_OVERRIDES = user_tokens_per_minute_overrides
+        self.USER_USAGE_MAX_USERS = user_usage_max_users
+        self.MODEL_SNAPSHOT_DIR = model_snapshot_dir
+        self.WARMUP_PROMPT_TOKENS = warmup_prompt_tokens
+        self.WARMUP_NEW_TOKENS = warmup_new_tokens
+        self.CPU_INFERENCE_MODE = cpu_inference_mode
+        self.CPU_THREADS = cpu_threads
+        self.CPU_INTEROP_THREADS = cpu_interop_threads
+        self.CPU_CORES = cpu_cores
+        self.CPU_BENCHMARK_THREADS = cpu_benchmark_threads
+        self.CPU_BENCHMARK_NEW_TOKENS = cpu_benchmark_new_tokens
+        self.DRAFT_MODEL_NAME = draft_model_name
+        self.SPECULATIVE_NUM_TOKENS = speculative_num_tokens
+        self.PROMPT_LOOKUP_MAX_NGRAM = prompt_lookup_max_ngram
+        self.DISCONNECT_POLL_INTERVAL = disconnect_poll_interval
+        self.ENABLE_COMPILED_GENERATION = enable_compiled_generation
+        self.COMPILED_PROMPT_BUCKETS = compiled_prompt_buckets
+        self.COMPILED_MAX_NEW_TOKENS = compiled_max_new_tokens
+        self.COMPILE_MODE = compile_mode
+        self.LOG_LEVEL = log_level
+        self.REPLICA_COUNT = replica_count
+        self.REPLICA_BASE_PORT = replica_base_port
+        self.REPLICA_HEALTH_INTERVAL = replica_health_interval
 
 config = Config(MODEL_NAME)
 
+# --- リクエストのトレース ---
+# Lambdaが生成したリクエストIDを受け取るヘッダー (ない場合はサーバーで生成する)
+REQUEST_ID_HEADER = "X-Request-ID"
+
+class RequestTrace:
+    """
+    1リクエスト分の段階ごとの所要時間 (秒) を集め、Server-Timing ヘッダーとして返す
+
+    ミドルウェアがリクエストごとに作成して current_trace に設定し、各段階の処理が add で記録する。
+    """
+
+    def __init__(self, request_id):
+        self.request_id = request_id
+        self.start = time.time()
+        self.spans = {}
+
+    def add(self, name, seconds):
+        if seconds is not None:
+            self.spans[name] = self.spans.get(name, 0.0) + seconds
+
+    def add_inference(self, result):
+        """推論ワーカーが返した InferenceResult の段階ごとの所要時間を記録する"""
+        self.add("queue", result.queue_wait_time)
+        for key in ("tokenize", "prefill", "decode"):
+            self.add(key, result.timings.get(key))
+
+    def summary(self):
+        """段階ごとの所要時間と、ここまでの合計 (total) を返す"""
+        return {**self.spans, "total": time.time() - self.start}
+
+    def server_timing(self):
+        # Server-Timing の dur はミリ秒
+        return ", ".join(f"{name};dur={seconds * 1000:.1f}" for name, seconds in self.summary().items())
+
+current_trace = contextvars.ContextVar("current_trace", default=None)
+
+def trace_span(name, seconds):
+    """処理中のリクエストのトレースに段階の所要時間を記録する (トレースの外では何もしない)"""
+    trace = current_trace.get()
+    if trace is not None:
+        trace.add(name, seconds)
+
+class RequestIdFilter(logging.Filter):
+    """ログに処理中のリクエストIDを付ける (リクエストの外では "-")"""
+
+    def filter(self, record):
+        trace = current_trace.get()
+        record.request_id = trace.request_id if trace is not None else "-"
+        return True
+
+# リクエスト処理中のログ (無効なレベルのメッセージは整形されない)
+logger = logging.getLogger("simplechat")
+if not logger.handlers:
+    _log_handler = logging.StreamHandler(sys.stdout)
+    _log_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s [%(request_id)s] %(message)s"))
+    _log_handler.addFilter(RequestIdFilter())
+    logger.addHandler(_log_handler)
+logger.setLevel(config.LOG_LEVEL)
+logger.propagate = False
+
 # --- FastAPIアプリケーション定義 ---
 app = FastAPI(
     title="ローカルLLM APIサービス",
@@ -39,6 +318,105 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+class RequestTraceMiddleware:
+    """
+    リクエストIDを引き継いでトレースを開始し、応答にリクエストIDと段階ごとの所要時間のヘッダーを付ける
+
+    @app.middleware("http") (BaseHTTPMiddleware) を通すとエンドポイントからクライアントの切断を
+    検出できないため、ASGIのミドルウェアとして実装する。
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        request_id = Request(scope).headers.get(REQUEST_ID_HEADER) or uuid.uuid4().hex
+        trace = RequestTrace(request_id)
+
+        async def send_with_headers(message):
+            if message["type"] == "http.response.start":
+                # ストリーミングの応答はヘッダーを先に返すため、生成の内訳は done イベントで返す
+                headers = MutableHeaders(scope=message)
+                headers[REQUEST_ID_HEADER] = trace.request_id
+                headers["Server-Timing"] = trace.server_timing()
+            await send(message)
+
+        token = current_trace.set(trace)
+        try:
+            await self.app(scope, receive, send_with_headers)
+        finally:
+            current_trace.reset(token)
+
+app.add_middleware(RequestTraceMiddleware)
+
+# --- メトリクス (Prometheus形式で /metrics から取得する) ---
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+FAST_BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.5)
+
+QUEUE_WAIT_SECONDS = Histogram(
+    "simplechat_queue_wait_seconds", "推論ワーカーの待ち行列で待機した秒数", ["model"], buckets=LATENCY_BUCKETS)
+TOKENIZE_SECONDS = Histogram(
+    "simplechat_tokenize_seconds", "プロンプトのトークン化にかかった秒数", ["model"], buckets=FAST_BUCKETS)
+PREFILL_SECONDS = Histogram(
+    "simplechat_prefill_seconds", "プロンプトを処理して最初のトークンを生成するまでの秒数", ["model"], buckets=LATENCY_BUCKETS)
+DECODE_SECONDS = Histogram(
+    "simplechat_decode_seconds", "最初のトークンの後、生成が終わるまでの秒数", ["model"], buckets=LATENCY_BUCKETS)
+EXTRACT_SECONDS = Histogram(
+    "simplechat_extract_seconds", "extract_assistant_response にかかった秒数", buckets=FAST_BUCKETS)
+REQUEST_SECONDS = Histogram(
+    "simplechat_request_seconds", "リクエストの受信から応答までの秒数", ["endpoint"], buckets=LATENCY_BUCKETS)
+PROMPT_TOKENS_TOTAL = Counter("simplechat_prompt_tokens_total", "処理したプロンプトのトークン数", ["model"])
+GENERATED_TOKENS_TOTAL = Counter("simplechat_generated_tokens_total", "生成したトークン数", ["model"])
+DECODE_TOKENS_PER_SECOND = Gauge(
+    "simplechat_decode_tokens_per_second", "直近に完了したリクエストのデコード速度 (トークン/秒)", ["model"])
+DECODE_TOKEN_SECONDS = Histogram(
+    "simplechat_decode_token_seconds", "1トークンあたりのデコード秒数 (mode: compiled / eager)", ["model", "mode"],
+    buckets=FAST_BUCKETS + (1.0,))
+MODEL_LOAD_SECONDS = Gauge(
+    "simplechat_model_load_seconds", "モデルの読み込みの所要秒数 (phase: load / warmup / time_to_ready)", ["model", "phase"])
+QUEUE_DEPTH = Gauge("simplechat_queue_depth", "推論ワーカーの待ち行列の長さ", ["model"])
+IN_FLIGHT_REQUESTS = Gauge("simplechat_in_flight_requests", "処理中のリクエスト数", ["model"])
+ERRORS_TOTAL = Counter("simplechat_errors_total", "種類ごとのエラー数", ["type"])
+QUOTA_REJECTIONS_TOTAL = Counter("simplechat_quota_rejections_total", "利用量の上限を超えたため受付時に拒否したリクエスト数")
+COALESCED_REQUESTS_TOTAL = Counter(
+    "simplechat_coalesced_requests_total", "実行中の同一リクエストに相乗りして推論を省略したリクエスト数", ["model"])
+STOP_SEQUENCE_HITS_TOTAL = Counter("simplechat_stop_sequence_hits_total", "停止文字列で生成を止めたリクエスト数", ["model"])
+GENERATION_TRUNCATED_TOTAL = Counter(
+    "simplechat_generation_truncated_total", "応答の期限で打ち切り、途中までの応答を返した生成の数", ["model"])
+DECODE_TOKENS_SAVED_TOTAL = Counter(
+    "simplechat_decode_tokens_saved_total", "停止文字列で止めたことで省略したデコードのトークン数 (max_new_tokensまでの残り)", ["model"])
+SEMANTIC_CACHE_LOOKUPS_TOTAL = Counter(
+    "simplechat_semantic_cache_lookups_total", "意味的キャッシュの検索数 (result: hit / miss)", ["result"])
+SEMANTIC_CACHE_LOOKUP_SECONDS = Histogram(
+    "simplechat_semantic_cache_lookup_seconds", "意味的キャッシュの検索 (埋め込みを含む) にかかった秒数", buckets=FAST_BUCKETS)
+SEMANTIC_CACHE_SIMILARITY = Histogram(
+    "simplechat_semantic_cache_similarity", "意味的キャッシュで最も近い質問とのコサイン類似度",
+    buckets=(0.5, 0.6, 0.7, 0.8, 0.85, 0.9, 0.92, 0.94, 0.96, 0.98, 1.0))
+
+def record_inference_metrics(model_name, result):
+    """推論ワーカーが返した InferenceResult の所要時間とトークン数をメトリクスに記録する"""
+    timings = result.timings or {}
+    if result.queue_wait_time is not None:
+        QUEUE_WAIT_SECONDS.labels(model_name).observe(result.queue_wait_time)
+    for key, histogram in (("tokenize", TOKENIZE_SECONDS), ("prefill", PREFILL_SECONDS), ("decode", DECODE_SECONDS)):
+        if timings.get(key) is not None:
+            histogram.labels(model_name).observe(timings[key])
+    PROMPT_TOKENS_TOTAL.labels(model_name).inc(timings.get("prompt_tokens", 0))
+    generated_tokens = timings.get("generated_tokens", 0)
+    GENERATED_TOKENS_TOTAL.labels(model_name).inc(generated_tokens)
+    if timings.get("decode") and generated_tokens > 1:
+        DECODE_TOKENS_PER_SECOND.labels(model_name).set((generated_tokens - 1) / timings["decode"])
+        if timings.get("mode"):
+            DECODE_TOKEN_SECONDS.labels(model_name, timings["mode"]).observe(timings["decode"] / (generated_tokens - 1))
+    if result.finish_reason in INTERRUPTED_FINISH_REASONS:
+        GENERATION_TRUNCATED_TOTAL.labels(model_name).inc()
+    if result.finish_reason == "stop":
+        STOP_SEQUENCE_HITS_TOTAL.labels(model_name).inc()
+        DECODE_TOKENS_SAVED_TOTAL.labels(model_name).inc(timings.get("decode_tokens_saved", 0))
+
 # --- データモデル定義 ---
 class Message(BaseModel):
     role: str
@@ -51,38 +429,459 @@ class SimpleGenerationRequest(BaseModel):
     do_sample: Optional[bool] = True
     temperature: Optional[float] = 0.7
     top_p: Optional[float] = 0.9
+    model: Optional[str] = None  # 使用するモデル名 (省略時は既定のモデル)
+    speculative: Optional[str] = None  # 投機的デコード: "draft" (draftモデル) / "prompt_lookup" (n-gram一致)
+    num_speculative_tokens: Optional[int] = None  # 1回の検証で提案する候補トークン数
+    stop: Optional[List[str]] = None  # 停止文字列 (例: "\nユーザー:")。現れた時点で生成を止め、応答からは除く
+    coalesce: Optional[bool] = None  # 実行中の同一リクエストの結果を共有するか (省略時は do_sample=False の場合のみ)
+    user: Optional[str] = None  # 利用者の識別子 (Lambdaが Cognito の sub を設定する)。公平なスケジューリングと利用量の上限に使う
+    timeout: Optional[float] = None  # 応答の期限までの秒数 (Lambdaが残りの実行時間から設定する)。期限の前に生成を打ち切り、途中までの応答を返す
 
 class GenerationResponse(BaseModel):
     generated_text: str
     response_time: float
+    model: Optional[str] = None  # 応答を生成したモデル名
+    queue_wait_time: Optional[float] = None  # 推論ワーカーの待ち行列で待機した秒数
+    queue_depth: Optional[int] = None  # 受付時点で先に待っていたリクエスト数
+    cached_prompt_tokens: Optional[int] = None  # KVキャッシュを再利用してprefillを省略したトークン数
+    cached: bool = False  # 応答キャッシュから返した場合はTrue
+    coalesced: bool = False  # 実行中の同一リクエストの結果を共有した場合はTrue
+    speculative: Optional[Dict[str, Any]] = None  # 投機的デコードの受理率と、通常のデコードの実測速度に対する速度向上
+    finish_reason: Optional[str] = None  # 生成が終わった理由: "stop" (停止文字列) / "eos" / "length" (max_new_tokens) / "deadline" (期限)
+    truncated: bool = False  # 期限までに生成を終えられず、途中までの応答を返した場合はTrue
+    generated_tokens: Optional[int] = None  # 生成したトークン数
+    semantic_similarity: Optional[float] = None  # 意味的キャッシュから返した場合の、元の質問とのコサイン類似度
+
+# 会話履歴を構造化して受け取るリクエスト (最後のメッセージが新しいユーザー入力)
+class ChatRequest(BaseModel):
+    messages: List[Message]
+    max_new_tokens: Optional[int] = 512
+    do_sample: Optional[bool] = True
+    temperature: Optional[float] = 0.7
+    top_p: Optional[float] = 0.9
+    model: Optional[str] = None
+    speculative: Optional[str] = None
+    num_speculative_tokens: Optional[int] = None
+    stop: Optional[List[str]] = None
+    coalesce: Optional[bool] = None
+    user: Optional[str] = None
+    timeout: Optional[float] = None
+
+# /generate/batch の1件分の結果 (失敗した場合は error と status_code、再試行できる時刻が分かれば retry_after を設定する)
+class BatchItemResult(BaseModel):
+    index: int
+    generated_text: Optional[str] = None
+    response_time: float
+    model: Optional[str] = None
+    cached: bool = False
+    coalesced: bool = False
+    error: Optional[str] = None
+    status_code: Optional[int] = None
+    retry_after: Optional[int] = None  # 利用量の上限などで失敗した場合に、再試行できるまでの秒数
+
+class BatchGenerationResponse(BaseModel):
+    results: List[BatchItemResult]  # 入力と同じ順序
+    response_time: float
+    succeeded: int
+    failed: int
 
 # --- モデル関連の関数 ---
-# モデルのグローバル変数
-model = None
+PROCESS_START_TIME = time.time()
+
+# スナップショットの書き込み完了を示すファイル
+SNAPSHOT_MARKER = "snapshot.json"
+
+class UnknownModelError(Exception):
+    """登録されていないモデル名が指定された"""
+
+class ModelEntry:
+    """
+    レジストリに登録された1モデル分の状態
+
+    status の state は not_loaded -> loading -> warming -> ready と遷移し、
+    読み込みに失敗した場合は failed、退避された場合は not_loaded に戻る。
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.pipe = None
+        self.draft_model = None
+        self.worker = None
+        self.memory_bytes = 0  # 最後に測定した常駐メモリ (退避後も次回の読み込みの見積もりに使う)
+        self.last_used = 0.0
+        self.in_flight = 0
+        self.status = {
+            "state": "not_loaded",
+            "progress": 0.0,
+            "message": "",
+            "source": None,
+            "load_time": None,
+            "warmup_time": None,
+            "eager_tokens_per_second": None,  # 通常のデコードの実測速度 (投機的デコードの速度向上の基準)
+            "time_to_ready": None,
+            "cpu_config": None,
+        }
+
+    @property
+    def ready(self):
+        return self.status["state"] == "ready"
+
+    def set_status(self, state, progress, message):
+        self.status.update({"state": state, "progress": round(progress, 3), "message": message})
+        print(f"モデル '{self.name}' の状態: {state} ({progress:.0%}) {message}")
+
+    def summary(self):
+        summary = {
+            "name": self.name,
+            "status": self.status["state"],
+            **{key: value for key, value in self.status.items() if key != "state"},
+            "resident_memory_bytes": self.memory_bytes if self.pipe is not None else 0,
+            "last_used": self.last_used or None,
+            "in_flight": self.in_flight,
+        }
+        if self.worker is not None:
+            summary["queue_depth"] = self.worker.queue_depth
+            summary["inference_stats"] = self.worker.stats
+            if getattr(self.worker, "prefix_cache", None) is not None:
+                summary["prefix_cache"] = self.worker.prefix_cache.summary()
+            if getattr(self.worker, "compiled", None) is not None:
+                summary["compiled_generation"] = self.worker.compiled.summary()
+        return summary
+
+class ModelRegistry:
+    """
+    名前で選択できる複数モデルのレジストリ
+
+    モデルは最初に要求されたときにバックグラウンドで読み込まれる。
+    常駐メモリの合計が memory_budget を超える場合は、処理中のリクエストがない
+    モデルを最後に使われた順 (LRU) に退避する。既定のモデルは退避しない。
+    """
+
+    def __init__(self, default_model, model_names=(), memory_budget=0):
+        self.default_model = default_model
+        self.memory_budget = memory_budget
+        names = list(dict.fromkeys([default_model] + list(model_names)))
+        self._entries = {name: ModelEntry(name) for name in names}
+        self._lock = threading.Lock()
+
+    def get(self, name=None):
+        """モデル名 (省略時は既定のモデル) に対応するエントリを返す"""
+        entry = self._entries.get(name or self.default_model)
+        if entry is None:
+            raise UnknownModelError(
+                f"モデル '{name}' は登録されていません (利用可能: {', '.join(self._entries)})"
+            )
+        return entry
+
+    def entries(self):
+        return list(self._entries.values())
+
+    def start_loading(self, name=None):
+        """
+        モデルの読み込みをバックグラウンドスレッドで開始する
 
-def load_model():
+        読み込み中・準備完了の場合は何もしないため、同時に呼ばれても読み込みは1回だけ行われる。
+        """
+        entry = self.get(name)
+        with self._lock:
+            if entry.status["state"] in ("loading", "warming", "ready"):
+                return False
+            entry.set_status("loading", 0.0, "モデルの読み込みを開始します")
+        threading.Thread(target=load_model_task, args=(entry.name,), name=f"model-loader-{entry.name}", daemon=True).start()
+        return True
+
+    def make_room(self, entry, required_bytes):
+        """entry に required_bytes を割り当てられるように、他のモデルをLRUで退避する"""
+        if not self.memory_budget:
+            return
+        with self._lock:
+            others = [e for e in self._entries.values() if e is not entry and e.pipe is not None]
+            resident = sum(e.memory_bytes for e in others)
+            candidates = sorted(
+                (e for e in others if e.name != self.default_model and e.ready and e.in_flight == 0),
+                key=lambda e: e.last_used
+            )
+            for victim in candidates:
+                if resident + required_bytes <= self.memory_budget:
+                    break
+                resident -= victim.memory_bytes
+                self._evict(victim)
+        if resident + required_bytes > self.memory_budget:
+            print(f"警告: モデルの常駐メモリが上限を超えています ({(resident + required_bytes) / 1024 ** 3:.1f}GB > {self.memory_budget / 1024 ** 3:.1f}GB)")
+
+    def _evict(self, entry):
+        print(f"モデル '{entry.name}' をメモリから退避します ({entry.memory_bytes / 1024 ** 3:.2f}GB)")
+        worker, entry.worker, entry.pipe, entry.draft_model = entry.worker, None, None, None
+        entry.set_status("not_loaded", 0.0, "メモリ上限のため退避されました")
+        if worker is not None:
+            worker.shutdown()
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    def acquire(self, entry):
+        """
+        準備ができていれば entry を処理中として数え、その推論ワーカーを返す (準備ができていなければNone)
+
+        処理中のモデルは退避されないため、release を呼ぶまで返したワーカーとpipelineを使い続けられる。
+        """
+        with self._lock:
+            if not entry.ready or entry.worker is None:
+                return None
+            entry.in_flight += 1
+            entry.last_used = time.time()
+            return entry.worker
+
+    def release(self, entry):
+        """acquire で処理中として数えたリクエストの終了を記録する"""
+        with self._lock:
+            entry.in_flight -= 1
+            entry.last_used = time.time()
+
+    def resident_bytes(self):
+        return sum(e.memory_bytes for e in self._entries.values() if e.pipe is not None)
+
+    def summary(self):
+        return [entry.summary() for entry in self._entries.values()]
+
+def measure_model_memory(pipe):
+    """モデルのパラメータとバッファが占めるメモリのバイト数を返す"""
+    if hasattr(pipe.model, "get_memory_footprint"):
+        return int(pipe.model.get_memory_footprint())
+    return sum(p.numel() * p.element_size() for p in pipe.model.parameters())
+
+def get_snapshot_path(model_name):
+    """モデルのローカルスナップショットのパスを返す (未設定ならNone)"""
+    if not config.MODEL_SNAPSHOT_DIR:
+        return None
+    return os.path.join(config.MODEL_SNAPSHOT_DIR, model_name.replace("/", "--"))
+
+def load_pipeline_from_snapshot(snapshot_path, device, torch_dtype):
+    """ローカルスナップショットからpipelineを組み立てる (safetensorsはメモリマップで読み込まれる)"""
+    snapshot_model = AutoModelForCausalLM.from_pretrained(
+        snapshot_path, torch_dtype=torch_dtype, local_files_only=True, use_safetensors=True
+    )
+    snapshot_tokenizer = AutoTokenizer.from_pretrained(snapshot_path, local_files_only=True)
+    return pipeline("text-generation", model=snapshot_model, tokenizer=snapshot_tokenizer, device=device)
+
+def save_model_snapshot(pipe, model_name):
+    """
+    読み込んだモデルをsafetensors形式でローカルスナップショットとして保存する
+
+    レプリカが同時に保存しないよう、ロックファイルを取得できたプロセスだけが書き込む
+    (取得できなかった場合は、他のプロセスが保存中なので何もしない)。
+    """
+    snapshot_path = get_snapshot_path(model_name)
+    if snapshot_path is None or os.path.exists(os.path.join(snapshot_path, SNAPSHOT_MARKER)):
+        return
+    tmp_path = f"{snapshot_path}.tmp-{os.getpid()}"
+    try:
+        os.makedirs(os.path.dirname(snapshot_path), exist_ok=True)
+        with open(f"{snapshot_path}.lock", "w") as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                print(f"モデルのスナップショットは他のプロセスが保存中です: {snapshot_path}")
+                return
+            if os.path.exists(os.path.join(snapshot_path, SNAPSHOT_MARKER)):
+                return
+            start_time = time.time()
+            pipe.model.save_pretrained(tmp_path, safe_serialization=True)
+            pipe.tokenizer.save_pretrained(tmp_path)
+            with open(os.path.join(tmp_path, SNAPSHOT_MARKER), "w") as f:
+                json.dump({"model_name": model_name, "created_at": time.time()}, f)
+            # 以前の保存が途中で終わったディレクトリ (目印のファイルがない) は置き換える
+            shutil.rmtree(snapshot_path, ignore_errors=True)
+            os.replace(tmp_path, snapshot_path)
+            print(f"モデルのスナップショットを保存しました: {snapshot_path} ({time.time() - start_time:.1f}秒)")
+    except Exception as e:
+        print(f"モデルのスナップショットの保存に失敗しました: {e}")
+        traceback.print_exc()
+        # 書きかけの一時ディレクトリを残さない
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+# --- CPU推論の最適化 ---
+_cpu_runtime_configured = False
+
+def parse_core_list(spec):
+    """"0-3,8" のようなコア指定をコア番号の集合に変換する"""
+    cores = set()
+    for part in spec.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        if "-" in part:
+            first, last = part.split("-", 1)
+            cores.update(range(int(first), int(last) + 1))
+        else:
+            cores.add(int(part))
+    return cores
+
+def configure_cpu_runtime():
+    """コアの固定とintra-op/inter-opスレッド数を設定する (プロセスで1回だけ)"""
+    global _cpu_runtime_configured
+    if _cpu_runtime_configured:
+        return
+    _cpu_runtime_configured = True
+    if config.CPU_CORES and hasattr(os, "sched_setaffinity"):
+        try:
+            os.sched_setaffinity(0, parse_core_list(config.CPU_CORES))
+        except Exception as e:
+            print(f"コアの固定に失敗しました: {e}")
+    available_cores = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count()
+    torch.set_num_threads(config.CPU_THREADS or available_cores)
+    try:
+        torch.set_num_interop_threads(config.CPU_INTEROP_THREADS)
+    except RuntimeError as e:
+        # 並列処理の開始後は変更できない
+        print(f"inter-opスレッド数を設定できませんでした: {e}")
+    print(f"CPU推論の設定: コア={config.CPU_CORES or 'すべて'}, intra-op={torch.get_num_threads()}, inter-op={config.CPU_INTEROP_THREADS}")
+
+def cpu_supports_bf16():
+    """CPUがbfloat16の演算をネイティブに実行できるか (AVX512-BF16 または AMX) を判定する"""
+    try:
+        with open("/proc/cpuinfo") as f:
+            flags = set(f.read().split())
+        return bool(flags & {"avx512_bf16", "amx_bf16"})
+    except OSError:
+        return False
+
+def select_cpu_dtype():
+    """CPU推論で読み込むdtypeを選択する"""
+    mode = config.CPU_INFERENCE_MODE
+    if mode == "bf16" or (mode == "auto" and cpu_supports_bf16()):
+        return torch.bfloat16
+    # ネイティブ対応がないCPUではbfloat16はエミュレーションになり遅いため、float32を使う
+    # 動的量子化とベンチマークもfloat32のモデルから始める
+    return torch.float32
+
+def quantize_int8(model_to_quantize):
+    """線形層の重みをint8に動的量子化する"""
+    return torch.ao.quantization.quantize_dynamic(model_to_quantize, {torch.nn.Linear}, dtype=torch.qint8)
+
+def measure_tokens_per_second(pipe, new_tokens):
+    """代表的なプロンプトで貪欲デコードを行い、生成速度 (tokens/sec) を計測する"""
+    prompt = "ユーザー: 日本の四季について簡単に説明してください。\nアシスタント: "
+    with torch.inference_mode():
+        pipe(prompt, max_new_tokens=2, do_sample=False)  # 初回のオーバーヘッドを除く
+        start_time = time.time()
+        outputs = pipe(prompt, max_new_tokens=new_tokens, min_new_tokens=new_tokens, do_sample=False, return_full_text=False)
+        elapsed = time.time() - start_time
+    generated = len(pipe.tokenizer(outputs[0]["generated_text"], add_special_tokens=False)["input_ids"])
+    return max(generated, 1) / elapsed
+
+def benchmark_cpu_configurations(pipe):
+    """
+    dtype・量子化・スレッド数の候補を計測し、最速の構成をpipeに適用する
+
+    float32で読み込んだモデルを基準に、候補ごとにコピーを作って比較する。
+    """
+    base_model = pipe.model
+    variants = [("fp32", lambda: base_model)]
+    if cpu_supports_bf16():
+        variants.append(("bf16", lambda: copy.deepcopy(base_model).to(torch.bfloat16)))
+    variants.append(("int8", lambda: quantize_int8(copy.deepcopy(base_model))))
+    thread_candidates = config.CPU_BENCHMARK_THREADS or [torch.get_num_threads()]
+
+    results = []
+    best = None
+    for name, build in variants:
+        candidate = build()
+        pipe.model = candidate
+        for threads in thread_candidates:
+            torch.set_num_threads(threads)
+            tokens_per_second = measure_tokens_per_second(pipe, config.CPU_BENCHMARK_NEW_TOKENS)
+            print(f"CPUベンチマーク: {name}, threads={threads}: {tokens_per_second:.2f} tokens/sec")
+            results.append({"mode": name, "threads": threads, "tokens_per_second": round(tokens_per_second, 2)})
+            if best is None or tokens_per_second > best[0]:
+                best = (tokens_per_second, name, threads, candidate)
+        if best[3] is not candidate and candidate is not base_model:
+            del candidate
+            gc.collect()
+
+    _, best_name, best_threads, best_model = best
+    pipe.model = best_model
+    torch.set_num_threads(best_threads)
+    print(f"CPUベンチマーク: 最速の構成 {best_name}, threads={best_threads} を使用します")
+    return {"mode": best_name, "threads": best_threads, "benchmark": results}
+
+def optimize_cpu_pipeline(pipe):
+    """CPU推論モードに応じて量子化またはベンチマークを行い、適用した構成を返す"""
+    mode = config.CPU_INFERENCE_MODE
+    if mode == "benchmark":
+        return benchmark_cpu_configurations(pipe)
+    if mode == "int8":
+        pipe.model = quantize_int8(pipe.model)
+        return {"mode": "int8", "threads": torch.get_num_threads()}
+    dtype_name = "bf16" if pipe.model.dtype == torch.bfloat16 else "fp32"
+    return {"mode": dtype_name, "threads": torch.get_num_threads()}
+
+def load_model(model_name=None):
     """推論用のLLMモデルを読み込む"""
-    global model  # グローバル変数を更新するために必要
+    entry = model_registry.get(model_name)
     try:
         device = "cuda" if torch.cuda.is_available() else "cpu"
         print(f"使用デバイス: {device}")
-        pipe = pipeline(
-            "text-generation",
-            model=config.MODEL_NAME,
-            model_kwargs={"torch_dtype": torch.bfloat16},
-            device=device
-        )
-        print(f"モデル '{config.MODEL_NAME}' の読み込みに成功しました")
-        model = pipe  # グローバル変数を更新
+        torch_dtype = torch.bfloat16
+        if device == "cpu":
+            configure_cpu_runtime()
+            torch_dtype = select_cpu_dtype()
+        pipe = None
+        snapshot_path = get_snapshot_path(entry.name)
+        if snapshot_path and os.path.exists(os.path.join(snapshot_path, SNAPSHOT_MARKER)):
+            try:
+                pipe = load_pipeline_from_snapshot(snapshot_path, device, torch_dtype)
+                entry.status["source"] = "snapshot"
+                print(f"ローカルスナップショットから読み込みました: {snapshot_path}")
+            except Exception as e:
+                print(f"スナップショットからの読み込みに失敗しました。通常の読み込みを行います: {e}")
+        if pipe is None:
+            pipe = pipeline(
+                "text-generation",
+                model=entry.name,
+                model_kwargs={"torch_dtype": torch_dtype},
+                device=device
+            )
+            entry.status["source"] = "pipeline"
+        if device == "cpu":
+            entry.status["cpu_config"] = optimize_cpu_pipeline(pipe)
+        print(f"モデル '{entry.name}' の読み込みに成功しました")
         return pipe
     except Exception as e:
-        error_msg = f"モデル '{config.MODEL_NAME}' の読み込みに失敗: {e}"
+        error_msg = f"モデル '{entry.name}' の読み込みに失敗: {e}"
         print(error_msg)
         traceback.print_exc()  # 詳細なエラー情報を出力
         return None
 
-def extract_assistant_response(outputs, user_prompt):
-    """モデルの出力からアシスタントの応答を抽出する"""
+def load_draft_model(pipe, draft_model_name):
+    """投機的デコード用のdraftモデルを本体と同じデバイスとdtypeで読み込む (語彙が異なる場合はNone)"""
+    try:
+        draft_tokenizer = AutoTokenizer.from_pretrained(draft_model_name)
+        if draft_tokenizer.get_vocab() != pipe.tokenizer.get_vocab():
+            print(f"draftモデル '{draft_model_name}' の語彙が本体のモデルと異なるため使用しません")
+            return None
+        draft_model = AutoModelForCausalLM.from_pretrained(draft_model_name, torch_dtype=pipe.model.dtype)
+        draft_model.to(pipe.model.device)
+        draft_model.eval()
+        print(f"draftモデル '{draft_model_name}' の読み込みに成功しました")
+        return draft_model
+    except Exception as e:
+        print(f"draftモデル '{draft_model_name}' の読み込みに失敗: {e}")
+        traceback.print_exc()
+        return None
+
+# モデルレジストリのグローバル変数
+model_registry = ModelRegistry(
+    config.MODEL_NAME,
+    config.MODEL_NAMES,
+    int(config.MODEL_MEMORY_BUDGET_GB * 1024 ** 3)
+)
+
+# 応答を抽出できなかった場合に extract_assistant_response が返すメッセージ
+EXTRACTION_FAILURE_RESPONSES = ("応答の抽出に失敗しました。", "応答を生成できませんでした。")
+
+def extract_assistant_response(outputs, user_prompt=None):
+    """モデルの出力からアシスタントの応答を抽出する (user_prompt がNoneの場合、出力は生成部分のみとみなす)"""
     assistant_response = ""
     try:
         if outputs and isinstance(outputs, list) and len(outputs) > 0 and outputs[0].get("generated_text"):
@@ -96,7 +895,7 @@ def extract_assistant_response(outputs, user_prompt):
                         assistant_response = last_message.get("content", "").strip()
                     else:
                         # 予期しないリスト形式の場合は最後の要素を文字列として試行
-                        print(f"警告: 最後のメッセージの形式が予期しないリスト形式です: {last_message}")
+                        logger.warning("最後のメッセージの形式が予期しないリスト形式です: %s", last_message)
                         assistant_response = str(last_message).strip()
 
             elif isinstance(generated_output, str):
@@ -113,171 +912,3223 @@ def extract_assistant_response(outputs, user_prompt):
                         # 元のプロンプトが見つからない場合は、生成されたテキストをそのまま返す
                         assistant_response = full_text
                 else:
-                    assistant_response = full_text
+                    # 新しく生成された部分だけが渡された場合は、プロンプトを探さない
+                    assistant_response = full_text.strip()
             else:
-                print(f"警告: 予期しない出力タイプ: {type(generated_output)}")
+                logger.warning("予期しない出力タイプ: %s", type(generated_output))
                 assistant_response = str(generated_output).strip()  # 文字列に変換
 
     except Exception as e:
-        print(f"応答の抽出中にエラーが発生しました: {e}")
-        traceback.print_exc()
+        logger.exception("応答の抽出中にエラーが発生しました: %s", e)
         assistant_response = "応答の抽出に失敗しました。"  # エラーメッセージを設定
 
     if not assistant_response:
-        print("警告: アシスタントの応答を抽出できませんでした。完全な出力:", outputs)
+        logger.warning("アシスタントの応答を抽出できませんでした。完全な出力: %s", outputs)
         # デフォルトまたはエラー応答を返す
         assistant_response = "応答を生成できませんでした。"
 
     return assistant_response
 
-# --- FastAPIエンドポイント定義 ---
-@app.on_event("startup")
-async def startup_event():
-    """起動時にモデルを初期化"""
-    load_model_task()  # バックグラウンドではなく同期的に読み込む
-    if model is None:
-        print("警告: 起動時にモデルの初期化に失敗しました")
-    else:
-        print("起動時にモデルの初期化が完了しました。")
+class IncrementalAssistantExtractor:
+    """
+    extract_assistant_response のストリーミング版
 
-@app.get("/")
-async def root():
-    """基本的なAPIチェック用のルートエンドポイント"""
-    return {"status": "ok", "message": "Local LLM API is runnning"}
+    推論ワーカーはプロンプトのトークンを通知しないため、受け取る断片に
+    プロンプトのエコーは含まれない。ここでは最終的に strip() した結果と
+    一致するように、先頭の空白を捨て、末尾の空白は続きが来るまで保留する。
+    """
 
-@app.get("/health")
-async def health_check():
-    """ヘルスチェックエンドポイント"""
-    global model
-    if model is None:
-        return {"status": "error", "message": "No model loaded"}
+    def __init__(self):
+        self._pending_whitespace = ""
+        self.text = ""
 
-    return {"status": "ok", "model": config.MODEL_NAME}
+    def feed(self, chunk):
+        """生成テキストの断片を追加し、クライアントに送信できるテキストを返す"""
+        text = self._pending_whitespace + chunk
+        if not self.text:
+            text = text.lstrip()
+        stripped = text.rstrip()
+        self._pending_whitespace = text[len(stripped):]
+        self.text += stripped
+        return stripped
 
-# 簡略化されたエンドポイント
-@app.post("/generate", response_model=GenerationResponse)
-async def generate_simple(request: SimpleGenerationRequest):
-    """単純なプロンプト入力に基づいてテキストを生成"""
-    global model
+    def finish(self):
+        """ストリームの終了時に呼び出し、抽出された応答全体を返す"""
+        if not self.text:
+            logger.warning("ストリーミング中にアシスタントの応答を抽出できませんでした。")
+            return "応答を生成できませんでした。"
+        return self.text
 
-    if model is None:
-        print("generateエンドポイント: モデルが読み込まれていません。読み込みを試みます...")
-        load_model_task()  # 再度読み込みを試みる
-        if model is None:
-            print("generateエンドポイント: モデルの読み込みに失敗しました。")
-            raise HTTPException(status_code=503, detail="モデルが利用できません。後でもう一度お試しください。")
+# --- 応答キャッシュ ---
+def request_fingerprint(request, model_name):
+    """プロンプトと生成パラメータを正規化したSHA-256ハッシュ (同一の出力分布になるリクエストは同じ値)"""
+    fields = request.model_dump() if hasattr(request, "model_dump") else request.dict()
+    fields["prompt"] = unicodedata.normalize("NFC", fields["prompt"])
+    fields["model"] = model_name
+    # 投機的デコードは出力の分布を変えないため、キーに含めない
+    fields.pop("speculative", None)
+    fields.pop("num_speculative_tokens", None)
+    fields.pop("coalesce", None)
+    # 同じ質問には利用者によらず同じ応答を返せるよう、利用者と期限はキーに含めない
+    # (相乗りした場合、共有する生成の期限は SingleFlight が最も遅い期限に延ばす)
+    fields.pop("user", None)
+    fields.pop("timeout", None)
+    payload = json.dumps(fields, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
 
-    try:
-        start_time = time.time()
-        print(f"シンプルなリクエストを受信: prompt={request.prompt[:100]}..., max_new_tokens={request.max_new_tokens}")  # 長いプロンプトは切り捨て
-
-        # プロンプトテキストで直接応答を生成
-        print("モデル推論を開始...")
-        outputs = model(
-            request.prompt,
-            max_new_tokens=request.max_new_tokens,
-            do_sample=request.do_sample,
-            temperature=request.temperature,
-            top_p=request.top_p,
-        )
-        print("モデル推論が完了しました。")
+class ResponseCache:
+    """
+    同一のプロンプトと生成パラメータに対する応答を保持するキャッシュ
 
-        # アシスタント応答を抽出
-        assistant_response = extract_assistant_response(outputs, request.prompt)
-        print(f"抽出されたアシスタント応答: {assistant_response[:100]}...")  # 長い場合は切り捨て
+    メモリ上はエントリ数上限付きのLRUとTTLで管理し、cache_dir を指定すると
+    SQLiteのディスク層にも書き込んで再起動後も再利用できるようにする。
+    """
 
-        end_time = time.time()
-        response_time = end_time - start_time
-        print(f"応答生成時間: {response_time:.2f}秒")
+    def __init__(self, max_entries=RESPONSE_CACHE_MAX_ENTRIES, ttl=RESPONSE_CACHE_TTL,
+                 include_sampled=RESPONSE_CACHE_INCLUDE_SAMPLED, cache_dir=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.include_sampled = include_sampled
+        self._entries = collections.OrderedDict()  # key -> (generated_text, stored_at)
+        self._lock = threading.Lock()
+        self._db = None
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+            self._db = sqlite3.connect(os.path.join(cache_dir, "response_cache.sqlite3"), check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, generated_text TEXT, stored_at REAL)"
+            )
+            # 前回の起動時から期限切れになったエントリを削除する
+            self._db.execute("DELETE FROM responses WHERE stored_at < ?", (time.time() - self.ttl,))
+            self._db.commit()
+        self.stats = {"hits": 0, "disk_hits": 0, "misses": 0, "evictions": 0, "expirations": 0, "skipped": 0}
 
-        return GenerationResponse(
-            generated_text=assistant_response,
-            response_time=response_time
-        )
+    def make_key(self, request, model_name):
+        """プロンプトと全パラメータを正規化したハッシュをキーとして返す。キャッシュ対象外ならNone"""
+        if request.do_sample and not self.include_sampled:
+            self.stats["skipped"] += 1
+            return None
+        return request_fingerprint(request, model_name)
 
-    except Exception as e:
-        print(f"シンプル応答生成中にエラーが発生しました: {e}")
-        traceback.print_exc()
-        raise HTTPException(status_code=500, detail=f"応答の生成中にエラーが発生しました: {str(e)}")
+    def get(self, key):
+        """キャッシュされた応答を返す。見つからない、または期限切れの場合はNone"""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                generated_text, stored_at = entry
+                if now - stored_at <= self.ttl:
+                    self._entries.move_to_end(key)
+                    self.stats["hits"] += 1
+                    return generated_text
+                del self._entries[key]
+                self.stats["expirations"] += 1
 
-def load_model_task():
-    """モデルを読み込むバックグラウンドタスク"""
-    global model
-    print("load_model_task: モデルの読み込みを開始...")
-    # load_model関数を呼び出し、結果をグローバル変数に設定
-    loaded_pipe = load_model()
-    if loaded_pipe:
-        model = loaded_pipe  # グローバル変数を更新
-        print("load_model_task: モデルの読み込みが完了しました。")
-    else:
-        print("load_model_task: モデルの読み込みに失敗しました。")
+            if self._db is not None:
+                row = self._db.execute(
+                    "SELECT generated_text, stored_at FROM responses WHERE key = ?", (key,)
+                ).fetchone()
+                if row is not None:
+                    generated_text, stored_at = row
+                    if now - stored_at <= self.ttl:
+                        self._put_memory(key, generated_text, stored_at)
+                        self.stats["hits"] += 1
+                        self.stats["disk_hits"] += 1
+                        return generated_text
+                    self._db.execute("DELETE FROM responses WHERE key = ?", (key,))
+                    self._db.commit()
+                    self.stats["expirations"] += 1
 
-print("FastAPIエンドポイントを定義しました。")
+            self.stats["misses"] += 1
+            return None
 
-# --- ngrokでAPIサーバーを実行する関数 ---
-def run_with_ngrok(port=8501):
-    """ngrokでFastAPIアプリを実行"""
-    nest_asyncio.apply()
+    def put(self, key, generated_text):
+        stored_at = time.time()
+        with self._lock:
+            self._put_memory(key, generated_text, stored_at)
+            if self._db is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO responses (key, generated_text, stored_at) VALUES (?, ?, ?)",
+                    (key, generated_text, stored_at)
+                )
+                self._db.commit()
 
-    ngrok_token = os.environ.get("NGROK_TOKEN")
-    if not ngrok_token:
-        print("Ngrok認証トークンが'NGROK_TOKEN'環境変数に設定されていません。")
-        try:
-            print("Colab Secrets(左側の鍵アイコン)で'NGROK_TOKEN'を設定することをお勧めします。")
-            ngrok_token = input("Ngrok認証トークンを入力してください (https://dashboard.ngrok.com/get-started/your-authtoken): ")
-        except EOFError:
-            print("\nエラー: 対話型入力が利用できません。")
-            print("Colab Secretsを使用するか、ノートブックセルで`os.environ['NGROK_TOKEN'] = 'あなたのトークン'`でトークンを設定してください")
-            return
+    def _put_memory(self, key, generated_text, stored_at):
+        self._entries[key] = (generated_text, stored_at)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.stats["evictions"] += 1
 
-    if not ngrok_token:
-        print("エラー: Ngrok認証トークンを取得できませんでした。中止します。")
-        return
+    def summary(self):
+        lookups = self.stats["hits"] + self.stats["misses"]
+        return {
+            **self.stats,
+            "hit_rate": self.stats["hits"] / lookups if lookups else 0.0,
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "ttl": self.ttl,
+            "disk": self._db is not None,
+        }
 
-    try:
-        ngrok.set_auth_token(ngrok_token)
+# 応答キャッシュのグローバル変数
+response_cache = None
+if config.ENABLE_RESPONSE_CACHE:
+    response_cache = ResponseCache(
+        config.RESPONSE_CACHE_MAX_ENTRIES,
+        config.RESPONSE_CACHE_TTL,
+        config.RESPONSE_CACHE_INCLUDE_SAMPLED,
+        config.RESPONSE_CACHE_DIR
+    )
 
-        # 既存のngrokトンネルを閉じる
+# --- 意味的キャッシュ ---
+def single_turn_question(prompt):
+    """
+    会話履歴の形式のプロンプトが1ターン目の質問であれば、(前置き, 質問) を返す
+
+    前置きはシステムコンテキストなど最初のユーザーの発言より前の部分。
+    アシスタントの応答を含む (2ターン目以降の) プロンプトや、会話履歴の形式でないプロンプトはNone。
+    """
+    assistant_prefix = CHAT_ROLE_PREFIXES["assistant"]
+    if not prompt.endswith(assistant_prefix):
+        return None
+    lines = prompt[:-len(assistant_prefix)].split("\n")
+    user_lines = [i for i, line in enumerate(lines) if line.startswith(CHAT_ROLE_PREFIXES["user"])]
+    if len(user_lines) != 1 or any(line.startswith(assistant_prefix) for line in lines):
+        return None
+    start = user_lines[0]
+    question = "\n".join(lines[start:])[len(CHAT_ROLE_PREFIXES["user"]):].strip()
+    if not question:
+        return None
+    return "\n".join(lines[:start]), question
+
+class TextEmbedder:
+    """
+    小さな埋め込みモデルで文章をL2正規化したベクトルにする
+
+    モデルは最初に使うときに読み込む。E5系のモデルは質問に "query: " を付けて埋め込む。
+    """
+
+    def __init__(self, model_name):
+        self.model_name = model_name
+        self.device = "cuda" if torch.cuda.is_available() else "cpu"
+        self._tokenizer = None
+        self._model = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        logger.info("意味的キャッシュの埋め込みモデルを読み込みます: %s", self.model_name)
+        self._tokenizer = AutoTokenizer.from_pretrained(self.model_name)
+        self._model = AutoModel.from_pretrained(self.model_name).to(self.device).eval()
+
+    def embed(self, text):
+        """
+        Args:
+            text (str): 埋め込む文章
+
+        Returns:
+            numpy.ndarray: L2正規化した float32 のベクトル
+        """
+        if "e5" in self.model_name.lower():
+            text = "query: " + text
+        with self._lock:
+            if self._model is None:
+                self._load()
+            inputs = self._tokenizer(text, return_tensors="pt", truncation=True, max_length=512).to(self.device)
+            with torch.inference_mode():
+                hidden = self._model(**inputs).last_hidden_state
+            # パディングを除いたトークンの平均
+            mask = inputs["attention_mask"].unsqueeze(-1).to(hidden.dtype)
+            vector = ((hidden * mask).sum(dim=1) / mask.sum(dim=1))[0].float().cpu().numpy()
+        return vector / max(float(np.linalg.norm(vector)), 1e-12)
+
+class VectorIndex:
+    """
+    正規化したベクトルを固定長のNumPy行列に保持し、内積 (コサイン類似度) で最も近いものを探す
+
+    エントリ数が max_entries に達すると、最も長く使われていないエントリの行を再利用する。
+    scope が異なるエントリ (モデルや生成パラメータが異なる) は検索の対象にしない。
+    """
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._vectors = None  # 最初の追加時に次元数を決めて確保する
+        self._scopes = np.zeros(max_entries, dtype=np.int64)
+        self._values = [None] * max_entries
+        self._stored_at = np.zeros(max_entries)
+        self._valid = np.zeros(max_entries, dtype=bool)
+        self._lru = collections.OrderedDict()  # 行番号 (使われた順)
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._lru)
+
+    def search(self, vector, scope):
+        """最も類似度の高いエントリの (行番号, 類似度) を返す。対象がなければ (None, None)"""
+        if self._vectors is None or not self._lru:
+            return None, None
+        candidates = self._valid & (self._scopes == scope)
+        if not candidates.any():
+            return None, None
+        scores = np.where(candidates, self._vectors @ vector, -np.inf)
+        row = int(np.argmax(scores))
+        return row, float(scores[row])
+
+    def get(self, row):
+        """行の (値, 保存した時刻) を返し、最近使われたものとして記録する"""
+        self._lru.move_to_end(row)
+        return self._values[row], self._stored_at[row]
+
+    def add(self, vector, scope, value):
+        if self._vectors is None:
+            self._vectors = np.zeros((self.max_entries, vector.shape[0]), dtype=np.float32)
+        if len(self._lru) < self.max_entries:
+            row = int(np.flatnonzero(~self._valid)[0])
+        else:
+            row, _ = self._lru.popitem(last=False)
+            self.evictions += 1
+        self._vectors[row] = vector
+        self._scopes[row] = scope
+        self._values[row] = value
+        self._stored_at[row] = time.time()
+        self._valid[row] = True
+        self._lru[row] = None
+        self._lru.move_to_end(row)
+
+    def remove(self, row):
+        self._lru.pop(row, None)
+        self._valid[row] = False
+        self._values[row] = None
+
+class SemanticLookup:
+    """意味的キャッシュの検索結果 (ミスした場合は生成後の保存に埋め込みを再利用する)"""
+
+    def __init__(self, scope, vector, answer=None, similarity=None, lookup_time=0.0):
+        self.scope = scope
+        self.vector = vector
+        self.answer = answer
+        self.similarity = similarity
+        self.lookup_time = lookup_time
+
+class SemanticCache:
+    """
+    言い回しだけが異なる1ターン目の質問に、以前に生成した応答を返すキャッシュ
+
+    質問を埋め込みモデルでベクトルにし、VectorIndex で最も近い質問とのコサイン類似度が
+    threshold 以上であればその応答を返す。前置き (システムコンテキスト)・モデル・
+    max_new_tokens・停止文字列が同じリクエストの間でのみ再利用する。
+    """
+
+    def __init__(self, embedder, threshold=SEMANTIC_CACHE_THRESHOLD, max_entries=SEMANTIC_CACHE_MAX_ENTRIES,
+                 ttl=SEMANTIC_CACHE_TTL):
+        self.embedder = embedder
+        self.threshold = threshold
+        self.ttl = ttl
+        self.index = VectorIndex(max_entries)
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "skipped": 0, "expirations": 0, "errors": 0, "lookup_seconds": 0.0}
+
+    @staticmethod
+    def make_scope(request, model_name, context):
+        # 決定的な生成とサンプリング (温度が異なるものも) の応答は互いに使い回さない
+        sampling = [request.do_sample, request.temperature if request.do_sample else None]
+        payload = json.dumps([model_name, context, request.max_new_tokens, request.stop, sampling], ensure_ascii=False)
+        return int.from_bytes(hashlib.sha256(payload.encode("utf-8")).digest()[:8], "big", signed=True)
+
+    def lookup(self, request, model_name):
+        """
+        リクエストの質問に近い質問の応答を探す (埋め込みの計算を含むため、イベントループの外で呼ぶ)
+
+        Returns:
+            SemanticLookup: 検索結果 (answer がNoneならミス)。1ターン目の質問でない場合や
+                            埋め込みに失敗した場合はNone
+        """
+        parsed = single_turn_question(unicodedata.normalize("NFC", request.prompt))
+        if parsed is None:
+            with self._lock:
+                self.stats["skipped"] += 1
+            return None
+        context, question = parsed
+        start = time.time()
         try:
-            tunnels = ngrok.get_tunnels()
-            if tunnels:
-                print(f"{len(tunnels)}個の既存トンネルが見つかりました。閉じています...")
-                for tunnel in tunnels:
-                    print(f"  - 切断中: {tunnel.public_url}")
-                    ngrok.disconnect(tunnel.public_url)
-                print("すべての既存ngrokトンネルを切断しました。")
-            else:
-                print("アクティブなngrokトンネルはありません。")
+            vector = self.embedder.embed(question)
         except Exception as e:
-            print(f"トンネル切断中にエラーが発生しました: {e}")
-            # エラーにもかかわらず続行を試みる
+            # 埋め込みモデルを使えなくても、通常の生成は続ける
+            with self._lock:
+                self.stats["errors"] += 1
+            logger.warning("意味的キャッシュの埋め込みに失敗しました: %s", e)
+            return None
+        scope = self.make_scope(request, model_name, context)
+        with self._lock:
+            row, similarity = self.index.search(vector, scope)
+            answer = None
+            if row is not None and similarity >= self.threshold:
+                answer, stored_at = self.index.get(row)
+                if time.time() - stored_at > self.ttl:
+                    self.index.remove(row)
+                    self.stats["expirations"] += 1
+                    answer = None
+            lookup_time = time.time() - start
+            self.stats["hits" if answer is not None else "misses"] += 1
+            self.stats["lookup_seconds"] += lookup_time
+        SEMANTIC_CACHE_LOOKUPS_TOTAL.labels("hit" if answer is not None else "miss").inc()
+        SEMANTIC_CACHE_LOOKUP_SECONDS.observe(lookup_time)
+        if similarity is not None:
+            SEMANTIC_CACHE_SIMILARITY.observe(similarity)
+        return SemanticLookup(scope, vector, answer, similarity, lookup_time)
 
-        # 新しいngrokトンネルを開く
-        print(f"ポート{port}に新しいngrokトンネルを開いています...")
-        ngrok_tunnel = ngrok.connect(port)
-        public_url = ngrok_tunnel.public_url
-        print("---------------------------------------------------------------------")
-        print(f"✅ 公開URL:   {public_url}")
-        print(f"📖 APIドキュメント (Swagger UI): {public_url}/docs")
-        print("---------------------------------------------------------------------")
-        print("(APIクライアントやブラウザからアクセスするためにこのURLをコピーしてください)")
-        uvicorn.run(app, host="0.0.0.0", port=port, log_level="info")  # ログレベルをinfoに設定
+    def put(self, lookup, answer):
+        """ミスした検索の質問に対して生成した応答を保存する"""
+        with self._lock:
+            self.index.add(lookup.vector, lookup.scope, answer)
 
-    except Exception as e:
-        print(f"\n ngrokまたはUvicornの起動中にエラーが発生しました: {e}")
-        traceback.print_exc()
-        # エラー後に残る可能性のあるngrokトンネルを閉じようとする
+    def summary(self):
+        with self._lock:
+            stats = dict(self.stats)
+            entries = len(self.index)
+        lookups = stats["hits"] + stats["misses"]
+        return {
+            **stats,
+            "hit_rate": stats["hits"] / lookups if lookups else 0.0,
+            "mean_lookup_seconds": stats["lookup_seconds"] / lookups if lookups else None,
+            "entries": entries,
+            "evictions": self.index.evictions,
+            "max_entries": self.index.max_entries,
+            "threshold": self.threshold,
+            "model": self.embedder.model_name,
+        }
+
+# 意味的キャッシュのグローバル変数
+semantic_cache = None
+if config.ENABLE_SEMANTIC_CACHE:
+    semantic_cache = SemanticCache(
+        TextEmbedder(config.SEMANTIC_CACHE_MODEL),
+        config.SEMANTIC_CACHE_THRESHOLD,
+        config.SEMANTIC_CACHE_MAX_ENTRIES,
+        config.SEMANTIC_CACHE_TTL
+    )
+
+class SingleFlight:
+    """
+    同じキーの処理が実行中であれば新たに実行せず、その結果を共有する
+
+    処理は独立したタスクとして実行するため、待っている呼び出し元の一部が
+    キャンセルされても、残りの呼び出し元への結果は失われない。
+    共有する生成は最初の呼び出し元が渡した GenerationControl で制御し、相乗りした呼び出し元の期限が
+    遅い場合 (または期限がない場合) はその期限まで延ばす。待っている呼び出し元が全てキャンセルされた
+    場合は生成を中止し、以降の呼び出し元が中止した生成に相乗りしないようにキーを取り除く。
+    """
+
+    def __init__(self):
+        self._tasks = {}  # key -> asyncio.Task
+        self._waiters = collections.Counter()  # key -> 結果を待っている呼び出し元の数
+        self._controls = {}  # key -> 共有する生成の GenerationControl
+        self.stats = {"leaders": 0, "coalesced": 0, "abandoned": 0}
+
+    def should_coalesce(self, request):
+        """do_sample=False は常に、サンプリングは coalesce=True を明示した場合だけ相乗りする"""
+        if request.coalesce is not None:
+            return request.coalesce
+        return not request.do_sample
+
+    async def run(self, key, make_coroutine, control=None):
+        """
+        (結果, 相乗りしたか) を返す
+
+        make_coroutine は実行中の処理がない場合だけ使われ、control はその生成の制御として保持する。
+        相乗りする場合は、実行中の生成の期限を control の期限まで延ばす。
+        """
+        task = self._tasks.get(key)
+        coalesced = task is not None
+        if coalesced:
+            self.stats["coalesced"] += 1
+            shared = self._controls.get(key)
+            if shared is not None and control is not None:
+                shared.extend_deadline(control.deadline)
+        else:
+            task = asyncio.ensure_future(make_coroutine())
+            self._tasks[key] = task
+            self._controls[key] = control
+            task.add_done_callback(lambda done: self._forget(key, done))
+            self.stats["leaders"] += 1
+        self._waiters[key] += 1
         try:
-            print("エラーにより残っている可能性のあるngrokトンネルを閉じています...")
-            tunnels = ngrok.get_tunnels()
-            for tunnel in tunnels:
-                ngrok.disconnect(tunnel.public_url)
-            print("ngrokトンネルを閉じました。")
-        except Exception as ne:
-            print(f"ngrokトンネルのクリーンアップ中に別のエラーが発生しました: {ne}")
+            return await asyncio.shield(task), coalesced
+        finally:
+            self._waiters[key] -= 1
+            if not self._waiters[key]:
+                del self._waiters[key]
+                if not task.done():
+                    # 結果を待つ呼び出し元がいなくなったため、生成を中止して以降の相乗りの対象から外す
+                    self.stats["abandoned"] += 1
+                    shared = self._controls.get(key) if self._tasks.get(key) is task else None
+                    self._forget(key, task)
+                    if shared is not None:
+                        shared.cancel()
+
+    def _forget(self, key, task):
+        if self._tasks.get(key) is task:
+            self._tasks.pop(key)
+            self._controls.pop(key, None)
+
+    def summary(self):
+        return {**self.stats, "in_flight": len(self._tasks)}
+
+# 相乗りのグローバル変数
+single_flight = SingleFlight() if config.ENABLE_COALESCING else None
+
+# --- ユーザーごとの利用量と上限 ---
+# user を指定しないリクエストの集計先
+ANONYMOUS_USER = "anonymous"
+
+class QuotaExceededError(Exception):
+    """ユーザーの1分あたりのトークン数の上限を超えている"""
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class UserUsageTracker:
+    """
+    ユーザーごとの利用量を集計し、1分あたりのトークン数 (TPM) の上限を適用する
+
+    受付時にプロンプトと max_new_tokens の合計を予約し、完了時に実際のトークン数で
+    精算する。直近1分の合計が上限を超えるリクエストは、推論ワーカーに入れる前に拒否する。
+    user はクライアントが指定するため、直近1分の利用がなくなったユーザーの記録は削除し、
+    累計は最近使った max_users 人分だけ保持する。
+    """
+
+    WINDOW = 60.0  # 秒
+
+    def __init__(self, tokens_per_minute=USER_TOKENS_PER_MINUTE, overrides=None, max_users=USER_USAGE_MAX_USERS):
+        self.tokens_per_minute = tokens_per_minute
+        self.overrides = overrides or {}
+        self.max_users = max_users
+        self._windows = {}  # user -> deque([[timestamp, tokens], ...])
+        self._totals = collections.OrderedDict()  # user -> 累計 (最近使った順)
+        self._last_prune = time.time()
+        self._lock = threading.Lock()
+
+    def limit_for(self, user):
+        return self.overrides.get(user, self.tokens_per_minute)
+
+    @staticmethod
+    def _empty_totals():
+        return {"requests": 0, "rejected": 0, "coalesced": 0, "prompt_tokens": 0, "generated_tokens": 0}
+
+    def _user_totals(self, user):
+        """user の累計を返す (なければ作成し、上限を超えた分は最も古いユーザーから捨てる)"""
+        totals = self._totals.get(user)
+        if totals is None:
+            totals = self._totals[user] = self._empty_totals()
+            while len(self._totals) > self.max_users:
+                self._totals.popitem(last=False)
+        else:
+            self._totals.move_to_end(user)
+        return totals
+
+    def _window_tokens(self, user, now):
+        """直近1分のトークン数を返す (期限切れの記録を取り除き、空になったユーザーは削除する)"""
+        window = self._windows.get(user)
+        if window is None:
+            return 0
+        while window and now - window[0][0] > self.WINDOW:
+            window.popleft()
+        if not window:
+            del self._windows[user]
+            return 0
+        return sum(tokens for _, tokens in window)
+
+    def _prune(self, now):
+        """1分に1回、その後リクエストのないユーザーも含めて期限切れの記録を取り除く"""
+        if now - self._last_prune < self.WINDOW:
+            return
+        self._last_prune = now
+        for user in list(self._windows):
+            self._window_tokens(user, now)
+
+    def reserve(self, user, tokens):
+        """tokens を予約し、精算に使う予約を返す。上限を超える場合は QuotaExceededError"""
+        user = user or ANONYMOUS_USER
+        now = time.time()
+        with self._lock:
+            self._prune(now)
+            limit = self.limit_for(user)
+            used = self._window_tokens(user, now)
+            window = self._windows.setdefault(user, collections.deque())
+            # 単独で上限を超えるリクエストも、直近1分の利用がなければ受け付ける
+            if limit and window and used + tokens > limit:
+                self._user_totals(user)["rejected"] += 1
+                raise QuotaExceededError(
+                    f"ユーザー '{user}' の利用量の上限 ({limit}トークン/分) を超えています",
+                    self._retry_after(window, used + tokens - limit, now)
+                )
+            reservation = [now, tokens]
+            window.append(reservation)
+            self._user_totals(user)["requests"] += 1
+        return user, reservation
+
+    def _retry_after(self, window, excess, now):
+        """直近1分の利用が excess トークン分だけ期限切れになるまでの秒数"""
+        released = 0
+        for timestamp, tokens in window:
+            released += tokens
+            if released >= excess:
+                return max(1, int(timestamp + self.WINDOW - now + 1))
+        return int(self.WINDOW)
+
+    def settle(self, reservation, prompt_tokens=0, generated_tokens=0, coalesced=False):
+        """予約を実際に使ったトークン数に置き換える (失敗した場合は0。相乗りの場合は共有した生成のトークン数)"""
+        user, record = reservation
+        with self._lock:
+            record[1] = prompt_tokens + generated_tokens
+            totals = self._user_totals(user)
+            totals["prompt_tokens"] += prompt_tokens
+            totals["generated_tokens"] += generated_tokens
+            if coalesced:
+                totals["coalesced"] += 1
+
+    def usage(self, user):
+        now = time.time()
+        with self._lock:
+            totals = self._totals.get(user) or self._empty_totals()
+            return {
+                "user": user,
+                **totals,
+                "tokens_last_minute": self._window_tokens(user, now),
+                "tokens_per_minute_limit": self.limit_for(user) or None,
+            }
+
+    def summary(self):
+        with self._lock:
+            users = list(self._totals)
+        return {"tokens_per_minute_limit": self.tokens_per_minute or None, "users": [self.usage(user) for user in users]}
+
+# 利用量のグローバル変数
+user_usage = UserUsageTracker(config.USER_TOKENS_PER_MINUTE, config.USER_TOKENS_PER_MINUTE_OVERRIDES,
+                              config.USER_USAGE_MAX_USERS)
+
+# --- 推論ワーカー ---
+class QueueFullError(Exception):
+    """推論待ち行列が満杯でリクエストを受け付けられない"""
+
+class DeadlineExceededError(Exception):
+    """応答の期限までに生成を開始できなかった"""
+
+class GenerationCancelledError(Exception):
+    """クライアントが切断したため、生成を開始する前に中止した"""
+
+# 期限または中止の指示で生成を打ち切った場合の finish_reason (途中までの応答はキャッシュしない)
+INTERRUPTED_FINISH_REASONS = ("deadline", "cancelled")
+
+class GenerationControl:
+    """
+    1リクエスト分の生成の期限と中止の指示
+
+    推論ワーカーのスレッドがトークンを生成するたびに should_stop を呼び、期限に間に合わない見込みになるか、
+    中止が指示された (クライアントが切断した) 時点で生成を打ち切る。直前の呼び出しからの間隔を
+    次のトークンの所要時間の見積もりとして使い、期限を過ぎる前に途中までの結果を返せるようにする。
+    """
+
+    def __init__(self, deadline=None):
+        self.deadline = deadline  # time.time() 基準の期限 (Noneの場合は期限なし)
+        self.cancelled = False
+        self.reason = None  # 打ち切った理由: "deadline" / "cancelled"
+        self.started = False  # 推論ワーカーが生成を始めたか
+        self.generated_tokens = 0  # should_stop を呼んだ回数 (打ち切るまでに生成したトークン数)
+        self._last_check = None
+
+    def cancel(self):
+        """生成の中止を指示する (イベントループのスレッドから呼ぶ)"""
+        self.cancelled = True
+
+    def extend_deadline(self, deadline):
+        """期限を deadline まで延ばす (Noneの場合は期限をなくす)。相乗りしたリクエストの期限に合わせるために使う"""
+        if self.deadline is not None:
+            self.deadline = None if deadline is None else max(self.deadline, deadline)
+
+    def check_start(self):
+        """生成を始める前に呼び、期限切れまたは中止済みの場合は例外を送出する"""
+        if self.cancelled:
+            raise GenerationCancelledError("クライアントが切断したため生成を中止しました")
+        if self.deadline is not None and time.time() >= self.deadline:
+            raise DeadlineExceededError("応答の期限までに生成を開始できませんでした")
+        self.started = True
+
+    def should_stop(self):
+        """トークンを生成するたびに呼び、生成を打ち切る場合はTrueを返す"""
+        now = time.time()
+        self.generated_tokens += 1
+        step_time = now - self._last_check if self._last_check is not None else 0.0
+        self._last_check = now
+        if self.reason is None:
+            if self.cancelled:
+                self.reason = "cancelled"
+            elif self.deadline is not None and now + step_time >= self.deadline:
+                self.reason = "deadline"
+        return self.reason is not None
+
+class FairQueue:
+    """
+    ユーザーごとの重み付き公平キュー (start-time fair queueing)
+
+    各リクエストに「仮想時刻 (処理中のリクエストの開始タグ) とそのユーザーの前回の終了タグの
+    遅い方 + コスト / 重み」を終了タグとして付け、終了タグの小さい順に取り出す。
+    大量に投入したユーザーの後ろに他のユーザーが並ばされることがなく、
+    同じユーザーのリクエストは投入順に処理される。スレッドセーフではないため、呼び出し側でロックする。
+    """
+
+    def __init__(self, weights=None, enabled=True):
+        self.weights = weights or {}
+        self.enabled = enabled
+        self._heap = []  # (終了タグ, 投入順, 開始タグ, item)
+        self._finish_tags = {}  # user -> 最後に投入したリクエストの終了タグ
+        self._virtual_time = 0.0
+        self._order = itertools.count()
+
+    def __len__(self):
+        return len(self._heap)
+
+    def push(self, item, user=None, cost=1):
+        if not self.enabled:
+            user = None
+        start = max(self._virtual_time, self._finish_tags.get(user, 0.0))
+        finish = start + max(cost, 1) / self.weights.get(user, 1.0)
+        self._finish_tags[user] = finish
+        heapq.heappush(self._heap, (finish, next(self._order), start, item))
+
+    def peek(self):
+        return self._heap[0][3]
+
+    def pop(self):
+        _, _, start, item = heapq.heappop(self._heap)
+        self._virtual_time = start
+        if not self._heap:
+            # 待ちがなくなったら、以前の利用量を持ち越さない
+            self._finish_tags.clear()
+        return item
+
+    def pop_matching(self, predicate, limit):
+        """
+        predicate を満たす項目を取り出す順に最大 limit 件取り出す
+
+        満たさない項目は終了タグを変えずに残すため、次に取り出す順序は変わらない。
+        """
+        taken = [entry for entry in sorted(self._heap) if predicate(entry[3])][:limit]
+        if not taken:
+            return []
+        taken_orders = {entry[1] for entry in taken}
+        self._heap = [entry for entry in self._heap if entry[1] not in taken_orders]
+        heapq.heapify(self._heap)
+        self._virtual_time = taken[-1][2]
+        if not self._heap:
+            self._finish_tags.clear()
+        return [entry[3] for entry in taken]
+
+    def drain(self):
+        """待っている全ての項目を取り出す"""
+        items = [entry[3] for entry in sorted(self._heap)]
+        self._heap.clear()
+        self._finish_tags.clear()
+        return items
+
+class InferenceResult:
+    """推論ワーカーが返す結果 (pipeline互換の出力と待ち行列の情報)"""
+
+    def __init__(self, outputs, queue_wait_time, queue_depth, cached_prompt_tokens=None, speculative=None, timings=None,
+                 finish_reason=None):
+        self.outputs = outputs
+        self.queue_wait_time = queue_wait_time
+        self.queue_depth = queue_depth
+        self.cached_prompt_tokens = cached_prompt_tokens
+        self.speculative = speculative
+        # 段階ごとの所要秒数 (tokenize / prefill / decode) とトークン数 (prompt_tokens / generated_tokens)
+        self.timings = timings or {}
+        self.finish_reason = finish_reason
+
+class PrefixKVCache:
+    """
+    プロンプトの先頭部分に対するKVキャッシュをメモリ上限付きのLRUで保持する
+
+    トークン列をブロック単位に区切り、各ブロック境界までの先頭部分のハッシュを
+    キーとして登録する。新しいプロンプトは一致する最長の先頭部分のKVを再利用し、
+    残りのトークンだけをprefillすればよい。
+    """
+
+    def __init__(self, max_bytes=PREFIX_CACHE_MAX_BYTES, block_size=PREFIX_CACHE_BLOCK_SIZE):
+        self.max_bytes = max_bytes
+        self.block_size = block_size
+        self.total_bytes = 0
+        self._entries = collections.OrderedDict()  # entry_id -> (tokens, kv, nbytes, hashes)
+        self._index = {}  # ブロック境界までの先頭部分のハッシュ -> entry_id
+        self._next_entry_id = 0
+        self.stats = {
+            "lookups": 0,
+            "hits": 0,
+            "prompt_tokens": 0,
+            "prefill_tokens_saved": 0,
+            "evictions": 0,
+        }
+
+    def _block_hashes(self, token_ids, limit):
+        """limitトークン以内の各ブロック境界について (境界位置, 先頭部分のハッシュ) を返す"""
+        hashes = []
+        prefix_hash = 0
+        for end in range(self.block_size, limit + 1, self.block_size):
+            prefix_hash = hash((prefix_hash, tuple(token_ids[end - self.block_size:end])))
+            hashes.append((end, prefix_hash))
+        return hashes
+
+    def lookup(self, token_ids):
+        """token_idsの先頭と一致する最長のキャッシュを探し、(一致したトークン数, kv) を返す"""
+        self.stats["lookups"] += 1
+        self.stats["prompt_tokens"] += len(token_ids)
+        # 次のトークンのロジットを得るため、最低1トークンはprefillする
+        for end, prefix_hash in reversed(self._block_hashes(token_ids, len(token_ids) - 1)):
+            entry_id = self._index.get(prefix_hash)
+            if entry_id is None:
+                continue
+            tokens, kv, _, _ = self._entries[entry_id]
+            if list(tokens[:end]) != token_ids[:end]:
+                continue  # ハッシュの衝突
+            self._entries.move_to_end(entry_id)
+            self.stats["hits"] += 1
+            self.stats["prefill_tokens_saved"] += end
+            return end, [(key[:, :, :end], value[:, :, :end]) for key, value in kv]
+        return 0, None
+
+    def store(self, token_ids, kv):
+        """1シーケンス分のKV ([1, heads, len(token_ids), dim]) をブロック境界で切り詰めて登録する"""
+        usable = len(token_ids) // self.block_size * self.block_size
+        if usable == 0:
+            return
+        hashes = self._block_hashes(token_ids, usable)
+        existing = self._index.get(hashes[-1][1])
+        if existing is not None and list(self._entries[existing][0][:usable]) == token_ids[:usable]:
+            self._entries.move_to_end(existing)
+            return
+
+        kv = [(key[:, :, :usable].clone(), value[:, :, :usable].clone()) for key, value in kv]
+        nbytes = sum(key.numel() * key.element_size() + value.numel() * value.element_size() for key, value in kv)
+        if nbytes > self.max_bytes:
+            return
+        while self._entries and self.total_bytes + nbytes > self.max_bytes:
+            self._evict_oldest()
+
+        entry_id = self._next_entry_id
+        self._next_entry_id += 1
+        self._entries[entry_id] = (tuple(token_ids[:usable]), kv, nbytes, [h for _, h in hashes])
+        for _, prefix_hash in hashes:
+            self._index[prefix_hash] = entry_id
+        self.total_bytes += nbytes
+
+    def _evict_oldest(self):
+        entry_id, (_, _, nbytes, hashes) = self._entries.popitem(last=False)
+        for prefix_hash in hashes:
+            if self._index.get(prefix_hash) == entry_id:
+                del self._index[prefix_hash]
+        self.total_bytes -= nbytes
+        self.stats["evictions"] += 1
+
+    def summary(self):
+        lookups = self.stats["lookups"]
+        prompt_tokens = self.stats["prompt_tokens"]
+        return {
+            **self.stats,
+            "hit_rate": self.stats["hits"] / lookups if lookups else 0.0,
+            "prefill_saved_ratio": self.stats["prefill_tokens_saved"] / prompt_tokens if prompt_tokens else 0.0,
+            "entries": len(self._entries),
+            "bytes": self.total_bytes,
+            "max_bytes": self.max_bytes,
+        }
+
+def _cache_to_kv(past_key_values):
+    """モデルが返したKVキャッシュを層ごとの (key, value) テンソルのリストに変換する"""
+    if hasattr(past_key_values, "layers"):
+        return [(layer.keys, layer.values) for layer in past_key_values.layers]
+    if hasattr(past_key_values, "key_cache"):
+        return list(zip(past_key_values.key_cache, past_key_values.value_cache))
+    return [(key, value) for key, value in past_key_values]
+
+def _kv_to_cache(kv):
+    """層ごとの (key, value) テンソルのリストからモデルに渡せるKVキャッシュを作成する"""
+    try:
+        from transformers import DynamicCache
+    except ImportError:
+        return tuple(kv)
+    cache = DynamicCache()
+    for layer_idx, (key, value) in enumerate(kv):
+        cache.update(key, value, layer_idx)
+    return cache
+
+def _left_pad(tensor, length, dim):
+    """テンソルを指定した次元で左側にゼロ埋めして長さを揃える"""
+    pad_len = length - tensor.shape[dim]
+    if pad_len <= 0:
+        return tensor
+    pad_shape = list(tensor.shape)
+    pad_shape[dim] = pad_len
+    return torch.cat([tensor.new_zeros(pad_shape), tensor], dim=dim)
+
+@functools.lru_cache(maxsize=256)
+def _build_logits_warpers(temperature, top_k, top_p, min_p, typical_p):
+    """generate の _get_logits_processor と同じ順序でサンプリングのwarperを並べる"""
+    warpers = LogitsProcessorList()
+    if temperature != 1.0:
+        warpers.append(TemperatureLogitsWarper(temperature))
+    if top_k:
+        warpers.append(TopKLogitsWarper(top_k=top_k))
+    if top_p < 1.0:
+        warpers.append(TopPLogitsWarper(top_p=top_p))
+    if min_p is not None:
+        warpers.append(MinPLogitsWarper(min_p=min_p))
+    if typical_p < 1.0:
+        warpers.append(TypicalLogitsWarper(mass=typical_p))
+    return warpers
+
+def sampling_logits_warpers(generation_config, request):
+    """
+    モデルの generation_config にリクエストの指定を重ねたサンプリングのwarperを返す
+
+    pipeline (generate) と同じく、リクエストで指定しない top_k などはモデルの設定
+    (それもなければ generate の既定値。top_k は50) を使う。
+    """
+    def setting(name, default):
+        value = getattr(request, name, None)
+        if value is None:
+            value = getattr(generation_config, name, None)
+        return default if value is None else value
+
+    return _build_logits_warpers(
+        setting("temperature", 1.0), setting("top_k", 50), setting("top_p", 1.0),
+        setting("min_p", None), setting("typical_p", 1.0)
+    )
+
+def _sample_next_token(logits, request, generation_config=None):
+    """1シーケンス分のロジットから、リクエストとモデルの generation_config のサンプリング設定に従って次のトークンを選ぶ"""
+    logits = logits.float()
+    if not request.do_sample or (request.temperature is not None and request.temperature <= 0):
+        return int(torch.argmax(logits).item())
+
+    scores = sampling_logits_warpers(generation_config, request)(None, logits.unsqueeze(0))
+    probs = torch.softmax(scores[0], dim=-1)
+    return int(torch.multinomial(probs, num_samples=1).item())
+
+def _collect_eos_token_ids(tokenizer, model):
+    """生成を終了させるトークンIDの集合を取得する"""
+    eos_ids = set()
+    candidates = [getattr(tokenizer, "eos_token_id", None)]
+    generation_config = getattr(model, "generation_config", None)
+    if generation_config is not None:
+        candidates.append(generation_config.eos_token_id)
+    for candidate in candidates:
+        if isinstance(candidate, (list, tuple)):
+            eos_ids.update(candidate)
+        elif candidate is not None:
+            eos_ids.add(candidate)
+    return eos_ids
+
+# --- 停止文字列 ---
+def find_stop_sequence(text, stop):
+    """text の中で最初に現れる停止文字列の位置を返す (なければ-1)"""
+    positions = [index for index in (text.find(s) for s in stop or () if s) if index != -1]
+    return min(positions) if positions else -1
+
+def truncate_at_stop(text, stop):
+    """停止文字列の直前までのテキストと、停止文字列が見つかったかを返す"""
+    index = find_stop_sequence(text, stop)
+    return (text, False) if index == -1 else (text[:index], True)
+
+def stop_sequence_reached(tokenizer, generated_ids, stop):
+    """
+    生成済みトークンの末尾に停止文字列が現れたかを判定する
+
+    トークンごとに呼ばれるため、停止文字列を含みうる末尾のトークンだけをデコードする
+    (バイト単位のトークナイザーでは1文字が最大3トークンに分かれる)。
+    """
+    window = 3 * max(len(s) for s in stop) + 2
+    return find_stop_sequence(tokenizer.decode(generated_ids[-window:], skip_special_tokens=True), stop) != -1
+
+class StopSequenceCriteria(StoppingCriteria):
+    """pipeline (generate) で、各行の生成部分に停止文字列が現れた時点で生成を止める"""
+
+    def __init__(self, tokenizer, stop):
+        self.tokenizer = tokenizer
+        self.stop = stop
+        self._prompt_length = None
+
+    def __call__(self, input_ids, scores, **kwargs):
+        if self._prompt_length is None:
+            # 最初の呼び出しは1トークン目の生成直後
+            self._prompt_length = input_ids.shape[1] - 1
+        done = [
+            stop_sequence_reached(self.tokenizer, row[self._prompt_length:].tolist(), self.stop)
+            for row in input_ids
+        ]
+        return torch.tensor(done, dtype=torch.bool, device=input_ids.device)
+
+class GenerationControlCriteria(StoppingCriteria):
+    """pipeline (generate) で、期限または中止の指示に従って行ごとに生成を止める (controls は行と同じ順序)"""
+
+    def __init__(self, controls):
+        self.controls = controls
+
+    def __call__(self, input_ids, scores, **kwargs):
+        done = [control is not None and control.should_stop() for control in self.controls]
+        return torch.tensor(done, dtype=torch.bool, device=input_ids.device)
+
+class StopSequenceFilter:
+    """
+    ストリーミング中のテキストから停止文字列以降を取り除く
+
+    停止文字列の先頭と一致する可能性がある末尾は、確定するまで送信を保留する。
+    """
+
+    def __init__(self, stop):
+        self.stop = [s for s in stop or () if s]
+        self.stopped = False
+        self._pending = ""
+
+    def feed(self, chunk):
+        if self.stopped:
+            return ""
+        if not self.stop:
+            return chunk
+        text = self._pending + chunk
+        index = find_stop_sequence(text, self.stop)
+        if index != -1:
+            self.stopped = True
+            self._pending = ""
+            return text[:index]
+        hold = 0
+        for s in self.stop:
+            for length in range(min(len(s) - 1, len(text)), hold, -1):
+                if text.endswith(s[:length]):
+                    hold = length
+                    break
+        self._pending = text[len(text) - hold:]
+        return text[:len(text) - hold]
+
+    def finish(self):
+        """ストリームの終了時に保留中のテキストを返す"""
+        text, self._pending = self._pending, ""
+        return "" if self.stopped else text
+
+# --- 投機的デコード ---
+SPECULATIVE_MODES = ("draft", "prompt_lookup")
+
+def _crop_cache(past_key_values, length):
+    """KVキャッシュを先頭から length トークン分に切り詰める"""
+    return _kv_to_cache([(key[:, :, :length], value[:, :, :length]) for key, value in _cache_to_kv(past_key_values)])
+
+def find_prompt_lookup_candidates(token_ids, num_tokens, max_ngram=PROMPT_LOOKUP_MAX_NGRAM):
+    """
+    末尾のn-gramと一致する箇所を文脈から探し、その続きのトークンを候補として返す
+
+    長いn-gramから順に試し、最も新しい一致を採用する。見つからなければ空のリストを返す。
+    """
+    if num_tokens <= 0:
+        return []
+    for n in range(min(max_ngram, len(token_ids) - 1), 0, -1):
+        pattern = token_ids[-n:]
+        last = pattern[-1]
+        for start in range(len(token_ids) - n - 1, -1, -1):
+            if token_ids[start + n - 1] == last and token_ids[start:start + n] == pattern:
+                return token_ids[start + n:start + n + num_tokens]
+    return []
+
+def measure_eager_decode_rate(model, tokenizer, num_tokens=32):
+    """
+    投機的デコードと比べる基準として、1シーケンスの通常の貪欲デコードの速度 (トークン/秒) を測る
+
+    プロンプトの処理は含めず、KVキャッシュを使って1トークンずつ num_tokens 回デコードする時間だけを測る。
+    """
+    input_ids = tokenizer("ユーザー: 自己紹介してください\nアシスタント: ")["input_ids"]
+    with torch.inference_mode():
+        outputs = model(input_ids=torch.tensor([input_ids], device=model.device), use_cache=True)
+        token_id = int(torch.argmax(outputs.logits[0, -1]).item())
+        decode_start = time.time()
+        for _ in range(num_tokens):
+            outputs = model(
+                input_ids=torch.tensor([[token_id]], device=model.device),
+                past_key_values=outputs.past_key_values,
+                use_cache=True,
+            )
+            token_id = int(torch.argmax(outputs.logits[0, -1]).item())
+        decode_time = time.time() - decode_start
+    return num_tokens / decode_time if decode_time else None
+
+class SpeculativeDecoder:
+    """
+    1シーケンス分の投機的デコードの状態
+
+    候補トークン (draftモデルの貪欲生成、または文脈中のn-gram一致の続き) を本体のモデルの
+    1回のforwardでまとめて検証する。各位置で本体のモデルの分布からトークンを選び、
+    候補と一致する間だけ受理するため、出力の分布は通常のデコードと変わらない
+    (貪欲デコードでは同じ出力になる)。
+
+    確定したトークンは emit(token_id) で通知し、emit がTrueを返すと生成を終了する。
+    eager_tokens_per_second には同じモデルの通常のデコード速度 (measure_eager_decode_rate) を渡す。
+    """
+
+    def __init__(self, model, request, input_ids, emit, draft_model=None, eager_tokens_per_second=None):
+        self.model = model
+        self.request = request
+        self.draft_model = draft_model if request.speculative == "draft" else None
+        self.eager_tokens_per_second = eager_tokens_per_second
+        self.num_tokens = request.num_speculative_tokens or config.SPECULATIVE_NUM_TOKENS
+        self.token_ids = list(input_ids)
+        self.emit = emit
+        self.finished = False
+        # KVキャッシュには最後に確定したトークンを除くトークンが入っている
+        self._past_key_values = None
+        self._cached_length = 0
+        self._draft_past_key_values = None
+        self._draft_cached_length = 0
+        self.stats = {
+            "proposed_tokens": 0, "accepted_tokens": 0, "generated_tokens": 0,
+            "verify_steps": 0, "verify_time": 0.0, "decode_time": 0.0,
+        }
+
+    def prefill(self, cached_tokens=0, cached_kv=None):
+        """プロンプトを処理して最初のトークンを確定する (cached_kv はプロンプト先頭 cached_tokens 分のKV)"""
+        input_ids = torch.tensor([self.token_ids[cached_tokens:]], device=self.model.device)
+        if cached_kv is not None:
+            outputs = self.model(input_ids=input_ids, past_key_values=_kv_to_cache(cached_kv), use_cache=True)
+        else:
+            outputs = self.model(input_ids=input_ids, use_cache=True)
+        self._past_key_values = outputs.past_key_values
+        self._cached_length = len(self.token_ids)
+        self._accept(_sample_next_token(outputs.logits[0, -1], self.request, self.model.generation_config))
+
+    def _accept(self, token_id):
+        self.token_ids.append(token_id)
+        self.stats["generated_tokens"] += 1
+        if self.emit(token_id):
+            self.finished = True
+
+    def step(self):
+        """候補を提案して本体のモデルで検証し、1トークン以上を確定する"""
+        step_start = time.time()
+        base_length = len(self.token_ids)
+        # 最後に確定するトークンの分を残して、生成上限を超える候補は提案しない
+        remaining = self.request.max_new_tokens - self.stats["generated_tokens"]
+        num_tokens = max(0, min(self.num_tokens, remaining - 1))
+        if self.draft_model is not None:
+            candidates = self._propose_with_draft(num_tokens)
+        else:
+            candidates = find_prompt_lookup_candidates(self.token_ids, num_tokens, config.PROMPT_LOOKUP_MAX_NGRAM)
+
+        verify_start = time.time()
+        input_ids = torch.tensor([[self.token_ids[-1]] + candidates], device=self.model.device)
+        outputs = self.model(input_ids=input_ids, past_key_values=self._past_key_values, use_cache=True)
+        self.stats["verify_time"] += time.time() - verify_start
+        self.stats["verify_steps"] += 1
+        self.stats["proposed_tokens"] += len(candidates)
+
+        accepted = 0
+        for i, logits in enumerate(outputs.logits[0]):
+            token_id = _sample_next_token(logits, self.request, self.model.generation_config)
+            matched = i < len(candidates) and token_id == candidates[i]
+            accepted += matched
+            self._accept(token_id)
+            if self.finished or not matched:
+                break
+        self.stats["accepted_tokens"] += accepted
+
+        # 受理されなかった候補のKVを捨てる
+        self._cached_length = len(self.token_ids) - 1
+        self._past_key_values = _crop_cache(outputs.past_key_values, self._cached_length)
+        if self._draft_cached_length > base_length + accepted:
+            self._draft_cached_length = base_length + accepted
+            self._draft_past_key_values = _crop_cache(self._draft_past_key_values, self._draft_cached_length)
+        self.stats["decode_time"] += time.time() - step_start
+
+    def _propose_with_draft(self, num_tokens):
+        """draftモデルで num_tokens 個の候補を貪欲に生成する"""
+        candidates = []
+        new_ids = self.token_ids[self._draft_cached_length:]
+        for _ in range(num_tokens):
+            outputs = self.draft_model(
+                input_ids=torch.tensor([new_ids], device=self.draft_model.device),
+                past_key_values=self._draft_past_key_values,
+                use_cache=True,
+            )
+            self._draft_past_key_values = outputs.past_key_values
+            self._draft_cached_length += len(new_ids)
+            token_id = int(torch.argmax(outputs.logits[0, -1]).item())
+            candidates.append(token_id)
+            new_ids = [token_id]
+        return candidates
+
+    def summary(self):
+        """受理率と、通常のデコードの実測速度に対する速度向上を返す (基準の速度が未測定ならspeedupはNone)"""
+        stats = self.stats
+        steps = stats["verify_steps"]
+        # prefillで確定した最初のトークンを除く
+        decoded = stats["generated_tokens"] - 1
+        decode_time = stats["decode_time"]
+        tokens_per_second = decoded / decode_time if decode_time else 0.0
+        return {
+            "mode": self.request.speculative,
+            "num_speculative_tokens": self.num_tokens,
+            "proposed_tokens": stats["proposed_tokens"],
+            "accepted_tokens": stats["accepted_tokens"],
+            "acceptance_rate": stats["accepted_tokens"] / stats["proposed_tokens"] if stats["proposed_tokens"] else 0.0,
+            "verify_steps": steps,
+            "tokens_per_step": decoded / steps if steps else 0.0,
+            "decode_tokens_per_second": tokens_per_second,
+            "eager_tokens_per_second": self.eager_tokens_per_second,
+            "speedup": (tokens_per_second / self.eager_tokens_per_second
+                        if tokens_per_second and self.eager_tokens_per_second else None),
+        }
+
+class _Sequence:
+    """連続バッチング中の1リクエスト分の状態"""
+
+    def __init__(self, request, input_ids, future, queue_depth, on_token=None, control=None):
+        self.request = request
+        self.on_token = on_token
+        self.control = control
+        self.input_ids = input_ids
+        self.generated_ids = []
+        self.future = future
+        self.finished = False
+        self.queue_depth = queue_depth
+        self.enqueued_at = time.time()
+        self.queue_wait_time = None
+        self.cached_prompt_tokens = 0
+        self.decoder = None  # 投機的デコードの場合のSpeculativeDecoder
+        self.timings = {}
+        self.first_token_at = None
+        self.finish_reason = None
+
+    @property
+    def token_budget(self):
+        """このシーケンスがKVキャッシュ上で最大限占有するトークン数"""
+        return len(self.input_ids) + self.request.max_new_tokens
+
+class ContinuousBatchingEngine:
+    """
+    イテレーション単位でリクエストを入れ替える連続バッチングスケジューラ
+
+    専用スレッドがモデルを所有し、デコードの各ステップの境界で
+    空いたスロットに新しいリクエストを追加 (prefill) し、
+    生成が終わったシーケンスをバッチから取り除く。
+    投機的デコードを指定したリクエストはバッチとは別に保持し、
+    各ステップの後に1回ずつ検証を進める。
+    """
+
+    def __init__(self, pipe, max_batch_size=MAX_BATCH_SIZE, max_batched_tokens=MAX_BATCHED_TOKENS,
+                 max_queue_size=MAX_QUEUE_SIZE, prefix_cache=None, draft_model=None, user_weights=None,
+                 fair_scheduling=ENABLE_FAIR_SCHEDULING):
+        self.model = pipe.model
+        self.draft_model = draft_model
+        self.eager_tokens_per_second = None  # 投機的デコードの速度向上の基準 (ウォームアップ時に測定)
+        self.tokenizer = pipe.tokenizer
+        self.device = self.model.device
+        self.max_batch_size = max_batch_size
+        self.max_batched_tokens = max_batched_tokens
+        self.max_queue_size = max_queue_size
+        self.prefix_cache = prefix_cache
+        self.eos_token_ids = _collect_eos_token_ids(self.tokenizer, self.model)
+        # BOSなど、プロンプトの先頭に付く特殊トークン
+        self._special_prefix_ids = self.tokenizer("")["input_ids"]
+        self._encode_segment = functools.lru_cache(maxsize=4096)(self._encode_segment_uncached)
+
+        # 待ち行列はユーザーごとに公平に取り出す (コストはKVキャッシュ上の最大トークン数)
+        self._pending = FairQueue(user_weights, fair_scheduling)
+        self._condition = threading.Condition()
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run_loop, name="continuous-batching", daemon=True)
+
+        # 実行中バッチの状態 (左詰めでパディングされたKVキャッシュとアテンションマスク)
+        self._running = []
+        self._past_key_values = None
+        self._attention_mask = None
+        # 投機的デコード中のシーケンス (それぞれが自分のKVキャッシュを持つ)
+        self._speculative = []
+
+        self.stats = {"steps": 0, "generated_tokens": 0, "completed_requests": 0, "max_running": 0,
+                      "speculative_requests": 0, "stop_sequence_hits": 0, "decode_tokens_saved": 0}
+
+    def start(self):
+        self._thread.start()
+        print(f"連続バッチングエンジンを起動しました (max_batch_size={self.max_batch_size}, max_batched_tokens={self.max_batched_tokens})")
+
+    def shutdown(self):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+        self._thread.join(timeout=5)
+
+    @property
+    def queue_depth(self):
+        return len(self._pending)
+
+    def _encode_segment_uncached(self, segment):
+        return tuple(self.tokenizer(segment, add_special_tokens=False)["input_ids"])
+
+    def encode_segments(self, segments):
+        """
+        会話のメッセージごとに区切られたプロンプトをトークン化する
+
+        メッセージ単位でトークン化して連結するため、ターンが進んでも
+        過去の部分のトークン列が変わらず、KVキャッシュの先頭一致が崩れない。
+        """
+        input_ids = list(self._special_prefix_ids)
+        for segment in segments:
+            input_ids.extend(self._encode_segment(segment))
+        return input_ids
+
+    def submit(self, request, on_token=None, prompt_segments=None, control=None):
+        """
+        リクエストを待ち行列に追加し、InferenceResultを返すFutureを返す
+
+        on_token を指定すると、生成された各トークンIDをエンジンのスレッドから通知する。
+        prompt_segments を指定すると、メッセージ単位でトークン化する (encode_segments を参照)。
+        control (GenerationControl) を指定すると、期限または中止の指示で生成を打ち切る。
+        """
+        future = Future()
+        tokenize_start = time.time()
+        if prompt_segments is not None:
+            input_ids = self.encode_segments(prompt_segments)
+        else:
+            input_ids = self.tokenizer(request.prompt)["input_ids"]
+        tokenize_time = time.time() - tokenize_start
+        with self._condition:
+            if self._stopped:
+                raise RuntimeError("連続バッチングエンジンは停止しています")
+            if len(self._pending) >= self.max_queue_size:
+                raise QueueFullError(f"推論待ち行列が満杯です ({self.max_queue_size}件)")
+            seq = _Sequence(request, input_ids, future, len(self._pending), on_token, control)
+            seq.timings["tokenize"] = tokenize_time
+            self._pending.push(seq, request.user, seq.token_budget)
+            self._condition.notify()
+        return future
+
+    def _run_loop(self):
+        while True:
+            with self._condition:
+                while not self._pending and not self._running and not self._speculative and not self._stopped:
+                    self._condition.wait()
+                if self._stopped:
+                    break
+            try:
+                with torch.inference_mode():
+                    self._admit_pending()
+                    self._retire_finished()
+                    if self._running:
+                        self._decode_step()
+                        self._retire_finished()
+                    if self._speculative:
+                        self._speculative_step()
+            except Exception as e:
+                print(f"連続バッチングのステップ中にエラーが発生しました: {e}")
+                traceback.print_exc()
+                self._fail_running(e)
+
+        self._fail_running(RuntimeError("連続バッチングエンジンが停止しました"))
+        with self._condition:
+            pending = self._pending.drain()
+        for seq in pending:
+            seq.future.set_exception(RuntimeError("連続バッチングエンジンが停止しました"))
+
+    def _admit_pending(self):
+        """空きスロットとトークン予算の範囲で待ち行列のリクエストをバッチに追加する"""
+        admitted = []
+        with self._condition:
+            active = self._running + self._speculative
+            used_tokens = sum(seq.token_budget for seq in active)
+            while self._pending and len(active) + len(admitted) < self.max_batch_size:
+                seq = self._pending.peek()
+                batch_is_empty = not active and not admitted
+                # 単独で予算を超えるリクエストも、バッチが空なら受け付ける
+                if used_tokens + seq.token_budget > self.max_batched_tokens and not batch_is_empty:
+                    break
+                self._pending.pop()
+                if not seq.future.set_running_or_notify_cancel():
+                    continue
+                if seq.control is not None:
+                    # 待っている間に期限を過ぎた、またはクライアントが切断したリクエストは処理しない
+                    try:
+                        seq.control.check_start()
+                    except Exception as e:
+                        seq.future.set_exception(e)
+                        continue
+                seq.queue_wait_time = time.time() - seq.enqueued_at
+                used_tokens += seq.token_budget
+                admitted.append(seq)
+
+        for seq in admitted:
+            try:
+                if seq.request.speculative:
+                    self._start_speculative(seq)
+                else:
+                    self._prefill(seq)
+            except Exception as e:
+                print(f"prefill中にエラーが発生しました: {e}")
+                traceback.print_exc()
+                seq.future.set_exception(e)
+        self.stats["max_running"] = max(self.stats["max_running"], len(self._running) + len(self._speculative))
+
+    def _prefill(self, seq):
+        """新しいシーケンスのプロンプトを処理して最初のトークンを生成し、実行中バッチに結合する"""
+        prefill_start = time.time()
+        cached_kv = None
+        if self.prefix_cache is not None:
+            seq.cached_prompt_tokens, cached_kv = self.prefix_cache.lookup(seq.input_ids)
+        # キャッシュと一致しなかった残りのトークンだけをprefillする
+        input_ids = torch.tensor([seq.input_ids[seq.cached_prompt_tokens:]], device=self.device)
+        if cached_kv is not None:
+            outputs = self.model(input_ids=input_ids, past_key_values=_kv_to_cache(cached_kv), use_cache=True)
+        else:
+            outputs = self.model(input_ids=input_ids, use_cache=True)
+        self._append_token(seq, _sample_next_token(outputs.logits[0, -1], seq.request, self.model.generation_config))
+        seq.first_token_at = time.time()
+        seq.timings["prefill"] = seq.first_token_at - prefill_start
+
+        new_kv = _cache_to_kv(outputs.past_key_values)
+        new_mask = torch.ones((1, len(seq.input_ids)), dtype=torch.long, device=self.device)
+        if not self._running:
+            self._running = [seq]
+            self._past_key_values = _kv_to_cache(new_kv)
+            self._attention_mask = new_mask
+            return
+
+        # 既存バッチと新しいシーケンスを同じ長さに左詰めパディングして結合する
+        running_kv = _cache_to_kv(self._past_key_values)
+        length = max(self._attention_mask.shape[1], new_mask.shape[1])
+        merged_kv = []
+        for (key, value), (new_key, new_value) in zip(running_kv, new_kv):
+            merged_kv.append((
+                torch.cat([_left_pad(key, length, 2), _left_pad(new_key, length, 2)], dim=0),
+                torch.cat([_left_pad(value, length, 2), _left_pad(new_value, length, 2)], dim=0),
+            ))
+        self._past_key_values = _kv_to_cache(merged_kv)
+        self._attention_mask = torch.cat(
+            [_left_pad(self._attention_mask, length, 1), _left_pad(new_mask, length, 1)], dim=0
+        )
+        self._running.append(seq)
+
+    def _start_speculative(self, seq):
+        """投機的デコードのシーケンスのプロンプトを処理し、投機的デコードの一覧に追加する"""
+        def emit(token_id):
+            self._append_token(seq, token_id)
+            return seq.finished
+
+        prefill_start = time.time()
+        cached_kv = None
+        if self.prefix_cache is not None:
+            seq.cached_prompt_tokens, cached_kv = self.prefix_cache.lookup(seq.input_ids)
+        seq.decoder = SpeculativeDecoder(
+            self.model, seq.request, seq.input_ids, emit, self.draft_model, self.eager_tokens_per_second
+        )
+        seq.decoder.prefill(seq.cached_prompt_tokens, cached_kv)
+        seq.first_token_at = time.time()
+        seq.timings["prefill"] = seq.first_token_at - prefill_start
+        self._speculative.append(seq)
+        self.stats["speculative_requests"] += 1
+
+    def _speculative_step(self):
+        """投機的デコード中の各シーケンスの検証を1回ずつ進め、終わったものの結果を返す"""
+        for seq in self._speculative:
+            if seq.finished:
+                continue
+            try:
+                seq.decoder.step()
+            except Exception as e:
+                print(f"投機的デコード中にエラーが発生しました: {e}")
+                traceback.print_exc()
+                seq.finished = True
+                seq.future.set_exception(e)
+
+        still_running = []
+        for seq in self._speculative:
+            if not seq.finished:
+                still_running.append(seq)
+                continue
+            if not seq.future.done():
+                self._complete(seq, seq.decoder.summary())
+        self._speculative = still_running
+
+    def _decode_step(self):
+        """実行中の全シーケンスについて1トークンずつまとめてデコードする"""
+        last_tokens = torch.tensor([[seq.generated_ids[-1]] for seq in self._running], device=self.device)
+        position_ids = self._attention_mask.sum(dim=1, keepdim=True)
+        self._attention_mask = torch.cat(
+            [self._attention_mask, self._attention_mask.new_ones((len(self._running), 1))], dim=1
+        )
+        outputs = self.model(
+            input_ids=last_tokens,
+            attention_mask=self._attention_mask,
+            position_ids=position_ids,
+            past_key_values=self._past_key_values,
+            use_cache=True,
+        )
+        self._past_key_values = outputs.past_key_values
+        self.stats["steps"] += 1
+
+        for row, seq in enumerate(self._running):
+            if not seq.finished:
+                self._append_token(
+                    seq, _sample_next_token(outputs.logits[row, -1], seq.request, self.model.generation_config)
+                )
+
+    def _append_token(self, seq, token_id):
+        seq.generated_ids.append(token_id)
+        self.stats["generated_tokens"] += 1
+        if seq.on_token is not None:
+            try:
+                seq.on_token(token_id)
+            except Exception as e:
+                print(f"トークン通知中にエラーが発生しました: {e}")
+        if token_id in self.eos_token_ids:
+            seq.finish_reason = "eos"
+        elif seq.request.stop and stop_sequence_reached(self.tokenizer, seq.generated_ids, seq.request.stop):
+            seq.finish_reason = "stop"
+        elif len(seq.generated_ids) >= seq.request.max_new_tokens:
+            seq.finish_reason = "length"
+        elif seq.control is not None and seq.control.should_stop():
+            # 期限または中止の指示で打ち切り、次のステップでバッチから取り除く
+            seq.finish_reason = seq.control.reason
+        seq.finished = seq.finish_reason is not None
+
+    def _retire_finished(self):
+        """生成が終わったシーケンスの結果を返し、バッチから取り除く"""
+        if not any(seq.finished for seq in self._running):
+            return
+        running_kv = _cache_to_kv(self._past_key_values)
+        keep_rows = []
+        for row, seq in enumerate(self._running):
+            if not seq.finished:
+                keep_rows.append(row)
+                continue
+            if self.prefix_cache is not None:
+                self._store_prefix(row, seq, running_kv)
+            self._complete(seq)
+
+        if not keep_rows:
+            self._running = []
+            self._past_key_values = None
+            self._attention_mask = None
+            return
+
+        index = torch.tensor(keep_rows, device=self.device)
+        mask = self._attention_mask.index_select(0, index)
+        # 全シーケンスで不要になった左側のパディング列を切り詰める
+        offset = int(mask.any(dim=0).nonzero()[0].item())
+        kv = [
+            (key.index_select(0, index)[:, :, offset:], value.index_select(0, index)[:, :, offset:])
+            for key, value in running_kv
+        ]
+        self._running = [self._running[row] for row in keep_rows]
+        self._past_key_values = _kv_to_cache(kv)
+        self._attention_mask = mask[:, offset:]
+
+    def _complete(self, seq, speculative=None):
+        """完了したシーケンスの結果をFutureに設定する"""
+        text = self.tokenizer.decode(seq.generated_ids, skip_special_tokens=True)
+        seq.timings.update({
+            "decode": time.time() - seq.first_token_at,
+            "prompt_tokens": len(seq.input_ids),
+            "generated_tokens": len(seq.generated_ids),
+        })
+        if seq.finish_reason == "stop":
+            text, _ = truncate_at_stop(text, seq.request.stop)
+            seq.timings["decode_tokens_saved"] = seq.request.max_new_tokens - len(seq.generated_ids)
+            self.stats["stop_sequence_hits"] += 1
+            self.stats["decode_tokens_saved"] += seq.timings["decode_tokens_saved"]
+        # pipeline (return_full_text=False) と同じ形式で、新しく生成された部分だけを返す
+        outputs = [{"generated_text": text}]
+        seq.future.set_result(InferenceResult(
+            outputs, seq.queue_wait_time, seq.queue_depth, seq.cached_prompt_tokens, speculative, seq.timings,
+            seq.finish_reason
+        ))
+        self.stats["completed_requests"] += 1
+
+    def _store_prefix(self, row, seq, running_kv):
+        """完了したシーケンスのプロンプトと生成済みトークンのKVを次のターンのために登録する"""
+        # KVは右詰めで、最後に生成されたトークンはまだモデルに入力されていない
+        length = int(self._attention_mask[row].sum().item())
+        token_ids = (seq.input_ids + seq.generated_ids)[:length]
+        kv = [(key[row:row + 1, :, -length:], value[row:row + 1, :, -length:]) for key, value in running_kv]
+        self.prefix_cache.store(token_ids, kv)
+
+    def _fail_running(self, error):
+        for seq in self._running + self._speculative:
+            if not seq.future.done():
+                seq.future.set_exception(error)
+        self._running = []
+        self._speculative = []
+        self._past_key_values = None
+        self._attention_mask = None
+
+# --- 静的な形状でコンパイルした生成 ---
+class StaticShapeGenerator:
+    """
+    静的なKVキャッシュと固定長のプロンプトのバケットを使い、torch.compile したforwardで1シーケンスずつ生成する
+
+    プロンプトはバケットの長さまで左側をパディングし、KVキャッシュは (最大のバケット + max_new_tokens) の
+    長さで1回だけ確保して使い回す。アテンションマスクもキャッシュ全体の長さで渡すため、forwardの入力の形状は
+    バケットごとのprefillと1トークンのデコードだけになり、起動時にコンパイルした後は再コンパイルしない。
+    最大のバケットより長いプロンプトや、max_new_tokens が上限を超えるリクエストは通常 (eager) の経路で処理する。
+    """
+
+    def __init__(self, model, tokenizer, buckets=COMPILED_PROMPT_BUCKETS, max_new_tokens=COMPILED_MAX_NEW_TOKENS,
+                 mode=COMPILE_MODE):
+        from transformers import StaticCache
+        self.model = model
+        self.buckets = sorted(set(buckets))
+        self.max_new_tokens = max_new_tokens
+        self.max_cache_len = self.buckets[-1] + max_new_tokens
+        self.device = model.device
+        self.pad_token_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else (tokenizer.eos_token_id or 0)
+        self._cache = StaticCache(config=model.config, max_cache_len=self.max_cache_len)
+        self._attention_mask = torch.zeros(1, self.max_cache_len, dtype=torch.long, device=self.device)
+        self._forward = torch.compile(model.forward, mode=mode, dynamic=False)
+        # モードごとのデコードのトークン数と秒数 (eager はこの生成器を使えずに通常の経路で処理したもの)
+        self.stats = {"compiled_requests": 0, "eager_fallbacks": 0, "compile_time": None,
+                      "decode": {"compiled": [0, 0.0], "eager": [0, 0.0]}}
+
+    def bucket_for(self, prompt_length):
+        """プロンプトを収められる最小のバケットの長さ (収まらない場合はNone)"""
+        for bucket in self.buckets:
+            if prompt_length <= bucket:
+                return bucket
+        return None
+
+    def supports(self, request, prompt_length):
+        return (not request.speculative and request.max_new_tokens <= self.max_new_tokens
+                and self.bucket_for(prompt_length) is not None)
+
+    def compile(self):
+        """全てのバケットのprefillと1トークンのデコードを1回ずつ実行し、グラフを作成しておく"""
+        start = time.time()
+        request = SimpleGenerationRequest(prompt="", max_new_tokens=2, do_sample=False)
+        for bucket in self.buckets:
+            generated = []
+            self.generate([self.pad_token_id] * bucket, request, lambda token_id: generated.append(token_id) or len(generated) >= 2)
+        self.stats["compile_time"] = time.time() - start
+        return self.stats["compile_time"]
+
+    def generate(self, input_ids, request, emit):
+        """
+        1シーケンス分を生成する (確定したトークンを emit(token_id) で通知し、Trueが返ると終了する)
+
+        Args:
+            input_ids (list): プロンプトのトークンID (いずれかのバケットに収まる長さ)
+            request (SimpleGenerationRequest): サンプリングの設定
+            emit (callable): トークンIDを受け取り、生成を終える場合にTrueを返す関数
+        """
+        bucket = self.bucket_for(len(input_ids))
+        padding = bucket - len(input_ids)
+        tokens = torch.tensor([[self.pad_token_id] * padding + list(input_ids)], device=self.device)
+        # パディングを除いた位置 (パディング部分はマスクされるため0でよい)
+        position_ids = torch.clamp(torch.arange(bucket, device=self.device) - padding, min=0).unsqueeze(0)
+        with torch.inference_mode():
+            # キャッシュのテンソルは inference_mode の中で作成されるため、初期化も同じ中で行う
+            self._cache.reset()
+            mask = self._attention_mask
+            mask.zero_()
+            mask[0, padding:bucket] = 1
+            logits = self._forward(
+                input_ids=tokens, attention_mask=mask, position_ids=position_ids,
+                cache_position=torch.arange(bucket, device=self.device), past_key_values=self._cache, use_cache=True
+            ).logits
+            token_id = _sample_next_token(logits[0, -1], request, self.model.generation_config)
+            position = bucket
+            while not emit(token_id) and position < self.max_cache_len:
+                mask[0, position] = 1
+                logits = self._forward(
+                    input_ids=torch.tensor([[token_id]], device=self.device), attention_mask=mask,
+                    position_ids=torch.tensor([[position - padding]], device=self.device),
+                    cache_position=torch.tensor([position], device=self.device),
+                    past_key_values=self._cache, use_cache=True
+                ).logits
+                token_id = _sample_next_token(logits[0, -1], request, self.model.generation_config)
+                position += 1
+
+    def record_decode(self, mode, timings):
+        """1リクエスト分のデコードの所要時間をモード (compiled / eager) ごとに集計する"""
+        if timings.get("decode") is None or timings.get("generated_tokens", 0) < 2:
+            return
+        totals = self.stats["decode"][mode]
+        totals[0] += timings["generated_tokens"] - 1
+        totals[1] += timings["decode"]
+
+    def summary(self):
+        per_token = {
+            mode: (seconds / tokens if tokens else None)
+            for mode, (tokens, seconds) in self.stats["decode"].items()
+        }
+        return {
+            "buckets": self.buckets,
+            "max_new_tokens": self.max_new_tokens,
+            "compiled_requests": self.stats["compiled_requests"],
+            "eager_fallbacks": self.stats["eager_fallbacks"],
+            "compile_time": self.stats["compile_time"],
+            "decode_seconds_per_token": per_token,
+            "speedup": per_token["eager"] / per_token["compiled"] if per_token["eager"] and per_token["compiled"] else None,
+        }
+
+def create_static_shape_generator(pipe):
+    """コンパイルした生成器を作成してグラフを作成する (失敗した場合はNoneを返し、通常の経路だけを使う)"""
+    try:
+        generator = StaticShapeGenerator(
+            pipe.model, pipe.tokenizer, config.COMPILED_PROMPT_BUCKETS, config.COMPILED_MAX_NEW_TOKENS, config.COMPILE_MODE
+        )
+        compile_time = generator.compile()
+        print(f"静的な形状でforwardをコンパイルしました ({compile_time:.1f}秒, バケット: {generator.buckets})")
+        return generator
+    except Exception as e:
+        print(f"forwardのコンパイルに失敗しました。通常の経路で続行します: {e}")
+        traceback.print_exc()
+        return None
+
+class SequentialInferenceWorker:
+    """
+    連続バッチングを使わない場合の推論ワーカー
+
+    専用スレッドが上限付きの待ち行列からリクエストを取り出し、
+    pipelineで推論する。イベントループはブロックされない。
+    同じ生成パラメータで待っているリクエストは最大 max_batch_size 件まで
+    まとめて1回のpipeline呼び出しで処理する。
+    """
+
+    def __init__(self, pipe, max_queue_size=MAX_QUEUE_SIZE, draft_model=None, max_batch_size=MAX_BATCH_SIZE,
+                 user_weights=None, fair_scheduling=ENABLE_FAIR_SCHEDULING, compiled=None):
+        self.pipe = pipe
+        self.draft_model = draft_model
+        self.eager_tokens_per_second = None  # 投機的デコードの速度向上の基準 (ウォームアップ時に測定)
+        self.compiled = compiled  # StaticShapeGenerator (コンパイルした生成を使わない場合はNone)
+        self.max_batch_size = max_batch_size
+        self.eos_token_ids = _collect_eos_token_ids(pipe.tokenizer, pipe.model)
+        if max_batch_size > 1:
+            # バッチ推論ではプロンプトを左詰めでパディングする
+            if pipe.tokenizer.pad_token_id is None:
+                pipe.tokenizer.pad_token = pipe.tokenizer.eos_token
+            pipe.tokenizer.padding_side = "left"
+        self.max_queue_size = max_queue_size
+        # 待ち行列はユーザーごとに公平に取り出す (コストはプロンプトと max_new_tokens のトークン数)
+        self._pending = FairQueue(user_weights, fair_scheduling)
+        self._condition = threading.Condition()
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run_loop, name="sequential-inference", daemon=True)
+        self.stats = {"completed_requests": 0, "batches": 0, "max_batch": 0,
+                      "stop_sequence_hits": 0, "decode_tokens_saved": 0}
+
+    @property
+    def queue_depth(self):
+        return len(self._pending)
+
+    def start(self):
+        self._thread.start()
+        print(f"逐次推論ワーカーを起動しました (max_queue_size={self.max_queue_size}, max_batch_size={self.max_batch_size})")
+
+    def shutdown(self):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+        self._thread.join(timeout=5)
+
+    def submit(self, request, on_token=None, prompt_segments=None, control=None):
+        """
+        リクエストを待ち行列に追加し、InferenceResultを返すFutureを返す
+
+        on_token を指定すると、生成された各トークンIDをワーカーのスレッドから通知する。
+        pipelineはプロンプト文字列をそのまま使うため、prompt_segments は使用しない。
+        control (GenerationControl) を指定すると、期限または中止の指示で生成を打ち切る。
+        """
+        future = Future()
+        cost = len(self.pipe.tokenizer(request.prompt)["input_ids"]) + request.max_new_tokens
+        with self._condition:
+            if self._stopped:
+                raise RuntimeError("逐次推論ワーカーは停止しています")
+            if self.queue_depth >= self.max_queue_size:
+                raise QueueFullError(f"推論待ち行列が満杯です ({self.max_queue_size}件)")
+            self._pending.push((request, future, time.time(), self.queue_depth, on_token, control), request.user, cost)
+            self._condition.notify()
+        return future
+
+    @staticmethod
+    def generation_key(request):
+        """同じpipeline呼び出しでまとめて処理できるリクエストの生成パラメータ"""
+        return (request.max_new_tokens, request.do_sample, request.temperature, request.top_p, tuple(request.stop or ()))
+
+    @classmethod
+    def _batch_key(cls, item):
+        """まとめて処理できるリクエストの生成パラメータ (ストリーミングと投機的デコードはまとめない)"""
+        request, _, _, _, on_token, _ = item
+        if on_token is not None or request.speculative:
+            return None
+        return cls.generation_key(request)
+
+    def _collect_batch(self, first):
+        """
+        先頭のリクエストと同じ生成パラメータで待っているリクエストをまとめる
+
+        生成パラメータが異なるリクエストは待ち行列に残し、公平な順序のまま後で取り出す。
+        """
+        key = self._batch_key(first)
+        if key is None or self.max_batch_size <= 1:
+            return [first]
+        with self._condition:
+            return [first] + self._pending.pop_matching(lambda item: self._batch_key(item) == key, self.max_batch_size - 1)
+
+    def _next_item(self):
+        """待ち行列から次のリクエストを取り出す (停止した場合はNone)"""
+        with self._condition:
+            while not self._pending and not self._stopped:
+                self._condition.wait()
+            if self._stopped:
+                return None
+            return self._pending.pop()
+
+    def _run_loop(self):
+        while True:
+            item = self._next_item()
+            if item is None:
+                break
+            batch = [
+                entry for entry in self._collect_batch(item)
+                if entry[1].set_running_or_notify_cancel() and self._check_start(entry)
+            ]
+            if len(batch) > 1:
+                self._run_batch(batch)
+            elif batch:
+                self._run_single(batch[0])
+
+        with self._condition:
+            pending = self._pending.drain()
+        for _, future, _, _, _, _ in pending:
+            if future.set_running_or_notify_cancel():
+                future.set_exception(RuntimeError("逐次推論ワーカーが停止しました"))
+
+    @staticmethod
+    def _check_start(item):
+        """待っている間に期限を過ぎた、またはクライアントが切断したリクエストを処理せずに終える"""
+        control = item[5]
+        if control is not None:
+            try:
+                control.check_start()
+            except Exception as e:
+                item[1].set_exception(e)
+                return False
+        return True
+
+    def generate_batch(self, requests):
+        """
+        同じ生成パラメータのリクエストを待ち行列を通さずに呼び出し元のスレッドでまとめて処理する
+        (オフラインのバッチ推論用。ワーカーのスレッドを起動していない場合に使う)
+
+        Returns:
+            list: リクエストごとの Future (InferenceResult または例外が設定済み)
+        """
+        batch = [(request, Future(), time.time(), 0, None, None) for request in requests]
+        for _, future, _, _, _, _ in batch:
+            future.set_running_or_notify_cancel()
+        if len(batch) > 1:
+            self._run_batch(batch)
+        elif batch:
+            self._run_single(batch[0])
+        return [future for _, future, _, _, _, _ in batch]
+
+    def _run_batch(self, batch):
+        """同じ生成パラメータのリクエストを1回のpipeline呼び出しで処理する"""
+        started_at = time.time()
+        request = batch[0][0]
+        prompt_tokens = [len(self.pipe.tokenizer(item[0].prompt)["input_ids"]) for item in batch]
+        tokenize_time = (time.time() - started_at) / len(batch)
+        generate_start = time.time()
+        try:
+            outputs = self.pipe(
+                [item[0].prompt for item in batch],
+                batch_size=len(batch),
+                max_new_tokens=request.max_new_tokens,
+                do_sample=request.do_sample,
+                temperature=request.temperature,
+                top_p=request.top_p,
+                return_full_text=False,
+                **self._stopping_kwargs(request, [item[5] for item in batch]),
+            )
+        except Exception as e:
+            # 1件の失敗で全体を失敗させないよう、1件ずつ処理し直す
+            print(f"バッチ推論中にエラーが発生しました。1件ずつ処理します: {e}")
+            for item in batch:
+                self._run_single(item)
+            return
+        # pipelineのバッチ呼び出しではprefillとデコードを分けて計測できないため、decodeに両方を含める
+        # (生成トークン数も生成テキストを再トークン化した近似値)
+        generate_time = time.time() - generate_start
+        for (item_request, future, enqueued_at, queue_depth, _, control), item_outputs, item_prompt_tokens in zip(batch, outputs, prompt_tokens):
+            generated_text = item_outputs[0]["generated_text"]
+            timings = {
+                "tokenize": tokenize_time,
+                "decode": generate_time,
+                "prompt_tokens": item_prompt_tokens,
+                "generated_tokens": len(self.pipe.tokenizer(generated_text, add_special_tokens=False)["input_ids"]),
+            }
+            finish_reason = self._finish(item_request, item_outputs, timings, control)
+            future.set_result(InferenceResult(
+                item_outputs, started_at - enqueued_at, queue_depth, timings=timings, finish_reason=finish_reason
+            ))
+        self.stats["completed_requests"] += len(batch)
+        self.stats["batches"] += 1
+        self.stats["max_batch"] = max(self.stats["max_batch"], len(batch))
+
+    def _run_single(self, item):
+        request, future, enqueued_at, queue_depth, on_token, control = item
+        started_at = time.time()
+        queue_wait_time = started_at - enqueued_at
+        timings = {"prompt_tokens": len(self.pipe.tokenizer(request.prompt)["input_ids"]), "generated_tokens": 0}
+        timings["tokenize"] = time.time() - started_at
+        first_token_at = None
+
+        def on_generated(token_id):
+            # 最初のトークンまでをprefill、それ以降をdecodeとして計測する
+            nonlocal first_token_at
+            if first_token_at is None:
+                first_token_at = time.time()
+            timings["generated_tokens"] += 1
+            if on_token is not None:
+                on_token(token_id)
+
+        generate_start = time.time()
+        try:
+            speculative = None
+            if request.speculative:
+                outputs, speculative = self._generate_speculative(request, on_generated, control)
+            elif self.compiled is not None and self.compiled.supports(request, timings["prompt_tokens"]):
+                timings["mode"] = "compiled"
+                outputs = self._generate_compiled(request, on_generated, control)
+            else:
+                if self.compiled is not None:
+                    # バケットに収まらないリクエストは通常の経路で処理する
+                    timings["mode"] = "eager"
+                    self.compiled.stats["eager_fallbacks"] += 1
+                outputs = self.pipe(
+                    request.prompt,
+                    max_new_tokens=request.max_new_tokens,
+                    do_sample=request.do_sample,
+                    temperature=request.temperature,
+                    top_p=request.top_p,
+                    return_full_text=False,
+                    streamer=TokenCallbackStreamer(on_generated),
+                    **self._stopping_kwargs(request, [control]),
+                )
+            if first_token_at is not None:
+                timings["prefill"] = first_token_at - generate_start
+                timings["decode"] = time.time() - first_token_at
+            if timings.get("mode"):
+                self.compiled.record_decode(timings["mode"], timings)
+            finish_reason = self._finish(request, outputs, timings, control)
+            future.set_result(InferenceResult(
+                outputs, queue_wait_time, queue_depth, speculative=speculative, timings=timings, finish_reason=finish_reason
+            ))
+            self.stats["completed_requests"] += 1
+        except Exception as e:
+            future.set_exception(e)
+
+    def _stopping_kwargs(self, request, controls=()):
+        """停止文字列または期限が指定されている場合に pipeline に渡す stopping_criteria (controls は行ごとの GenerationControl)"""
+        criteria = []
+        if request.stop:
+            criteria.append(StopSequenceCriteria(self.pipe.tokenizer, request.stop))
+        if any(control is not None for control in controls):
+            criteria.append(GenerationControlCriteria(list(controls)))
+        if not criteria:
+            return {}
+        return {"stopping_criteria": StoppingCriteriaList(criteria)}
+
+    def _finish(self, request, outputs, timings, control=None):
+        """出力を停止文字列の直前で切り詰め、生成が終わった理由を返す"""
+        text, stopped = truncate_at_stop(outputs[0]["generated_text"], request.stop)
+        if stopped:
+            outputs[0]["generated_text"] = text
+            timings["decode_tokens_saved"] = max(0, request.max_new_tokens - timings["generated_tokens"])
+            self.stats["stop_sequence_hits"] += 1
+            self.stats["decode_tokens_saved"] += timings["decode_tokens_saved"]
+            return "stop"
+        if timings["generated_tokens"] >= request.max_new_tokens:
+            return "length"
+        if control is not None and control.reason is not None:
+            return control.reason
+        return "eos"
+
+    def _make_emit(self, request, on_token, generated_ids, control=None):
+        """確定したトークンを generated_ids に追加して通知し、生成を終えるかを返す関数を作成する"""
+        def emit(token_id):
+            generated_ids.append(token_id)
+            if on_token is not None:
+                on_token(token_id)
+            if request.stop and stop_sequence_reached(self.pipe.tokenizer, generated_ids, request.stop):
+                return True
+            if token_id in self.eos_token_ids or len(generated_ids) >= request.max_new_tokens:
+                return True
+            return control is not None and control.should_stop()
+        return emit
+
+    def _generate_compiled(self, request, on_token, control=None):
+        """コンパイルした生成器で生成し、pipeline互換の出力を返す"""
+        generated_ids = []
+        input_ids = self.pipe.tokenizer(request.prompt)["input_ids"]
+        self.compiled.generate(input_ids, request, self._make_emit(request, on_token, generated_ids, control))
+        self.compiled.stats["compiled_requests"] += 1
+        text = self.pipe.tokenizer.decode(generated_ids, skip_special_tokens=True)
+        return [{"generated_text": text}]
+
+    def _generate_speculative(self, request, on_token, control=None):
+        """投機的デコードで生成し、pipeline互換の出力と受理率などの統計を返す"""
+        generated_ids = []
+        emit = self._make_emit(request, on_token, generated_ids, control)
+        input_ids = self.pipe.tokenizer(request.prompt)["input_ids"]
+        decoder = SpeculativeDecoder(
+            self.pipe.model, request, input_ids, emit, self.draft_model, self.eager_tokens_per_second
+        )
+        with torch.inference_mode():
+            decoder.prefill()
+            while not decoder.finished:
+                decoder.step()
+        text = self.pipe.tokenizer.decode(generated_ids, skip_special_tokens=True)
+        return [{"generated_text": text}], decoder.summary()
+
+def create_inference_worker(pipe, draft_model=None, compiled=None):
+    """読み込んだモデルの推論ワーカー (連続バッチングエンジンまたは逐次ワーカー) を起動する"""
+    if compiled is not None:
+        # コンパイルした生成は1シーケンスずつの静的な形状のため、逐次ワーカーで1件ずつ処理する
+        print("警告: コンパイルした生成が有効なため、連続バッチングとバッチ推論を無効にしてリクエストを1件ずつ処理します。"
+              f" (ENABLE_CONTINUOUS_BATCHING={config.ENABLE_CONTINUOUS_BATCHING}, MAX_BATCH_SIZE={config.MAX_BATCH_SIZE} は使われません)"
+              " 同時に多くのリクエストを処理する場合は ENABLE_COMPILED_GENERATION=0 を推奨します。")
+        worker = SequentialInferenceWorker(
+            pipe, config.MAX_QUEUE_SIZE, draft_model, 1, config.USER_WEIGHTS, config.ENABLE_FAIR_SCHEDULING, compiled
+        )
+        worker.start()
+        return worker
+    if config.ENABLE_CONTINUOUS_BATCHING:
+        try:
+            prefix_cache = None
+            if config.ENABLE_PREFIX_CACHE:
+                prefix_cache = PrefixKVCache(config.PREFIX_CACHE_MAX_BYTES, config.PREFIX_CACHE_BLOCK_SIZE)
+            worker = ContinuousBatchingEngine(
+                pipe, config.MAX_BATCH_SIZE, config.MAX_BATCHED_TOKENS, config.MAX_QUEUE_SIZE, prefix_cache,
+                draft_model, config.USER_WEIGHTS, config.ENABLE_FAIR_SCHEDULING
+            )
+            worker.start()
+            return worker
+        except Exception as e:
+            print(f"連続バッチングエンジンの起動に失敗しました。逐次処理で続行します: {e}")
+            traceback.print_exc()
+    worker = SequentialInferenceWorker(
+        pipe, config.MAX_QUEUE_SIZE, draft_model, config.MAX_BATCH_SIZE, config.USER_WEIGHTS, config.ENABLE_FAIR_SCHEDULING
+    )
+    worker.start()
+    return worker
+
+# --- 会話履歴のフォーマット ---
+# Lambda (lambda/index.py の format_prompt_from_history) と同じ形式
+CHAT_ROLE_PREFIXES = {"system": "システム: ", "user": "ユーザー: ", "assistant": "アシスタント: "}
+
+def format_chat_segments(messages):
+    """
+    会話履歴をメッセージごとのプロンプト断片のリストに変換する
+
+    断片を連結すると format_prompt_from_history と同じプロンプトになり、
+    最後の断片はアシスタントの応答を促す "アシスタント: " になる。
+    """
+    segments = []
+    for message in messages:
+        prefix = CHAT_ROLE_PREFIXES.get(message.role)
+        if prefix is not None:
+            segments.append(f"{prefix}{message.content}\n")
+    segments.append(CHAT_ROLE_PREFIXES["assistant"])
+    return segments
+
+# --- ストリーミング ---
+class TokenCallbackStreamer:
+    """
+    pipeline (generate) の streamer 引数に渡し、生成されたトークンIDを1つずつ通知する
+
+    generate は最初にプロンプトのトークンを put() するため、それは読み飛ばす。
+    """
+
+    def __init__(self, on_token):
+        self.on_token = on_token
+        self._prompt_skipped = False
+
+    def put(self, value):
+        if not self._prompt_skipped:
+            self._prompt_skipped = True
+            return
+        for token_id in value.reshape(-1).tolist():
+            self.on_token(token_id)
+
+    def end(self):
+        pass
+
+class IncrementalDetokenizer:
+    """
+    トークンIDを1つずつ受け取り、新しく確定したテキストだけを返す
+
+    マルチバイト文字の途中 (置換文字 U+FFFD で終わる) では出力を保留する。
+    """
+
+    def __init__(self, tokenizer):
+        self.tokenizer = tokenizer
+        self.token_ids = []
+        self._prefix_offset = 0
+        self._read_offset = 0
+
+    def _decode(self, token_ids):
+        return self.tokenizer.decode(token_ids, skip_special_tokens=True)
+
+    def add(self, token_id):
+        self.token_ids.append(token_id)
+        prefix_text = self._decode(self.token_ids[self._prefix_offset:self._read_offset])
+        new_text = self._decode(self.token_ids[self._prefix_offset:])
+        if len(new_text) > len(prefix_text) and not new_text.endswith("\ufffd"):
+            self._prefix_offset = self._read_offset
+            self._read_offset = len(self.token_ids)
+            return new_text[len(prefix_text):]
+        return ""
+
+    def flush(self):
+        """保留中のテキストを返す"""
+        prefix_text = self._decode(self.token_ids[self._prefix_offset:self._read_offset])
+        new_text = self._decode(self.token_ids[self._prefix_offset:])
+        self._prefix_offset = self._read_offset = len(self.token_ids)
+        return new_text[len(prefix_text):]
+
+def format_sse(event, data):
+    """Server-Sent Events の1イベント分の文字列を作成する"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+# --- FastAPIエンドポイント定義 ---
+@app.on_event("startup")
+async def startup_event():
+    """起動時にモデルの初期化をバックグラウンドで開始"""
+    # 読み込みを待たずに接続を受け付け、状態は /health で確認できる
+    # 既定以外のモデルは最初に要求されたときに読み込む
+    model_registry.start_loading()
+    print("起動時にモデルの初期化を開始しました。")
+
+@app.get("/")
+async def root():
+    """基本的なAPIチェック用のルートエンドポイント"""
+    return {"status": "ok", "message": "Local LLM API is runnning"}
+
+@app.get("/health")
+async def health_check():
+    """ヘルスチェックエンドポイント"""
+    default_entry = model_registry.get()
+    health = {
+        "status": default_entry.status["state"],
+        "model": default_entry.name,
+        "progress": default_entry.status["progress"],
+        "message": default_entry.status["message"],
+        "source": default_entry.status["source"],
+        "load_time": default_entry.status["load_time"],
+        "warmup_time": default_entry.status["warmup_time"],
+        "time_to_ready": default_entry.status["time_to_ready"],
+        "max_queue_size": config.MAX_QUEUE_SIZE,
+        "models": model_registry.summary(),
+        "resident_memory_bytes": model_registry.resident_bytes(),
+        "memory_budget_bytes": model_registry.memory_budget or None,
+    }
+    if response_cache is not None:
+        health["response_cache"] = response_cache.summary()
+    if semantic_cache is not None:
+        health["semantic_cache"] = semantic_cache.summary()
+    if single_flight is not None:
+        health["coalescing"] = single_flight.summary()
+    return health
+
+@app.get("/metrics")
+async def metrics():
+    """Prometheus形式のメトリクスを返す"""
+    # 待ち行列の長さと処理中のリクエスト数は取得時点の値を設定する
+    for entry in model_registry.entries():
+        QUEUE_DEPTH.labels(entry.name).set(entry.worker.queue_depth if entry.worker is not None else 0)
+        IN_FLIGHT_REQUESTS.labels(entry.name).set(entry.in_flight)
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+@app.get("/usage")
+async def usage():
+    """ユーザーごとの利用量 (累計と直近1分のトークン数) を返す"""
+    return user_usage.summary()
+
+@app.get("/usage/{user_id}")
+async def usage_for_user(user_id: str):
+    """指定したユーザーの利用量を返す"""
+    return user_usage.usage(user_id)
+
+def resolve_model(model_name):
+    """リクエストで指定されたモデル名に対応するエントリを返す。未登録なら400を返す"""
+    try:
+        return model_registry.get(model_name)
+    except UnknownModelError as e:
+        ERRORS_TOTAL.labels("unknown_model").inc()
+        raise HTTPException(status_code=400, detail=str(e))
+
+async def ensure_model_loaded(entry):
+    """
+    モデルの準備ができていれば推論ワーカーを返し、できていない場合は読み込みを開始して待たずに503を返す
+
+    返したワーカーは処理中として数えられ、その間モデルは退避されない。
+    使い終わったら必ず model_registry.release(entry) を呼ぶこと。
+    """
+    worker = model_registry.acquire(entry)
+    if worker is not None:
+        return worker
+    if model_registry.start_loading(entry.name):
+        print(f"generateエンドポイント: モデル '{entry.name}' が読み込まれていません。バックグラウンドで読み込みを開始しました。")
+    ERRORS_TOTAL.labels("model_not_ready").inc()
+    raise HTTPException(
+        status_code=503,
+        detail=f"モデル '{entry.name}' が利用できません ({entry.status['state']})。後でもう一度お試しください。",
+        headers={"Retry-After": str(config.QUEUE_RETRY_AFTER)}
+    )
+
+def invalid_request_exception(detail):
+    """リクエストの内容が不正な場合に返す400エラーを作成する"""
+    ERRORS_TOTAL.labels("invalid_request").inc()
+    return HTTPException(status_code=400, detail=detail)
+
+def validate_speculative(request, entry):
+    """投機的デコードの指定を検証する (不正な場合は400)"""
+    if request.speculative is None:
+        return
+    if request.speculative not in SPECULATIVE_MODES:
+        raise invalid_request_exception(f"speculative には {', '.join(SPECULATIVE_MODES)} のいずれかを指定してください。")
+    if request.speculative == "draft" and entry.draft_model is None:
+        raise invalid_request_exception(f"モデル '{entry.name}' にはdraftモデルが読み込まれていません。")
+    if request.num_speculative_tokens is not None and request.num_speculative_tokens < 1:
+        raise invalid_request_exception("num_speculative_tokens は1以上を指定してください。")
+
+# 利用量の上限による429に付けるヘッダー (混雑による429と区別し、再試行しないようにする)
+QUOTA_EXCEEDED_HEADER = "X-Quota-Exceeded"
+
+def quota_exceeded_exception(error):
+    """利用量の上限を超えたユーザーに返す429エラーを作成する"""
+    ERRORS_TOTAL.labels("quota_exceeded").inc()
+    QUOTA_REJECTIONS_TOTAL.inc()
+    logger.warning("%s", error)
+    return HTTPException(
+        status_code=429,
+        detail="利用量の上限に達しました。しばらくしてから再試行してください。",
+        # 混雑による429と区別できるようにする (Lambdaは利用量の上限による429を別のサーバーで再試行しない)
+        headers={"Retry-After": str(error.retry_after), QUOTA_EXCEEDED_HEADER: "true"}
+    )
+
+async def reserve_user_tokens(entry, request):
+    """
+    推論ワーカーに入れる前にユーザーの利用枠を予約する (上限を超えている場合は429)
+
+    長いプロンプトのトークン化でイベントループを止めないよう、別スレッドでトークン数を数える。
+
+    Returns:
+        tuple: (予約, プロンプトのトークン数)
+    """
+    input_ids = (await asyncio.get_running_loop().run_in_executor(None, entry.pipe.tokenizer, request.prompt))["input_ids"]
+    prompt_tokens = len(input_ids)
+    try:
+        return user_usage.reserve(request.user, prompt_tokens + request.max_new_tokens), prompt_tokens
+    except QuotaExceededError as e:
+        raise quota_exceeded_exception(e)
+
+def settle_interrupted(reservation, prompt_tokens, control):
+    """
+    完了しなかった生成の予約を精算する
+
+    生成を始めていた場合は、プロンプトと打ち切るまでに生成したトークン数を数える
+    (切断して結果を受け取らなかったリクエストも、推論ワーカーの処理は利用量に含める)。
+    生成を始める前に失敗した場合は0とする。
+    """
+    if control.started:
+        user_usage.settle(reservation, prompt_tokens, control.generated_tokens)
+    else:
+        user_usage.settle(reservation)
+
+def deadline_exceeded_exception(error):
+    """期限までに生成を開始できなかった場合に返す504エラーを作成する"""
+    ERRORS_TOTAL.labels("deadline_exceeded").inc()
+    logger.warning("generateエンドポイント: %s", error)
+    return HTTPException(status_code=504, detail=str(error))
+
+def create_generation_control(request, start_time):
+    """リクエストの timeout から期限を計算し、生成の制御を作成する (timeout が不正な場合は400)"""
+    if request.timeout is not None and request.timeout <= 0:
+        raise invalid_request_exception("timeout は0より大きい秒数を指定してください。")
+    return GenerationControl(start_time + request.timeout if request.timeout is not None else None)
+
+async def await_unless_disconnected(awaitable, http_request, on_disconnect):
+    """
+    awaitable の完了を待つ。その間にクライアントが切断した場合は待つのをやめて on_disconnect を呼び、499を返す
+
+    Args:
+        awaitable: 待つ処理
+        http_request (Request): 切断を確認するリクエスト (Noneの場合は確認しない)
+        on_disconnect (callable): 切断した場合に呼ぶ関数 (生成の中止など)
+    """
+    task = asyncio.ensure_future(awaitable)
+    if http_request is None:
+        return await task
+    while True:
+        done, _ = await asyncio.wait({task}, timeout=config.DISCONNECT_POLL_INTERVAL)
+        if done:
+            return task.result()
+        if await http_request.is_disconnected():
+            break
+    task.cancel()
+    try:
+        await task
+    except BaseException:
+        pass
+    if on_disconnect is not None:
+        on_disconnect()
+    ERRORS_TOTAL.labels("client_disconnected").inc()
+    logger.info("クライアントが切断したため生成を中止しました")
+    # 499 はクライアントが応答を待たずに切断したことを表す (nginxの慣例)
+    raise HTTPException(status_code=499, detail="クライアントが切断しました")
+
+def queue_full_exception(error):
+    """推論待ち行列が満杯の場合に返す429エラーを作成する"""
+    ERRORS_TOTAL.labels("queue_full").inc()
+    logger.warning("generateエンドポイント: %s", error)
+    return HTTPException(
+        status_code=429,
+        detail="サーバーが混雑しています。しばらくしてから再試行してください。",
+        headers={"Retry-After": str(config.QUEUE_RETRY_AFTER)}
+    )
+
+# 簡略化されたエンドポイント
+@app.post("/generate", response_model=GenerationResponse)
+async def generate_simple(request: SimpleGenerationRequest, http_request: Request):
+    """単純なプロンプト入力に基づいてテキストを生成"""
+    return await run_generation(request, endpoint="generate", http_request=http_request)
+
+@app.post("/chat", response_model=GenerationResponse)
+async def chat(request: ChatRequest, http_request: Request):
+    """構造化された会話履歴に基づいてテキストを生成"""
+    if not request.messages:
+        raise invalid_request_exception("messagesが空です。")
+    segments = format_chat_segments(request.messages)
+    generation_request = SimpleGenerationRequest(
+        prompt="".join(segments),
+        max_new_tokens=request.max_new_tokens,
+        do_sample=request.do_sample,
+        temperature=request.temperature,
+        top_p=request.top_p,
+        model=request.model,
+        speculative=request.speculative,
+        num_speculative_tokens=request.num_speculative_tokens,
+        stop=request.stop,
+        coalesce=request.coalesce,
+        user=request.user,
+        timeout=request.timeout,
+    )
+    return await run_generation(generation_request, prompt_segments=segments, endpoint="chat", http_request=http_request)
+
+@app.post("/generate/batch", response_model=BatchGenerationResponse)
+async def generate_batch(requests: List[SimpleGenerationRequest]):
+    """
+    複数のプロンプトをまとめて生成し、入力と同じ順序で結果を返す
+
+    リクエストをモデルとプロンプトの長さの順に並べて推論ワーカーに投入するため、
+    同時に処理されるプロンプトの長さが揃い、パディングが少なくなる。
+    1件の失敗は他の件に影響せず、その件の error と status_code に記録する。
+    """
+    if not requests:
+        raise invalid_request_exception("リクエストが空です。")
+    if len(requests) > config.MAX_BATCH_REQUESTS:
+        raise invalid_request_exception(f"1回に処理できるのは{config.MAX_BATCH_REQUESTS}件までです ({len(requests)}件)。")
+    start_time = time.time()
+    logger.info("バッチリクエストを受信: %d件", len(requests))
+    # 同時に投入する件数をバッチサイズまでに抑え、並べた順に推論ワーカーに入るようにする
+    semaphore = asyncio.Semaphore(config.MAX_BATCH_SIZE)
+    order = sorted(range(len(requests)), key=lambda i: (requests[i].model or "", len(requests[i].prompt)))
+    results = [None] * len(requests)
+
+    async def run_item(index):
+        async with semaphore:
+            item_start = time.time()
+            while True:
+                try:
+                    response = await run_generation(requests[index], endpoint="batch_item")
+                    results[index] = BatchItemResult(
+                        index=index,
+                        generated_text=response.generated_text,
+                        response_time=time.time() - item_start,
+                        model=response.model,
+                        cached=response.cached,
+                        coalesced=response.coalesced
+                    )
+                    return
+                except HTTPException as e:
+                    headers = e.headers or {}
+                    # 待ち行列の満杯とモデルの読み込み中は、時間内であれば再試行する
+                    # (利用量の上限による429は待っても解消しないため、すぐにその件を失敗にする)
+                    if (e.status_code in (429, 503) and QUOTA_EXCEEDED_HEADER not in headers
+                            and time.time() - start_time < config.BATCH_RETRY_TIMEOUT):
+                        await asyncio.sleep(1.0)
+                        continue
+                    retry_after = headers.get("Retry-After")
+                    results[index] = BatchItemResult(
+                        index=index, response_time=time.time() - item_start, error=str(e.detail), status_code=e.status_code,
+                        retry_after=int(retry_after) if retry_after and retry_after.isdigit() else None
+                    )
+                    return
+                except Exception as e:
+                    logger.exception("バッチの%d件目でエラーが発生しました: %s", index, e)
+                    ERRORS_TOTAL.labels(type(e).__name__).inc()
+                    results[index] = BatchItemResult(
+                        index=index, response_time=time.time() - item_start, error=str(e), status_code=500
+                    )
+                    return
+
+    await asyncio.gather(*(run_item(index) for index in order))
+    failed = sum(1 for result in results if result.error is not None)
+    response_time = time.time() - start_time
+    REQUEST_SECONDS.labels("batch").observe(response_time)
+    logger.info("バッチ応答生成時間: %.2f秒 (%d件成功, %d件失敗)", response_time, len(results) - failed, failed)
+    return BatchGenerationResponse(
+        results=results,
+        response_time=response_time,
+        succeeded=len(results) - failed,
+        failed=failed
+    )
+
+async def run_generation(request, prompt_segments=None, endpoint="generate", http_request=None):
+    """
+    推論ワーカーで生成を実行し、GenerationResponseを返す (endpoint はメトリクスのラベル)
+
+    request.timeout を指定すると期限の前に生成を打ち切り、途中までの応答を truncated=True で返す。
+    http_request を指定すると、生成中にクライアントが切断した場合に生成を中止する。
+    """
+    start_time = time.time()
+    control = create_generation_control(request, start_time)
+    entry = resolve_model(request.model)
+    cache_key = response_cache.make_key(request, entry.name) if response_cache is not None else None
+    if cache_key is not None:
+        cached_text = response_cache.get(cache_key)
+        if cached_text is not None:
+            logger.debug("応答キャッシュにヒットしました。")
+            response_time = time.time() - start_time
+            REQUEST_SECONDS.labels(endpoint).observe(response_time)
+            return GenerationResponse(
+                generated_text=cached_text,
+                response_time=response_time,
+                model=entry.name,
+                cached=True
+            )
+
+    load_start = time.time()
+    worker = await ensure_model_loaded(entry)
+    trace_span("model_load", time.time() - load_start)
+    try:
+        validate_speculative(request, entry)
+
+        semantic_lookup = None
+        if semantic_cache is not None:
+            # 埋め込みの計算でイベントループを止めないよう、別スレッドで検索する
+            semantic_lookup = await asyncio.get_running_loop().run_in_executor(
+                None, semantic_cache.lookup, request, entry.name
+            )
+            if semantic_lookup is not None:
+                trace_span("semantic_cache", semantic_lookup.lookup_time)
+                if semantic_lookup.answer is not None:
+                    logger.debug("意味的キャッシュにヒットしました (類似度 %.3f)", semantic_lookup.similarity)
+                    response_time = time.time() - start_time
+                    REQUEST_SECONDS.labels(endpoint).observe(response_time)
+                    return GenerationResponse(
+                        generated_text=semantic_lookup.answer,
+                        response_time=response_time,
+                        model=entry.name,
+                        cached=True,
+                        semantic_similarity=semantic_lookup.similarity
+                    )
+
+        reservation, prompt_tokens = await reserve_user_tokens(entry, request)
+
+        try:
+            if single_flight is not None and single_flight.should_coalesce(request):
+                # 同じ内容のリクエストが実行中なら、その生成が終わるのを待って結果を共有する
+                # (生成を中止するのは、相乗りしたクライアントも含めて全員が切断した場合だけ)
+                (assistant_response, result), coalesced = await await_unless_disconnected(
+                    single_flight.run(
+                        request_fingerprint(request, entry.name),
+                        lambda: generate_assistant_response(entry, worker, request, prompt_segments, cache_key, control),
+                        control=control
+                    ),
+                    http_request, None
+                )
+                if coalesced:
+                    COALESCED_REQUESTS_TOTAL.labels(entry.name).inc()
+            else:
+                assistant_response, result = await await_unless_disconnected(
+                    generate_assistant_response(entry, worker, request, prompt_segments, cache_key, control),
+                    http_request, control.cancel
+                )
+                coalesced = False
+        except BaseException:
+            settle_interrupted(reservation, prompt_tokens, control)
+            raise
+        trace = current_trace.get()
+        if trace is not None:
+            # 相乗りしたリクエストには、共有した生成の内訳を記録する
+            trace.add_inference(result)
+        # 相乗りしたリクエストにも、共有した生成のトークン数を利用量として数える
+        # (数えないと、同じ内容を並べて送るだけで上限を回避できてしまう)
+        user_usage.settle(reservation, result.timings.get("prompt_tokens", 0), result.timings.get("generated_tokens", 0),
+                          coalesced=coalesced)
+        if (not coalesced and semantic_lookup is not None and assistant_response not in EXTRACTION_FAILURE_RESPONSES
+                and result.finish_reason not in INTERRUPTED_FINISH_REASONS):
+            semantic_cache.put(semantic_lookup, assistant_response)
+
+        response_time = time.time() - start_time
+        REQUEST_SECONDS.labels(endpoint).observe(response_time)
+        truncated = result.finish_reason in INTERRUPTED_FINISH_REASONS
+        logger.info("応答生成時間: %.2f秒 (待ち時間: %.2f秒%s%s)", response_time, result.queue_wait_time,
+                    ", 相乗り" if coalesced else "", ", 期限で打ち切り" if truncated else "")
+
+        return GenerationResponse(
+            generated_text=assistant_response,
+            response_time=response_time,
+            model=entry.name,
+            queue_wait_time=result.queue_wait_time,
+            queue_depth=result.queue_depth,
+            cached_prompt_tokens=result.cached_prompt_tokens,
+            coalesced=coalesced,
+            speculative=result.speculative,
+            finish_reason=result.finish_reason,
+            truncated=truncated,
+            generated_tokens=result.timings.get("generated_tokens")
+        )
+    finally:
+        model_registry.release(entry)
+
+async def generate_assistant_response(entry, worker, request, prompt_segments, cache_key, control=None):
+    """
+    推論ワーカーで1回生成し、(アシスタント応答, InferenceResult) を返す
+
+    worker には ensure_model_loaded で固定したワーカーを渡す (呼び出し元が release するまでモデルは退避されない)。
+    """
+    try:
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("シンプルなリクエストを受信: prompt=%s..., max_new_tokens=%s", request.prompt[:100], request.max_new_tokens)  # 長いプロンプトは切り捨て
+
+        # 推論ワーカーに投入し、イベントループをブロックせずに結果を待つ
+        result = await asyncio.wrap_future(worker.submit(request, prompt_segments=prompt_segments, control=control))
+        record_inference_metrics(entry.name, result)
+
+        # アシスタント応答を抽出 (出力は新しく生成された部分だけのため、プロンプトを探さない)
+        extract_start = time.time()
+        assistant_response = extract_assistant_response(result.outputs)
+        EXTRACT_SECONDS.observe(time.time() - extract_start)
+        trace_span("extract", time.time() - extract_start)
+        if assistant_response in EXTRACTION_FAILURE_RESPONSES:
+            ERRORS_TOTAL.labels("extraction_failed").inc()
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("抽出されたアシスタント応答: %s...", assistant_response[:100])  # 長い場合は切り捨て
+
+        # 期限または切断で打ち切った途中までの応答はキャッシュしない
+        if (cache_key is not None and assistant_response not in EXTRACTION_FAILURE_RESPONSES
+                and result.finish_reason not in INTERRUPTED_FINISH_REASONS):
+            response_cache.put(cache_key, assistant_response)
+        return assistant_response, result
+
+    except QueueFullError as e:
+        raise queue_full_exception(e)
+    except DeadlineExceededError as e:
+        raise deadline_exceeded_exception(e)
+    except Exception as e:
+        ERRORS_TOTAL.labels(type(e).__name__).inc()
+        logger.exception("シンプル応答生成中にエラーが発生しました: %s", e)
+        raise HTTPException(status_code=500, detail=f"応答の生成中にエラーが発生しました: {str(e)}")
+
+@app.post("/generate/stream")
+async def generate_stream(request: SimpleGenerationRequest):
+    """
+    生成されたトークンを Server-Sent Events で逐次返す
+
+    イベントの種類:
+        token: {"text": 新しく確定したテキスト}
+        done:  {"generated_text", "response_time", "time_to_first_token", "token_count", "queue_wait_time", "model", "speculative",
+                "finish_reason", "truncated", "timings"}
+        error: {"detail": エラーメッセージ}
+
+    done の timings には段階ごとの所要時間 (秒) を含める (ヘッダーを先に返すため Server-Timing には含まれない)。
+    timeout を指定すると期限の前に生成を打ち切り、truncated=True の done で終える。
+    クライアントが切断した場合は、実行中の生成を中止する。
+    """
+    trace = current_trace.get()
+    control = create_generation_control(request, time.time())
+    entry = resolve_model(request.model)
+    load_start = time.time()
+    worker = await ensure_model_loaded(entry)
+    trace_span("model_load", time.time() - load_start)
+    try:
+        validate_speculative(request, entry)
+        reservation, prompt_tokens = await reserve_user_tokens(entry, request)
+    except BaseException:
+        model_registry.release(entry)
+        raise
+    tokenizer = entry.pipe.tokenizer
+
+    start_time = time.time()
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("ストリーミングリクエストを受信: prompt=%s..., max_new_tokens=%s", request.prompt[:100], request.max_new_tokens)
+    loop = asyncio.get_running_loop()
+    token_queue = asyncio.Queue()
+
+    def on_token(token_id):
+        # 推論ワーカーのスレッドから呼ばれるため、イベントループ経由でキューに渡す
+        loop.call_soon_threadsafe(token_queue.put_nowait, token_id)
+
+    try:
+        result_future = asyncio.wrap_future(worker.submit(request, on_token=on_token, control=control))
+    except BaseException as e:
+        model_registry.release(entry)
+        user_usage.settle(reservation)
+        if isinstance(e, QueueFullError):
+            raise queue_full_exception(e)
+        raise
+
+    def on_done(_):
+        model_registry.release(entry)
+        # 全トークンの通知の後に完了を通知する (call_soon_threadsafe の順序が保たれる)
+        token_queue.put_nowait(None)
+
+    result_future.add_done_callback(on_done)
+
+    async def event_stream():
+        detokenizer = IncrementalDetokenizer(tokenizer)
+        stop_filter = StopSequenceFilter(request.stop)
+        extractor = IncrementalAssistantExtractor()
+        time_to_first_token = None
+        token_count = 0
+
+        try:
+            while True:
+                token_id = await token_queue.get()
+                if token_id is None:
+                    break
+                token_count += 1
+                if time_to_first_token is None:
+                    time_to_first_token = time.time() - start_time
+                text = extractor.feed(stop_filter.feed(detokenizer.add(token_id)))
+                if text:
+                    yield format_sse("token", {"text": text})
+        except (asyncio.CancelledError, GeneratorExit):
+            # クライアントが切断した場合は、生成を中止して推論ワーカーの枠を空ける
+            control.cancel()
+            result_future.cancel()
+            # 生成を始めていた場合は、切断までに受け取ったトークンも利用量に数える
+            user_usage.settle(reservation, prompt_tokens if control.started else 0, token_count)
+            ERRORS_TOTAL.labels("client_disconnected").inc()
+            logger.info("クライアントが切断したためストリーミングの生成を中止しました (%dトークン)", token_count)
+            raise
+
+        try:
+            result = await result_future
+        except Exception as e:
+            settle_interrupted(reservation, prompt_tokens, control)
+            ERRORS_TOTAL.labels(type(e).__name__).inc()
+            logger.error("ストリーミング応答生成中にエラーが発生しました: %s", e)
+            yield format_sse("error", {"detail": f"応答の生成中にエラーが発生しました: {str(e)}"})
+            return
+
+        text = extractor.feed(stop_filter.feed(detokenizer.flush()) + stop_filter.finish())
+        if text:
+            yield format_sse("token", {"text": text})
+
+        record_inference_metrics(entry.name, result)
+        user_usage.settle(reservation, result.timings.get("prompt_tokens", 0), result.timings.get("generated_tokens", 0))
+        if trace is not None:
+            trace.add_inference(result)
+        response_time = time.time() - start_time
+        REQUEST_SECONDS.labels("stream").observe(response_time)
+        logger.info("ストリーミング応答生成時間: %.2f秒 (最初のトークンまで: %.2f秒, %dトークン)",
+                    response_time, time_to_first_token or 0, token_count)
+        yield format_sse("done", {
+            "generated_text": extractor.finish(),
+            "response_time": response_time,
+            "time_to_first_token": time_to_first_token,
+            "token_count": token_count,
+            "queue_wait_time": result.queue_wait_time,
+            "model": entry.name,
+            "speculative": result.speculative,
+            "finish_reason": result.finish_reason,
+            "truncated": result.finish_reason in INTERRUPTED_FINISH_REASONS,
+            "timings": trace.summary() if trace is not None else None,
+        })
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+def warmup_model(pipe, entry):
+    """代表的な長さのプロンプトで推論を一通り実行し、初回リクエストの遅延を取り除く"""
+    lengths = config.WARMUP_PROMPT_TOKENS
+    unit = "ユーザー: こんにちは\nアシスタント: こんにちは、ご用件をどうぞ。\n"
+    unit_tokens = max(1, len(pipe.tokenizer(unit, add_special_tokens=False)["input_ids"]))
+    for i, length in enumerate(lengths):
+        prompt = unit * max(1, length // unit_tokens) + "ユーザー: 自己紹介してください\nアシスタント: "
+        with torch.inference_mode():
+            pipe(prompt, max_new_tokens=config.WARMUP_NEW_TOKENS, do_sample=False)
+        entry.set_status("warming", 0.8 + 0.2 * (i + 1) / len(lengths), f"ウォームアップ中 ({length}トークン)")
+
+def load_model_task(model_name=None):
+    """モデルを読み込むバックグラウンドタスク"""
+    entry = model_registry.get(model_name)
+    print(f"load_model_task: モデル '{entry.name}' の読み込みを開始...")
+    entry.set_status("loading", 0.05, "モデルを読み込んでいます")
+    load_start = time.time()
+    # 前回測定したサイズが分かっていれば、読み込み前に他のモデルを退避しておく
+    model_registry.make_room(entry, entry.memory_bytes)
+    # load_model関数を呼び出し、結果をレジストリのエントリに設定
+    loaded_pipe = load_model(entry.name)
+    if not loaded_pipe:
+        print("load_model_task: モデルの読み込みに失敗しました。")
+        entry.set_status("failed", 0.0, "モデルの読み込みに失敗しました")
+        return
+
+    entry.pipe = loaded_pipe
+    entry.memory_bytes = measure_model_memory(loaded_pipe)
+    if config.DRAFT_MODEL_NAME and entry.name == config.MODEL_NAME:
+        entry.set_status("loading", 0.7, "draftモデルを読み込んでいます")
+        entry.draft_model = load_draft_model(loaded_pipe, config.DRAFT_MODEL_NAME)
+        if entry.draft_model is not None:
+            entry.memory_bytes += int(entry.draft_model.get_memory_footprint())
+    entry.status["load_time"] = time.time() - load_start
+    model_registry.make_room(entry, entry.memory_bytes)
+    print(f"load_model_task: モデルの読み込みが完了しました。({entry.memory_bytes / 1024 ** 3:.2f}GB)")
+
+    entry.set_status("warming", 0.8, "ウォームアップ中")
+    warmup_start = time.time()
+    eager_tokens_per_second = None
+    try:
+        warmup_model(loaded_pipe, entry)
+        eager_tokens_per_second = measure_eager_decode_rate(loaded_pipe.model, loaded_pipe.tokenizer)
+    except Exception as e:
+        # ウォームアップの失敗は致命的ではないため、そのまま続行する
+        print(f"ウォームアップ中にエラーが発生しました: {e}")
+        traceback.print_exc()
+    entry.status["warmup_time"] = time.time() - warmup_start
+    entry.status["eager_tokens_per_second"] = eager_tokens_per_second
+
+    compiled = None
+    if config.ENABLE_COMPILED_GENERATION:
+        entry.set_status("warming", 1.0, "forwardをコンパイルしています")
+        compiled = create_static_shape_generator(loaded_pipe)
+
+    entry.worker = create_inference_worker(loaded_pipe, entry.draft_model, compiled)
+    entry.worker.eager_tokens_per_second = eager_tokens_per_second
+    entry.last_used = time.time()
+    entry.status["time_to_ready"] = time.time() - PROCESS_START_TIME
+    for phase in ("load_time", "warmup_time", "time_to_ready"):
+        MODEL_LOAD_SECONDS.labels(entry.name, phase.replace("_time", "")).set(entry.status[phase])
+    entry.set_status("ready", 1.0, "モデルの準備が完了しました")
+    print(f"load_model_task: 起動から準備完了まで {entry.status['time_to_ready']:.1f}秒 "
+          f"(読み込み {entry.status['load_time']:.1f}秒, ウォームアップ {entry.status['warmup_time']:.1f}秒)")
+
+    cpu_config = entry.status["cpu_config"] or {}
+    if entry.status["source"] == "pipeline" and cpu_config.get("mode") != "int8":
+        # 準備完了後にスナップショットを保存し、次回の起動を速くする (量子化済みのモデルは保存できない)
+        save_model_snapshot(loaded_pipe, entry.name)
+
+print("FastAPIエンドポイントを定義しました。")
+
+# --- マルチプロセスのレプリカプール ---
+# ルーターからワーカーへ転送しないヘッダー
+HOP_BY_HOP_HEADERS = {"connection", "keep-alive", "transfer-encoding", "upgrade", "host", "content-length"}
+
+def split_cores(count):
+    """割り当てられたコアをワーカー数で分割し、ワーカーごとのコアのリストを返す"""
+    cores = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else list(range(os.cpu_count() or 1))
+    if count > len(cores):
+        # コアよりワーカーが多い場合は固定しない
+        return [[] for _ in range(count)]
+    chunk = len(cores) // count
+    return [cores[i * chunk:(i + 1) * chunk] for i in range(count)]
+
+class ReplicaProcess:
+    """ルーター配下の1つのモデルワーカープロセス"""
+
+    def __init__(self, index, port, cores):
+        self.index = index
+        self.port = port
+        self.cores = cores
+        self.process = None
+        self.in_flight = 0
+        self.healthy = False
+        self.restarts = 0
+        self.completed_requests = 0
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.port}"
+
+    @property
+    def alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    def start(self):
+        env = dict(os.environ, REPLICA_WORKER_PORT=str(self.port), REPLICA_COUNT="1")
+        if self.cores:
+            env["CPU_CORES"] = ",".join(str(core) for core in self.cores)
+            env["CPU_THREADS"] = str(len(self.cores))
+        if not env.get("MODEL_SNAPSHOT_DIR"):
+            # 全ワーカーが同じsafetensorsファイルをメモリマップで読み込み、ページキャッシュを共有する
+            env["MODEL_SNAPSHOT_DIR"] = os.path.join(os.path.expanduser("~"), ".cache", "simplechat-snapshots")
+        self.process = subprocess.Popen([sys.executable, os.path.abspath(__file__)], env=env)
+        self.healthy = False
+        print(f"レプリカ {self.index} を起動しました (pid={self.process.pid}, port={self.port}, cores={self.cores or 'すべて'})")
+
+    def stop(self):
+        if self.alive:
+            self.process.terminate()
+            try:
+                self.process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+
+    def summary(self):
+        return {
+            "index": self.index,
+            "pid": self.process.pid if self.process else None,
+            "port": self.port,
+            "cores": self.cores,
+            "alive": self.alive,
+            "healthy": self.healthy,
+            "in_flight": self.in_flight,
+            "completed_requests": self.completed_requests,
+            "restarts": self.restarts,
+        }
+
+class ReplicaPool:
+    """
+    モデルワーカープロセスの集合
+
+    リクエストは処理中の件数が最も少ない準備完了のワーカーに割り当て、
+    終了したワーカーは死活監視で検出して再起動する。
+    """
+
+    def __init__(self, count=REPLICA_COUNT, base_port=REPLICA_BASE_PORT, health_interval=REPLICA_HEALTH_INTERVAL):
+        self.replicas = [
+            ReplicaProcess(i, base_port + i, cores) for i, cores in enumerate(split_cores(count))
+        ]
+        self.health_interval = health_interval
+        self.client = None
+        self._monitor_task = None
+
+    async def start(self):
+        self.client = httpx.AsyncClient(timeout=httpx.Timeout(None, connect=5.0))
+        for replica in self.replicas:
+            replica.start()
+        self._monitor_task = asyncio.create_task(self._monitor())
+
+    async def stop(self):
+        if self._monitor_task is not None:
+            self._monitor_task.cancel()
+        for replica in self.replicas:
+            replica.stop()
+        if self.client is not None:
+            await self.client.aclose()
+
+    async def _monitor(self):
+        while True:
+            for replica in self.replicas:
+                if not replica.alive:
+                    print(f"レプリカ {replica.index} が終了しました (code={replica.process.returncode})。再起動します。")
+                    replica.restarts += 1
+                    replica.start()
+                    continue
+                try:
+                    response = await self.client.get(f"{replica.url}/health", timeout=2.0)
+                    replica.healthy = response.json().get("status") == "ready"
+                except (httpx.HTTPError, ValueError):
+                    replica.healthy = False
+            await asyncio.sleep(self.health_interval)
+
+    def pick(self, exclude=()):
+        """処理中の件数が最も少ない準備完了のワーカーを返す (なければNone)"""
+        candidates = [r for r in self.replicas if r.healthy and r.alive and r not in exclude]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda r: r.in_flight)
+
+# ルーターのFastAPIアプリケーション (REPLICA_COUNTが2以上の場合に使用)
+router_app = FastAPI(
+    title="ローカルLLM APIルーター",
+    description="複数のモデルワーカープロセスにリクエストを振り分けるルーター",
+    version="1.0.0"
+)
+router_app.add_middleware(
+    CORSMiddleware,
+    allow_origins=["*"],
+    allow_credentials=True,
+    allow_methods=["*"],
+    allow_headers=["*"],
+)
+
+# レプリカプールのグローバル変数
+replica_pool = None
+
+@router_app.on_event("startup")
+async def router_startup_event():
+    """ルーターの起動時にワーカープロセスを起動"""
+    global replica_pool
+    replica_pool = ReplicaPool(config.REPLICA_COUNT, config.REPLICA_BASE_PORT, config.REPLICA_HEALTH_INTERVAL)
+    await replica_pool.start()
+
+@router_app.on_event("shutdown")
+async def router_shutdown_event():
+    if replica_pool is not None:
+        await replica_pool.stop()
+
+@router_app.get("/health")
+async def router_health_check():
+    """ルーターと全ワーカーの状態を返す"""
+    replicas = [replica.summary() for replica in replica_pool.replicas]
+    ready = sum(1 for replica in replicas if replica["healthy"])
+    return {
+        "status": "ready" if ready else "loading",
+        "ready_replicas": ready,
+        "replicas": replicas,
+    }
+
+@router_app.api_route("/{path:path}", methods=["GET", "POST"])
+async def router_proxy(path: str, request: Request):
+    """リクエストを最も空いているワーカーに転送し、応答をそのまま (ストリーミングも含めて) 返す"""
+    body = await request.body()
+    headers = {k: v for k, v in request.headers.items() if k.lower() not in HOP_BY_HOP_HEADERS}
+    tried = []
+    while True:
+        replica = replica_pool.pick(exclude=tried)
+        if replica is None:
+            raise HTTPException(
+                status_code=503,
+                detail="利用可能なワーカーがありません。後でもう一度お試しください。",
+                headers={"Retry-After": str(config.QUEUE_RETRY_AFTER)}
+            )
+        replica.in_flight += 1
+        try:
+            upstream_request = replica_pool.client.build_request(
+                request.method, f"{replica.url}/{path}", content=body, headers=headers, params=request.query_params
+            )
+            upstream = await replica_pool.client.send(upstream_request, stream=True)
+            break
+        except httpx.TransportError as e:
+            # 接続できないワーカーは不健全として扱い、別のワーカーで再試行する
+            print(f"レプリカ {replica.index} への転送に失敗しました: {e}")
+            replica.in_flight -= 1
+            replica.healthy = False
+            tried.append(replica)
+
+    released = False
+
+    async def release():
+        # 本文の転送の終了時と応答の送信後の両方から呼ばれるため、1回だけ処理する
+        nonlocal released
+        if released:
+            return
+        released = True
+        await upstream.aclose()
+        replica.in_flight -= 1
+        replica.completed_requests += 1
+
+    async def relay():
+        try:
+            async for chunk in upstream.aiter_raw():
+                yield chunk
+        finally:
+            await release()
+
+    response_headers = {k: v for k, v in upstream.headers.items() if k.lower() not in HOP_BY_HOP_HEADERS}
+    # 本文を読み始める前にクライアントが切断すると relay の finally は実行されないため、
+    # バックグラウンドタスクでも処理中の数を戻して上流の接続を閉じる
+    return StreamingResponse(relay(), status_code=upstream.status_code, headers=response_headers,
+                             background=BackgroundTask(release))
+
+def run_replica_worker(port):
+    """レプリカプールのワーカーとして、ローカルホストでAPIサーバーを実行"""
+    print(f"レプリカワーカーを起動します (port={port}, pid={os.getpid()})")
+    uvicorn.run(app, host="127.0.0.1", port=port, log_level="warning")
+
+# --- ngrokでAPIサーバーを実行する関数 ---
+def run_with_ngrok(port=8501):
+    """ngrokでFastAPIアプリを実行"""
+    nest_asyncio.apply()
+
+    ngrok_token = os.environ.get("NGROK_TOKEN")
+    if not ngrok_token:
+        print("Ngrok認証トークンが'NGROK_TOKEN'環境変数に設定されていません。")
+        try:
+            print("Colab Secrets(左側の鍵アイコン)で'NGROK_TOKEN'を設定することをお勧めします。")
+            ngrok_token = input("Ngrok認証トークンを入力してください (https://dashboard.ngrok.com/get-started/your-authtoken): ")
+        except EOFError:
+            print("\nエラー: 対話型入力が利用できません。")
+            print("Colab Secretsを使用するか、ノートブックセルで`os.environ['NGROK_TOKEN'] = 'あなたのトークン'`でトークンを設定してください")
+            return
+
+    if not ngrok_token:
+        print("エラー: Ngrok認証トークンを取得できませんでした。中止します。")
+        return
+
+    try:
+        ngrok.set_auth_token(ngrok_token)
+
+        # 既存のngrokトンネルを閉じる
+        try:
+            tunnels = ngrok.get_tunnels()
+            if tunnels:
+                print(f"{len(tunnels)}個の既存トンネルが見つかりました。閉じています...")
+                for tunnel in tunnels:
+                    print(f"  - 切断中: {tunnel.public_url}")
+                    ngrok.disconnect(tunnel.public_url)
+                print("すべての既存ngrokトンネルを切断しました。")
+            else:
+                print("アクティブなngrokトンネルはありません。")
+        except Exception as e:
+            print(f"トンネル切断中にエラーが発生しました: {e}")
+            # エラーにもかかわらず続行を試みる
+
+        # 新しいngrokトンネルを開く
+        print(f"ポート{port}に新しいngrokトンネルを開いています...")
+        ngrok_tunnel = ngrok.connect(port)
+        public_url = ngrok_tunnel.public_url
+        print("---------------------------------------------------------------------")
+        print(f"✅ 公開URL:   {public_url}")
+        print(f"📖 APIドキュメント (Swagger UI): {public_url}/docs")
+        print("---------------------------------------------------------------------")
+        print("(APIクライアントやブラウザからアクセスするためにこのURLをコピーしてください)")
+        if config.REPLICA_COUNT > 1:
+            # 複数のワーカープロセスを起動し、ルーター経由でリクエストを振り分ける
+            print(f"レプリカプールモード: {config.REPLICA_COUNT}個のワーカープロセスを起動します")
+            uvicorn.run(router_app, host="0.0.0.0", port=port, log_level="info")
+        else:
+            uvicorn.run(app, host="0.0.0.0", port=port, log_level="info")  # ログレベルをinfoに設定
+
+    except Exception as e:
+        print(f"\n ngrokまたはUvicornの起動中にエラーが発生しました: {e}")
+        traceback.print_exc()
+        # エラー後に残る可能性のあるngrokトンネルを閉じようとする
+        try:
+            print("エラーにより残っている可能性のあるngrokトンネルを閉じています...")
+            tunnels = ngrok.get_tunnels()
+            for tunnel in tunnels:
+                ngrok.disconnect(tunnel.public_url)
+            print("ngrokトンネルを閉じました。")
+        except Exception as ne:
+            print(f"ngrokトンネルのクリーンアップ中に別のエラーが発生しました: {ne}")
+
+# --- オフラインのバッチ推論 (JSONL) ---
+# 入力の1行で指定できる生成パラメータ (省略した項目はコマンドラインの指定値)
+BATCH_RECORD_FIELDS = ("max_new_tokens", "do_sample", "temperature", "top_p", "stop")
+
+def parse_batch_record(line, defaults):
+    """
+    入力のJSONLの1行を (id, SimpleGenerationRequest) にする
+
+    行には "prompt" (プロンプト文字列) または "messages" (/chat と同じ会話履歴) のどちらかが必要。
+    "id" は結果の行にそのまま含める。
+    """
+    record = json.loads(line)
+    if not isinstance(record, dict):
+        raise ValueError("各行はJSONオブジェクトである必要があります")
+    if record.get("messages"):
+        prompt = "".join(format_chat_segments([Message(**message) for message in record["messages"]]))
+    elif record.get("prompt"):
+        prompt = record["prompt"]
+    else:
+        raise ValueError("prompt または messages が必要です")
+    fields = {**defaults, **{key: record[key] for key in BATCH_RECORD_FIELDS if key in record}}
+    return record.get("id"), SimpleGenerationRequest(prompt=prompt, **fields)
+
+def read_jsonl_window(f, window_size):
+    """バイナリモードで開いた入力から最大 window_size 行を読み、空行を除いた行のリストを返す"""
+    lines = []
+    while len(lines) < window_size:
+        raw = f.readline()
+        if not raw:
+            break
+        lines.append(raw.decode("utf-8").strip())
+    return lines
+
+def load_batch_checkpoint(path, input_path):
+    """前回の実行の進捗を読み込む (ない場合や別の入力ファイルの進捗の場合はNone)"""
+    if not path or not os.path.exists(path):
+        return None
+    with open(path, encoding="utf-8") as f:
+        state = json.load(f)
+    if state.get("input") != os.path.abspath(input_path):
+        print(f"チェックポイント {path} は別の入力ファイルのものです。最初から処理します。")
+        return None
+    return state
+
+def save_batch_checkpoint(path, state):
+    """進捗を一時ファイルに書いてから置き換える (書き込み中に中断しても前回の進捗が残る)"""
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(state, f, ensure_ascii=False, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+def make_length_buckets(items, batch_size):
+    """
+    (行番号, id, リクエスト, プロンプトのトークン数) のリストを、生成パラメータが同じで
+    長さの近いリクエストのバッチに分ける (左詰めのパディングを最小にするため、長さ順に並べてから区切る)
+    """
+    items = sorted(items, key=lambda item: (repr(SequentialInferenceWorker.generation_key(item[2])), item[3]))
+    batches, batch, key = [], [], None
+    for item in items:
+        item_key = SequentialInferenceWorker.generation_key(item[2])
+        if batch and (item_key != key or len(batch) >= batch_size):
+            batches.append(batch)
+            batch = []
+        batch.append(item)
+        key = item_key
+    if batch:
+        batches.append(batch)
+    return batches
+
+def format_batch_progress(state):
+    elapsed = state["elapsed"] or 1e-9
+    padded = state["prompt_tokens"] + state["padding_tokens"]
+    return (f"{state['prompts']}件 (失敗 {state['errors']}件) / {state['elapsed']:.1f}秒: "
+            f"{state['prompts'] / elapsed:.2f} プロンプト/秒, {state['generated_tokens'] / elapsed:.1f} トークン/秒, "
+            f"パディング {state['padding_tokens'] / padded * 100 if padded else 0.0:.1f}%")
+
+def run_batch_inference(args):
+    """
+    入力のJSONLを window 行ずつ読み、長さでバケットに分けてpipelineでまとめて推論し、結果をJSONLに追記する
+
+    入力全体はメモリに読み込まない。出力の行は window の中では長さ順になるため、入力の行番号 (index) を含める。
+    window ごとに出力を書き終えてから進捗をチェックポイントに保存し、中断した場合は次の実行で
+    チェックポイントの位置 (入力と出力のバイト位置) から再開する。
+    """
+    checkpoint_path = args.checkpoint or args.output + ".checkpoint.json"
+    state = None if args.restart else load_batch_checkpoint(checkpoint_path, args.input)
+    if state is not None and state.get("finished"):
+        print(f"{args.input} の処理は完了しています ({format_batch_progress(state)})。やり直す場合は --restart を指定してください。")
+        return state
+    if state is None:
+        state = {
+            "input": os.path.abspath(args.input), "input_offset": 0, "next_line": 0, "output_bytes": 0,
+            "prompts": 0, "errors": 0, "prompt_tokens": 0, "padding_tokens": 0, "generated_tokens": 0,
+            "elapsed": 0.0, "finished": False,
+        }
+        open(args.output, "wb").close()
+    else:
+        print(f"チェックポイントから再開します: {state['next_line']}行目から ({format_batch_progress(state)})")
+        # 前回のチェックポイントの後に書きかけた結果は捨てる
+        os.truncate(args.output, state["output_bytes"])
+
+    global model_registry
+    if args.model:
+        # サーバーとして起動しないため、指定されたモデルだけを登録し直す
+        model_registry = ModelRegistry(args.model)
+    entry = model_registry.get()
+    pipe = load_model(entry.name)
+    if pipe is None:
+        raise RuntimeError(f"モデル '{entry.name}' を読み込めませんでした")
+    worker = SequentialInferenceWorker(pipe, max_queue_size=0, max_batch_size=args.batch_size)
+    defaults = {"max_new_tokens": args.max_new_tokens, "do_sample": not args.greedy,
+                "temperature": args.temperature, "top_p": args.top_p}
+
+    with open(args.input, "rb") as source, open(args.output, "ab") as sink:
+        def write_result(result_record):
+            if "error" in result_record:
+                state["errors"] += 1
+            sink.write((json.dumps(result_record, ensure_ascii=False) + "\n").encode("utf-8"))
+
+        source.seek(state["input_offset"])
+        while True:
+            window_start = time.time()
+            lines = read_jsonl_window(source, args.window)
+            if not lines:
+                break
+            items = []
+            for offset, line in enumerate(lines):
+                index = state["next_line"] + offset
+                if not line:
+                    continue
+                state["prompts"] += 1
+                try:
+                    record_id, request = parse_batch_record(line, defaults)
+                except Exception as e:
+                    write_result({"index": index, "error": f"入力を解析できません: {e}"})
+                    continue
+                items.append((index, record_id, request, len(pipe.tokenizer(request.prompt)["input_ids"])))
+
+            for batch in make_length_buckets(items, args.batch_size):
+                longest = max(item[3] for item in batch)
+                state["padding_tokens"] += sum(longest - item[3] for item in batch)
+                futures = worker.generate_batch([item[2] for item in batch])
+                for (index, record_id, _, prompt_tokens), future in zip(batch, futures):
+                    result_record = {"index": index, "id": record_id} if record_id is not None else {"index": index}
+                    state["prompt_tokens"] += prompt_tokens
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        result_record["error"] = str(e)
+                    else:
+                        result_record.update({
+                            "generated_text": extract_assistant_response(result.outputs),
+                            "finish_reason": result.finish_reason,
+                            "prompt_tokens": prompt_tokens,
+                            "generated_tokens": result.timings.get("generated_tokens"),
+                        })
+                        state["generated_tokens"] += result.timings.get("generated_tokens", 0)
+                    write_result(result_record)
+                # バッチごとに書き出し、処理中の結果を確認できるようにする
+                sink.flush()
+
+            os.fsync(sink.fileno())
+            state["next_line"] += len(lines)
+            state["input_offset"] = source.tell()
+            state["output_bytes"] = sink.tell()
+            state["elapsed"] += time.time() - window_start
+            save_batch_checkpoint(checkpoint_path, state)
+            print(format_batch_progress(state), flush=True)
+
+    state["finished"] = True
+    save_batch_checkpoint(checkpoint_path, state)
+    print(f"完了しました: {format_batch_progress(state)} -> {args.output}")
+    return state
+
+def run_batch_cli(argv=None):
+    """`python app.py batch --input prompts.jsonl --output results.jsonl` で実行する"""
+    parser = argparse.ArgumentParser(prog="app.py batch", description="JSONLのプロンプトをHTTPサーバーを起動せずにまとめて推論する")
+    parser.add_argument("--input", required=True, help="1行に1件の {'prompt' または 'messages', 'id', 生成パラメータ} を含むJSONL")
+    parser.add_argument("--output", required=True, help="結果を書き出すJSONL (index は入力の行番号)")
+    parser.add_argument("--checkpoint", help="進捗を保存するファイル (省略時は <output>.checkpoint.json)")
+    parser.add_argument("--restart", action="store_true", help="チェックポイントを無視して最初から処理する")
+    parser.add_argument("--model", help="使用するモデル名またはパス (省略時は MODEL_NAME)")
+    parser.add_argument("--batch-size", type=int, default=max(config.MAX_BATCH_SIZE, 1), help="1回のpipeline呼び出しでまとめる件数")
+    parser.add_argument("--window", type=int, default=256,
+                        help="長さで並べ替える単位の行数 (この行数ごとに結果を書き出してチェックポイントを保存する)")
+    parser.add_argument("--max-new-tokens", type=int, default=512)
+    parser.add_argument("--temperature", type=float, default=0.7)
+    parser.add_argument("--top-p", type=float, default=0.9)
+    parser.add_argument("--greedy", action="store_true", help="サンプリングせずに貪欲法で生成する (再現性のある結果)")
+    args = parser.parse_args(argv)
+    run_batch_inference(args)
 
 # --- メイン実行ブロック ---
 if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "batch":
+        # HTTPサーバーを起動せずにJSONLのプロンプトをまとめて推論する
+        run_batch_cli(sys.argv[2:])
+        sys.exit(0)
+    if os.environ.get("REPLICA_WORKER_PORT"):
+        # レプリカプールのルーターから起動されたワーカープロセス
+        run_replica_worker(int(os.environ["REPLICA_WORKER_PORT"]))
+        sys.exit(0)
     # 指定されたポートでサーバーを起動
     run_with_ngrok(port=8501)  # このポート番号を確認
     # run_with_ngrokが終了したときにメッセージを表示
@@ -0,0 +1,222 @@
+# lambda/conversation_store.py
+import json
+import os
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+
+class ConversationNotFoundError(Exception):
+    """会話が存在しない、または別のユーザーの会話"""
+
+class VersionConflictError(Exception):
+    """会話が他のリクエストで先に更新されている"""
+
+    def __init__(self, message, current_version):
+        super().__init__(message)
+        self.current_version = current_version
+
+def _check_owner(conversation_id, stored_owner, owner):
+    """
+    所有者のある会話は、同じ所有者からだけ読み書きできるようにする
+
+    所有者のない呼び出し (owner が None) からも、所有者のある会話は見つからないものとして扱う。
+    """
+    if stored_owner is not None and stored_owner != owner:
+        raise ConversationNotFoundError(f"会話 {conversation_id} が見つかりません")
+
+class ConversationStore(ABC):
+    """
+    会話履歴の保存先のインターフェース
+
+    会話ごとにメッセージのリストとバージョン (更新のたびに1増える) を保持する。
+    append は読み込んだ時点のバージョンを expected_version として渡し、
+    その間に別のリクエストが更新していた場合は VersionConflictError を送出する (楽観的排他制御)。
+    会話の所有者は最初に追加したときの owner で決まり、以降は同じ owner からだけ読み書きできる。
+    """
+
+    @abstractmethod
+    def load(self, conversation_id, owner=None):
+        """
+        会話履歴を読み込む
+
+        Args:
+            conversation_id (str): 会話ID
+            owner (str): リクエストしたユーザー (Noneの場合は所有者のない会話だけを読める)
+
+        Returns:
+            tuple: (メッセージのリスト, バージョン)。存在しない会話は ([], 0)
+
+        Raises:
+            ConversationNotFoundError: 別のユーザーの会話の場合
+        """
+
+    @abstractmethod
+    def append(self, conversation_id, messages, expected_version, owner=None):
+        """
+        会話の末尾にメッセージを追加し、新しいバージョンを返す
+
+        Raises:
+            VersionConflictError: 保存されているバージョンが expected_version と異なる場合
+            ConversationNotFoundError: 別のユーザーの会話の場合
+        """
+
+class InMemoryConversationStore(ConversationStore):
+    """プロセス内の辞書に保持する (テストとローカルでの確認用)"""
+
+    def __init__(self):
+        self._conversations = {}  # conversation_id -> (owner, messages, version)
+        self._lock = threading.Lock()
+
+    def load(self, conversation_id, owner=None):
+        with self._lock:
+            stored = self._conversations.get(conversation_id)
+        if stored is None:
+            return [], 0
+        stored_owner, messages, version = stored
+        _check_owner(conversation_id, stored_owner, owner)
+        return list(messages), version
+
+    def append(self, conversation_id, messages, expected_version, owner=None):
+        with self._lock:
+            stored_owner, stored_messages, version = self._conversations.get(conversation_id, (owner, [], 0))
+            _check_owner(conversation_id, stored_owner, owner)
+            if version != expected_version:
+                raise VersionConflictError(
+                    f"会話 {conversation_id} は他のリクエストで更新されています (version {version})", version
+                )
+            self._conversations[conversation_id] = (stored_owner, stored_messages + list(messages), version + 1)
+            return version + 1
+
+class SQLiteConversationStore(ConversationStore):
+    """
+    SQLiteのファイルに保持する (ローカルでの確認や、1台で動かす場合の保存先)
+
+    バージョンの確認と更新は1つのUPDATE文で行うため、複数のプロセスから使っても
+    同じバージョンに対する更新は1つだけが成功する。
+    """
+
+    def __init__(self, path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._lock = threading.Lock()
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS conversations ("
+            "id TEXT PRIMARY KEY, owner TEXT, messages TEXT, version INTEGER, updated_at REAL)"
+        )
+
+    def load(self, conversation_id, owner=None):
+        with self._lock:
+            row = self._db.execute(
+                "SELECT owner, messages, version FROM conversations WHERE id = ?", (conversation_id,)
+            ).fetchone()
+        if row is None:
+            return [], 0
+        stored_owner, messages, version = row
+        _check_owner(conversation_id, stored_owner, owner)
+        return json.loads(messages), version
+
+    def append(self, conversation_id, messages, expected_version, owner=None):
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._db.execute(
+                    "SELECT owner, messages, version FROM conversations WHERE id = ?", (conversation_id,)
+                ).fetchone()
+                stored_owner, stored_messages, version = row if row is not None else (owner, "[]", 0)
+                _check_owner(conversation_id, stored_owner, owner)
+                if version != expected_version:
+                    raise VersionConflictError(
+                        f"会話 {conversation_id} は他のリクエストで更新されています (version {version})", version
+                    )
+                updated = json.dumps(json.loads(stored_messages) + list(messages), ensure_ascii=False)
+                self._db.execute(
+                    "INSERT INTO conversations (id, owner, messages, version, updated_at) VALUES (?, ?, ?, ?, ?) "
+                    "ON CONFLICT(id) DO UPDATE SET messages = excluded.messages, version = excluded.version, "
+                    "updated_at = excluded.updated_at",
+                    (conversation_id, stored_owner, updated, version + 1, time.time())
+                )
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+        return version + 1
+
+class DynamoDBConversationStore(ConversationStore):
+    """
+    DynamoDBのテーブルに保持する (Lambdaで使う保存先)
+
+    テーブルのパーティションキーは文字列の "conversationId"。
+    バージョンの確認は条件付き書き込み (ConditionExpression) で行う。
+    """
+
+    def __init__(self, table_name):
+        import boto3
+        self._table = boto3.resource("dynamodb").Table(table_name)
+
+    def _get(self, conversation_id):
+        return self._table.get_item(Key={"conversationId": conversation_id}, ConsistentRead=True).get("Item")
+
+    def load(self, conversation_id, owner=None):
+        item = self._get(conversation_id)
+        if item is None:
+            return [], 0
+        _check_owner(conversation_id, item.get("owner"), owner)
+        return json.loads(item["messages"]), int(item["version"])
+
+    def append(self, conversation_id, messages, expected_version, owner=None):
+        from botocore.exceptions import ClientError
+        stored = self._get(conversation_id)
+        if stored is not None:
+            _check_owner(conversation_id, stored.get("owner"), owner)
+        # 上書きで所有者が消えないように、保存されている所有者 (新しい会話ではリクエストしたユーザー) を引き継ぐ
+        stored_owner = stored.get("owner") if stored is not None else owner
+        stored_messages = json.loads(stored["messages"]) if stored is not None else []
+        item = {
+            "conversationId": conversation_id,
+            "messages": json.dumps(stored_messages + list(messages), ensure_ascii=False),
+            "version": expected_version + 1,
+            "updatedAt": int(time.time()),
+        }
+        if stored_owner is not None:
+            item["owner"] = stored_owner
+        try:
+            if expected_version == 0:
+                self._table.put_item(Item=item, ConditionExpression="attribute_not_exists(conversationId)")
+            else:
+                self._table.put_item(
+                    Item=item,
+                    ConditionExpression="version = :expected",
+                    ExpressionAttributeValues={":expected": expected_version}
+                )
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") != "ConditionalCheckFailedException":
+                raise
+            _, version = self.load(conversation_id)
+            raise VersionConflictError(
+                f"会話 {conversation_id} は他のリクエストで更新されています (version {version})", version
+            )
+        return expected_version + 1
+
+def create_conversation_store(spec):
+    """
+    設定の文字列から会話の保存先を作成する
+
+    Args:
+        spec (str): "memory" / "sqlite:<ファイルのパス>" / "dynamodb:<テーブル名>" (空の場合はNone)
+
+    Returns:
+        ConversationStore: 保存先 (会話IDのモードを使わない場合はNone)
+    """
+    if not spec:
+        return None
+    kind, _, target = spec.partition(":")
+    if kind == "memory":
+        return InMemoryConversationStore()
+    if kind == "sqlite":
+        return SQLiteConversationStore(target or "/tmp/conversations.sqlite3")
+    if kind == "dynamodb":
+        return DynamoDBConversationStore(target)
+    raise ValueError(f"未対応の会話の保存先です: {spec}")
@@ -2,157 +2,639 @@
 import json
 import os
 import re
-import requests
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from requests.exceptions import RequestException
 
+from upstream import UpstreamClient, UpstreamError
+from conversation_store import create_conversation_store, ConversationNotFoundError, VersionConflictError
+from tracing import RequestTrace, REQUEST_ID_HEADER, parse_server_timing
+
 # APIのベースURL
 API_BASE_URL = os.environ.get("API_BASE_URL", "https://2c41-34-87-69-11.ngrok-free.app")
+# カンマ区切りで複数のサーバーを指定すると、処理中の要求が最も少ないサーバーに振り分ける (省略時は API_BASE_URL のみ)
+API_BASE_URLS = [url.strip() for url in os.environ.get("API_BASE_URLS", API_BASE_URL).split(",") if url.strip()]
+
+# サーバーへの要求の設定
+UPSTREAM_TIMEOUT = float(os.environ.get("UPSTREAM_TIMEOUT", "30"))  # Lambdaのcontextがない場合の期限 (秒)
+UPSTREAM_MAX_ATTEMPTS = int(os.environ.get("UPSTREAM_MAX_ATTEMPTS", "3"))  # 別のサーバーへの再試行を含む試行回数
+UPSTREAM_HEDGE_AFTER = float(os.environ.get("UPSTREAM_HEDGE_AFTER", "0"))  # この秒数応答がなければ別のサーバーにも送る (0は無効)
+UPSTREAM_FAILURE_THRESHOLD = int(os.environ.get("UPSTREAM_FAILURE_THRESHOLD", "3"))  # 連続失敗でサーキットを開く回数
+UPSTREAM_COOLDOWN = float(os.environ.get("UPSTREAM_COOLDOWN", "10"))  # サーキットを開いている秒数
+UPSTREAM_POOL_SIZE = int(os.environ.get("UPSTREAM_POOL_SIZE", "10"))  # サーバーごとに保持するkeep-alive接続数
+# Lambdaの残り時間のうち、応答を返すために残しておく秒数
+DEADLINE_MARGIN = float(os.environ.get("DEADLINE_MARGIN", "0.5"))
+# サーバーに伝える生成の期限を、要求の期限よりこの秒数だけ早める (応答がngrok経由でLambdaに届くまでの時間)
+SERVER_DEADLINE_MARGIN = float(os.environ.get("SERVER_DEADLINE_MARGIN", "1.0"))
 
-# モデルID（元のコードと互換性のために保持）
+# モデルID。FastAPIサーバーに登録されたモデル名を指定すると、そのモデルで応答を生成する
+# 既定値の "local-model" の場合はサーバーの既定モデルを使用する
 MODEL_ID = os.environ.get("MODEL_ID", "local-model")
+DEFAULT_MODEL_ID = "local-model"
+
+# 生成するトークン数の既定値と、本文の maxNewTokens で指定できる上限
+MAX_NEW_TOKENS = int(os.environ.get("MAX_NEW_TOKENS", "512"))
+
+# プロンプトに含める会話履歴のトークン数の上限 (推定値)
+PROMPT_TOKEN_BUDGET = int(os.environ.get("PROMPT_TOKEN_BUDGET", "4096"))
+# 常にプロンプトの先頭に置くシステムコンテキスト (任意)
+SYSTEM_PROMPT = os.environ.get("SYSTEM_PROMPT", "")
+
+# トークン数推定の係数 (1トークンあたりの文字数)。日本語は1文字≒1トークンとして安全側に見積もる
+CJK_CHARS_PER_TOKEN = float(os.environ.get("CJK_CHARS_PER_TOKEN", "1.0"))
+ASCII_CHARS_PER_TOKEN = float(os.environ.get("ASCII_CHARS_PER_TOKEN", "4.0"))
+
+# 会話の役割ごとのプロンプト上の表記
+ROLE_PREFIXES = {
+    "system": "システム: ",
+    "user": "ユーザー: ",
+    "assistant": "アシスタント: ",
+}
+
+# モデルが次の話者の発言まで続けて生成しないよう、サーバー側で生成を止める停止文字列
+ENABLE_STOP_SEQUENCES = os.environ.get("ENABLE_STOP_SEQUENCES", "true").lower() == "true"
+
+# サンプリングのリクエストでも、同じ内容で同時に実行中の生成があれば結果を共有する (既定は無効)
+# 有効にすると、同じプロンプトを同時に送った別のユーザーにも同じサンプルが返る
+COALESCE_SAMPLED_REQUESTS = os.environ.get("COALESCE_SAMPLED_REQUESTS", "false").lower() == "true"
+STOP_SEQUENCES = ["\n" + ROLE_PREFIXES[role].strip() for role in ("user", "system")]
+
+# ウォームスタート間で接続と各サーバーの状態を引き継ぐため、モジュールの読み込み時に1回だけ作成する
+upstream = UpstreamClient(
+    API_BASE_URLS,
+    timeout=UPSTREAM_TIMEOUT,
+    max_attempts=UPSTREAM_MAX_ATTEMPTS,
+    hedge_after=UPSTREAM_HEDGE_AFTER,
+    failure_threshold=UPSTREAM_FAILURE_THRESHOLD,
+    cooldown=UPSTREAM_COOLDOWN,
+    pool_size=UPSTREAM_POOL_SIZE,
+    server_deadline_margin=SERVER_DEADLINE_MARGIN
+)
+
+# 応答に付けるCORSヘッダー
+CORS_HEADERS = {
+    "Access-Control-Allow-Origin": "*",
+    "Access-Control-Allow-Headers": "Content-Type,X-Amz-Date,Authorization,X-Api-Key,X-Amz-Security-Token",
+    "Access-Control-Allow-Methods": "OPTIONS,POST",
+    # 問い合わせの際にリクエストIDを伝えられるよう、ブラウザからも読めるようにする
+    "Access-Control-Expose-Headers": "X-Request-ID,Retry-After"
+}
+
+# 会話IDのモードで会話履歴を保持する保存先 ("memory" / "sqlite:<パス>" / "dynamodb:<テーブル名>")
+# 設定すると、リクエストに conversationId を含めたクライアントは新しいメッセージだけを送ればよい
+CONVERSATION_STORE = os.environ.get("CONVERSATION_STORE", "")
+conversation_store = create_conversation_store(CONVERSATION_STORE)
+
+# ストリーミング用のHTTPサーバー (run_stream_server) の設定
+STREAM_SERVER_PORT = int(os.environ.get("AWS_LWA_PORT", os.environ.get("PORT", "8080")))
+STREAM_TIMEOUT = float(os.environ.get("STREAM_TIMEOUT", "120"))  # 1回のストリーミング応答の期限 (秒)
+
+# リクエストごとの構造化ログ (1リクエスト1行) の設定
+# エラーと TRACE_SLOW_THRESHOLD 秒以上かかったリクエストは常に、それ以外は TRACE_SAMPLE_RATE の割合で出力する
+TRACE_SAMPLE_RATE = float(os.environ.get("TRACE_SAMPLE_RATE", "0.1"))
+TRACE_SLOW_THRESHOLD = float(os.environ.get("TRACE_SLOW_THRESHOLD", "10"))
+
+# ひらがな・カタカナ・CJK統合漢字・全角記号などの範囲
+CJK_PATTERN = re.compile(r"[\u3000-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uff00-\uffef]")
 
 def lambda_handler(event, context):
+    # LambdaのリクエストIDを LLM APIサーバーまで引き継ぎ、CloudWatchのログと突き合わせられるようにする
+    trace = create_trace(getattr(context, "aws_request_id", None))
+    result = handle_chat(event, context, trace)
+    result["headers"] = {**result["headers"], REQUEST_ID_HEADER: trace.request_id}
+    trace.emit(result["statusCode"])
+    return result
+
+def create_trace(request_id=None):
+    """設定したサンプリングでリクエストのトレースを作成する"""
+    return RequestTrace(request_id, sample_rate=TRACE_SAMPLE_RATE, slow_threshold=TRACE_SLOW_THRESHOLD)
+
+def handle_chat(event, context, trace):
+    """
+    1回の発言を処理し、API Gatewayのプロキシ統合の形式の応答を返す
+
+    Args:
+        event (dict): API Gatewayのプロキシ統合のイベント
+        context: Lambdaのcontext (期限の計算に使う。Noneの場合は UPSTREAM_TIMEOUT)
+        trace (RequestTrace): 所要時間の内訳と結果を記録するトレース
+    """
     try:
-        print("Received event:", json.dumps(event))
-        
-        # Cognitoで認証されたユーザー情報を取得
-        user_info = None
-        if 'requestContext' in event and 'authorizer' in event['requestContext']:
-            user_info = event['requestContext']['authorizer']['claims']
-            print(f"Authenticated user: {user_info.get('email') or user_info.get('cognito:username')}")
-        
-        # リクエストボディの解析
-        body = json.loads(event['body'])
-        message = body['message']
-        conversation_history = body.get('conversationHistory', [])
+        with trace.span("prepare"):
+            turn = prepare_chat_request(event, trace)
         
-        print("Processing message:", message)
-        
-        # 会話履歴から最後のN個のメッセージを取得し、コンテキストを構築
-        # 最後のユーザーメッセージを含む会話履歴から適切なプロンプトを作成
-        prompt = format_prompt_from_history(conversation_history, message)
-        
-        # FastAPIサーバーへのリクエストペイロードを作成
-        request_payload = {
-            "prompt": prompt,
-            "max_new_tokens": 512,
-            "temperature": 0.7,
-            "top_p": 0.9,
-            "do_sample": True
-        }
-        
-        print(f"Calling local LLM API at {API_BASE_URL}/generate")
+        # ストリーミングを指定された場合は、SSEのフレームで返す
+        # (API Gatewayのプロキシ統合は応答をまとめて返すため、全てのフレームを1つの本文にする。
+        #  逐次返すには run_stream_server を Lambda Web Adapter の背後で使う)
+        if turn.stream:
+            frames = stream_chat(turn, get_deadline(context))
+            return {
+                "statusCode": 200,
+                "headers": {**CORS_HEADERS, "Content-Type": "text/event-stream; charset=utf-8"},
+                "body": "".join(frames)
+            }
         
-        # FastAPIサーバーにリクエストを送信
-        response = requests.post(
-            f"{API_BASE_URL}/generate",
-            json=request_payload,
-            timeout=30  # タイムアウト設定
-        )
+        # FastAPIサーバーにリクエストを送信 (Lambdaのタイムアウトより前に打ち切る)
+        with trace.span("upstream"):
+            response = upstream.post_json("/generate", turn.request_payload, get_deadline(context), trace.headers())
+        trace.set_server_timings(parse_server_timing(response.headers.get("Server-Timing")))
         
         # レスポンスが成功した場合
         if response.status_code == 200:
             response_data = response.json()
-            print("LLM API response:", json.dumps(response_data, default=str))
+            trace.set(
+                finishReason=response_data.get("finish_reason"),
+                truncated=response_data.get("truncated") or None,
+                generatedTokens=response_data.get("generated_tokens"),
+                cached=response_data.get("cached"),
+                coalesced=response_data.get("coalesced")
+            )
             
             # アシスタントの応答を取得
             assistant_response = response_data.get('generated_text', '')
             if not assistant_response:
                 raise Exception("No response content from the model")
             
-            # アシスタントの応答を会話履歴に追加
-            messages = conversation_history.copy()
-            # ユーザーメッセージを追加
-            messages.append({
-                "role": "user",
-                "content": message
-            })
-            # アシスタントの応答を追加
-            messages.append({
-                "role": "assistant",
-                "content": assistant_response
-            })
+            # アシスタントの応答を会話履歴に追加 (会話IDのモードでは保存先に追加し、履歴は返さない)
+            with trace.span("store"):
+                conversation = turn.complete(assistant_response)
             
             # 成功レスポンスの返却
             return {
                 "statusCode": 200,
-                "headers": {
-                    "Content-Type": "application/json",
-                    "Access-Control-Allow-Origin": "*",
-                    "Access-Control-Allow-Headers": "Content-Type,X-Amz-Date,Authorization,X-Api-Key,X-Amz-Security-Token",
-                    "Access-Control-Allow-Methods": "OPTIONS,POST"
-                },
+                "headers": {**CORS_HEADERS, "Content-Type": "application/json"},
                 "body": json.dumps({
                     "success": True,
                     "response": assistant_response,
-                    "conversationHistory": messages
+                    **conversation,
+                    # 期限までに生成を終えられず、途中までの応答を返した場合はTrue
+                    "truncated": bool(response_data.get("truncated")),
+                    # サーバーが生成したトークン数 (キャッシュから返した場合はNone)
+                    "generatedTokens": response_data.get("generated_tokens")
                 })
             }
+        elif response.status_code == 504:
+            # サーバーが期限までに生成を開始できなかった
+            error_msg = f"LLM API returned status code 504: {response.text}"
+            trace.fail(error_msg)
+            return create_error_response(504, error_msg)
+        elif response.status_code == 429:
+            # 利用量の上限または混雑。いつ再試行できるかをクライアントにそのまま伝える
+            error_msg = f"LLM API returned status code 429: {response.text}"
+            trace.fail(error_msg)
+            retry_after = response.headers.get("Retry-After")
+            return create_error_response(429, error_msg, {"Retry-After": retry_after} if retry_after else None)
         else:
             # APIエラーの場合
             error_msg = f"LLM API returned status code {response.status_code}: {response.text}"
-            print(error_msg)
             raise Exception(error_msg)
         
+    except InvalidChatRequestError as e:
+        trace.fail(f"Invalid request: {e}")
+        return create_error_response(400, str(e))
+        
+    except ConversationNotFoundError as e:
+        trace.fail(f"Conversation not found: {e}")
+        return create_error_response(404, str(e))
+        
+    except VersionConflictError as e:
+        trace.fail(f"Conversation version conflict: {e}")
+        return create_error_response(409, str(e))
+        
+    except UpstreamError as e:
+        error_msg = f"Request to LLM API failed: {str(e)}"
+        trace.fail(error_msg)
+        trace.set(upstream=upstream.summary())
+        return create_error_response(504 if e.deadline_exceeded else 502, error_msg)
+        
     except RequestException as e:
         error_msg = f"Request to LLM API failed: {str(e)}"
-        print(error_msg)
+        trace.fail(error_msg)
         return create_error_response(500, error_msg)
         
     except Exception as error:
-        print("Error:", str(error))
+        trace.fail(error)
         return create_error_response(500, str(error))
 
-def format_prompt_from_history(conversation_history, new_message):
+class InvalidChatRequestError(ValueError):
+    """リクエストの内容がこのLambdaの設定では処理できない"""
+
+class ChatTurn:
+    """1回の発言の処理に必要な情報 (prepare_chat_request が作成する)"""
+
+    def __init__(self, message, conversation_history, request_payload, stream=False,
+                 conversation_id=None, version=None, owner=None, trace=None):
+        self.message = message
+        self.conversation_history = conversation_history
+        self.request_payload = request_payload
+        self.stream = stream
+        self.conversation_id = conversation_id  # 会話IDのモードでない場合はNone
+        self.version = version
+        self.owner = owner
+        self.trace = trace or create_trace()
+
+    def complete(self, assistant_response):
+        """
+        応答を会話に追加し、レスポンスの本文に含める会話の情報を返す
+
+        従来のモードでは更新後の会話履歴全体を、会話IDのモードでは保存先に追加したうえで
+        会話IDと新しいバージョンだけを返す。
+
+        Raises:
+            VersionConflictError: 応答の生成中に別のリクエストが同じ会話を更新した場合
+        """
+        if self.conversation_id is None:
+            return {"conversationHistory": append_turn(self.conversation_history, self.message, assistant_response)}
+        new_messages = append_turn([], self.message, assistant_response)
+        version = conversation_store.append(self.conversation_id, new_messages, self.version, self.owner)
+        return {"conversationId": self.conversation_id, "version": version}
+
+def prepare_chat_request(event, trace=None):
+    """
+    イベントからメッセージと会話履歴を取り出し、FastAPIサーバーへのリクエストペイロードを作成する
+    
+    本文に conversationId を含む場合は、会話履歴を保存先から読み込む (nullの場合は新しい会話を作る)。
+    version を含む場合は、保存されているバージョンと一致しなければ生成する前に拒否する。
+    maxNewTokens を含む場合は、生成するトークン数を MAX_NEW_TOKENS 以下に変更する。
+    
+    Args:
+        event (dict): API Gatewayのプロキシ統合のイベント
+        trace (RequestTrace): ユーザーやプロンプトの大きさを記録するトレース (Noneの場合は新しく作成する)
+    
+    Returns:
+        ChatTurn: メッセージ・会話履歴・リクエストペイロードなど
+    
+    Raises:
+        InvalidChatRequestError: 会話IDのモードが有効でないのに conversationId が指定された場合、
+            または maxNewTokens が1以上 MAX_NEW_TOKENS 以下の整数でない場合
+        VersionConflictError: 指定された version が古い場合
+    """
+    trace = trace or create_trace()
+    
+    # Cognitoで認証されたユーザー情報を取得
+    user_info = None
+    user_id = None
+    if 'requestContext' in event and 'authorizer' in event['requestContext']:
+        user_info = event['requestContext']['authorizer']['claims']
+        # サーバー側の公平なスケジューリングと利用量の上限には、変わらない sub を使う
+        user_id = user_info.get('sub') or user_info.get('cognito:username')
+        trace.set(user=user_id)
+    
+    # リクエストボディの解析
+    body = json.loads(event['body'])
+    message = body['message']
+    max_new_tokens = body.get('maxNewTokens', MAX_NEW_TOKENS)
+    if isinstance(max_new_tokens, bool) or not isinstance(max_new_tokens, int) or not 1 <= max_new_tokens <= MAX_NEW_TOKENS:
+        raise InvalidChatRequestError(f"maxNewTokens must be an integer between 1 and {MAX_NEW_TOKENS}")
+    conversation_id = version = None
+    if 'conversationId' in body:
+        if conversation_store is None:
+            raise InvalidChatRequestError("conversationId is not supported (CONVERSATION_STORE is not configured)")
+        conversation_id = body['conversationId'] or str(uuid.uuid4())
+        conversation_history, version = conversation_store.load(conversation_id, user_id)
+        if body.get('version') is not None and body['version'] != version:
+            raise VersionConflictError(
+                f"会話 {conversation_id} は他のリクエストで更新されています (version {version})", version
+            )
+    else:
+        conversation_history = body.get('conversationHistory', [])
+    
+    # 会話履歴からトークン予算に収まる直近のメッセージを選び、コンテキストを構築
+    # 最後のユーザーメッセージを含む会話履歴から適切なプロンプトを作成
+    prompt = format_prompt_from_history(conversation_history, message, PROMPT_TOKEN_BUDGET)
+    trace.set(historyMessages=len(conversation_history), promptTokens=estimate_tokens(prompt))
+    
+    # FastAPIサーバーへのリクエストペイロードを作成
+    request_payload = {
+        "prompt": prompt,
+        "max_new_tokens": max_new_tokens,
+        "temperature": 0.7,
+        "top_p": 0.9,
+        "do_sample": True
+    }
+    if MODEL_ID and MODEL_ID != DEFAULT_MODEL_ID:
+        request_payload["model"] = MODEL_ID
+    if ENABLE_STOP_SEQUENCES:
+        request_payload["stop"] = STOP_SEQUENCES
+    if COALESCE_SAMPLED_REQUESTS:
+        request_payload["coalesce"] = True
+    if user_id:
+        request_payload["user"] = user_id
+    return ChatTurn(message, conversation_history, request_payload, bool(body.get('stream')),
+                    conversation_id, version, user_id, trace)
+
+def append_turn(conversation_history, message, assistant_response):
+    """
+    会話履歴にユーザーメッセージとアシスタントの応答を追加した新しいリストを返す
+    """
+    messages = list(conversation_history)
+    messages.append({"role": "user", "content": message})
+    messages.append({"role": "assistant", "content": assistant_response})
+    return messages
+
+def format_sse(event, data):
+    """Server-Sent Events の1イベント分の文字列を作成する (app.py と同じ形式)"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+def iter_sse_events(response):
+    """
+    SSEの応答を (イベント名, データ) の組として受け取った順に返す
+    
+    Args:
+        response (requests.Response): stream=True で受け取った応答
+    """
+    response.encoding = "utf-8"
+    event, data_lines = "message", []
+    for line in response.iter_lines(decode_unicode=True):
+        if not line:
+            if data_lines:
+                yield event, json.loads("\n".join(data_lines))
+            event, data_lines = "message", []
+        elif line.startswith("event:"):
+            event = line[len("event:"):].strip()
+        elif line.startswith("data:"):
+            data_lines.append(line[len("data:"):].strip())
+
+def stream_chat(turn, deadline=None):
+    """
+    FastAPIサーバーの /generate/stream を呼び出し、生成されたテキストをSSEのフレームとして順に返す
+    
+    token フレームで新しく生成されたテキストを返し、最後の done フレームで応答全体と
+    更新後の会話履歴を返す (まとめて返す場合の本文と同じ項目)。失敗した場合は error フレームで終わる。
+    
+    Args:
+        turn (ChatTurn): prepare_chat_request で作成した発言の情報
+        deadline (float): time.monotonic() 基準の期限
+    
+    Yields:
+        str: SSEのフレーム
+    """
+    trace = turn.trace
+    trace.set(stream=True)
+    try:
+        with trace.span("upstream"), upstream.stream("/generate/stream", turn.request_payload, deadline, trace.headers()) as response:
+            if response.status_code != 200:
+                error_msg = f"LLM API returned status code {response.status_code}: {response.text}"
+                trace.fail(error_msg)
+                error = {"success": False, "error": error_msg, "statusCode": response.status_code}
+                if response.headers.get("Retry-After"):
+                    # ヘッダーは送信済みのため、再試行できるまでの秒数はフレームで伝える
+                    error["retryAfter"] = response.headers["Retry-After"]
+                yield format_sse("error", error)
+                return
+            for event, data in iter_sse_events(response):
+                if event == "token":
+                    if "firstToken" not in trace.fields:
+                        trace.set(firstToken=round(time.monotonic() - trace.start, 4))
+                    yield format_sse("token", {"text": data.get("text", "")})
+                elif event == "done":
+                    assistant_response = data.get("generated_text", "")
+                    # ヘッダーを先に受け取るため、サーバーの内訳は done イベントの timings で受け取る
+                    trace.set_server_timings(data.get("timings"))
+                    trace.set(finishReason=data.get("finish_reason"), truncated=data.get("truncated") or None,
+                              generatedTokens=data.get("token_count"))
+                    try:
+                        with trace.span("store"):
+                            conversation = turn.complete(assistant_response)
+                    except VersionConflictError as e:
+                        trace.fail(f"Conversation version conflict: {e}")
+                        yield format_sse("error", {"success": False, "error": str(e), "statusCode": 409})
+                        return
+                    yield format_sse("done", {
+                        "success": True,
+                        "response": assistant_response,
+                        **conversation,
+                        "finishReason": data.get("finish_reason"),
+                        "truncated": bool(data.get("truncated")),
+                        "generatedTokens": data.get("token_count")
+                    })
+                    return
+                elif event == "error":
+                    trace.fail(data.get("detail", ""))
+                    yield format_sse("error", {"success": False, "error": data.get("detail", "")})
+                    return
+                if deadline is not None and time.monotonic() > deadline:
+                    trace.fail("応答の期限を過ぎました")
+                    yield format_sse("error", {"success": False, "error": "応答の期限を過ぎました"})
+                    return
+            trace.fail("LLM APIのストリームが途中で終了しました")
+            yield format_sse("error", {"success": False, "error": "LLM APIのストリームが途中で終了しました"})
+    except (UpstreamError, RequestException) as e:
+        error_msg = f"Request to LLM API failed: {str(e)}"
+        trace.fail(error_msg)
+        yield format_sse("error", {"success": False, "error": error_msg})
+
+def get_deadline(context):
+    """
+    サーバーへの要求を打ち切る期限を time.monotonic() 基準で返す
+
+    Args:
+        context: Lambdaのcontext (Noneの場合は UpstreamClient の timeout を使う)
+
+    Returns:
+        float: 期限 (contextがない場合はNone)
+    """
+    if context is None or not hasattr(context, "get_remaining_time_in_millis"):
+        return None
+    return time.monotonic() + context.get_remaining_time_in_millis() / 1000 - DEADLINE_MARGIN
+
+def estimate_tokens(text):
+    """
+    テキストのトークン数を推定する
+
+    日本語 (かな・漢字・全角文字) とそれ以外で1トークンあたりの文字数を変えて見積もる。
+    
+    Args:
+        text (str): 対象のテキスト
+    
+    Returns:
+        int: 推定トークン数
+    """
+    cjk_chars = len(CJK_PATTERN.findall(text))
+    other_chars = len(text) - cjk_chars
+    return int(cjk_chars / CJK_CHARS_PER_TOKEN + other_chars / ASCII_CHARS_PER_TOKEN + 0.999)
+
+def format_message_line(msg):
+    """
+    1件のメッセージをプロンプトの1行に変換する。対象外の役割の場合はNoneを返す
+    """
+    prefix = ROLE_PREFIXES.get(msg.get("role", ""))
+    if prefix is None:
+        return None
+    return f"{prefix}{msg.get('content', '')}\n"
+
+def format_prompt_from_history(conversation_history, new_message, token_budget=None):
     """
     会話履歴と新しいメッセージからプロンプトを作成する
+
+    token_budget を指定すると、システムコンテキストと新しいメッセージを必ず残したうえで、
+    予算に収まる範囲で直近のメッセージから順に会話履歴を含める。
     
     Args:
         conversation_history (list): これまでの会話履歴
         new_message (str): 新しいユーザーメッセージ
+        token_budget (int): プロンプト全体の推定トークン数の上限 (Noneの場合は無制限)
     
     Returns:
         str: フォーマットされたプロンプト
     """
-    formatted_history = ""
-    
-    # 会話履歴がある場合、それをフォーマット
-    if conversation_history:
-        for msg in conversation_history:
-            role = msg.get("role", "")
-            content = msg.get("content", "")
-            
-            if role == "user":
-                formatted_history += f"ユーザー: {content}\n"
-            elif role == "assistant":
-                formatted_history += f"アシスタント: {content}\n"
-    
+    pinned_lines = []
+    if SYSTEM_PROMPT:
+        pinned_lines.append(format_message_line({"role": "system", "content": SYSTEM_PROMPT}))
+
+    history_lines = []
+    for msg in conversation_history or []:
+        line = format_message_line(msg)
+        if line is None:
+            continue
+        if msg.get("role") == "system":
+            pinned_lines.append(line)
+        else:
+            history_lines.append((msg.get("role"), line))
+
     # 新しいメッセージを追加
-    formatted_history += f"ユーザー: {new_message}\nアシスタント: "
-    
-    return formatted_history
+    new_lines = [format_message_line({"role": "user", "content": new_message}), ROLE_PREFIXES["assistant"]]
+
+    if token_budget is not None:
+        remaining = token_budget - sum(estimate_tokens(line) for line in pinned_lines + new_lines)
+        # 直近のメッセージから予算に収まるだけ遡る
+        start = len(history_lines)
+        while start > 0:
+            cost = estimate_tokens(history_lines[start - 1][1])
+            if cost > remaining:
+                break
+            remaining -= cost
+            start -= 1
+        # ユーザーの発言から始まるように、先頭に残ったアシスタントの応答は除く
+        while start < len(history_lines) and history_lines[start][0] != "user":
+            start += 1
+        if start > 0:
+            print(f"Conversation history truncated: kept {len(history_lines) - start} of {len(history_lines)} messages")
+        history_lines = history_lines[start:]
+
+    # 各行をリストにまとめてから一度に連結する
+    return "".join(pinned_lines + [line for _, line in history_lines] + new_lines)
 
-def create_error_response(status_code, error_message):
+def create_error_response(status_code, error_message, headers=None):
     """
     エラーレスポンスを作成する
     
     Args:
         status_code (int): HTTPステータスコード
         error_message (str): エラーメッセージ
+        headers (dict): 追加で返すヘッダー (Retry-After など)
     
     Returns:
         dict: エラーレスポンス
     """
     return {
         "statusCode": status_code,
-        "headers": {
-            "Content-Type": "application/json",
-            "Access-Control-Allow-Origin": "*", 
-            "Access-Control-Allow-Headers": "Content-Type,X-Amz-Date,Authorization,X-Api-Key,X-Amz-Security-Token",
-            "Access-Control-Allow-Methods": "OPTIONS,POST"
-        },
+        "headers": {**CORS_HEADERS, "Content-Type": "application/json", **(headers or {})},
         "body": json.dumps({
             "success": False,
             "error": error_message
         })
     }
+
+# --- ストリーミング用のHTTPサーバー ---
+class ChatRequestHandler(BaseHTTPRequestHandler):
+    """
+    POST /chat (JSONをまとめて返す) と POST /chat/stream (SSEを逐次返す) を受け付ける
+
+    Lambda Web Adapter を応答ストリーミングのモード (AWS_LWA_INVOKE_MODE=response_stream) で使うと、
+    Lambda関数URLからブラウザにトークンを逐次返せる。ローカルではスタブのバックエンドを
+    API_BASE_URLS に指定して `python index.py` で起動し、動作を確認できる。
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def do_OPTIONS(self):
+        self.send_response(204)
+        for name, value in CORS_HEADERS.items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0))).decode("utf-8")
+        event = {"body": body, "requestContext": request_context_from_headers(self.headers)}
+        if self.path == "/chat":
+            result = lambda_handler(event, None)
+            self._send_body(result["statusCode"], result["headers"], result["body"])
+        elif self.path == "/chat/stream":
+            self._stream(event)
+        else:
+            self._send_body(404, {**CORS_HEADERS, "Content-Type": "application/json"}, json.dumps({"error": "Not Found"}))
+
+    def _send_body(self, status_code, headers, body):
+        data = body.encode("utf-8")
+        self.send_response(status_code)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _stream(self, event):
+        trace = create_trace(self.headers.get(REQUEST_ID_HEADER))
+        try:
+            with trace.span("prepare"):
+                turn = prepare_chat_request(event, trace)
+        except ConversationNotFoundError as e:
+            error = create_error_response(404, str(e))
+        except VersionConflictError as e:
+            error = create_error_response(409, str(e))
+        except (KeyError, ValueError) as e:
+            error = create_error_response(400, f"Invalid request: {e}")
+        else:
+            error = None
+        if error is not None:
+            trace.fail(json.loads(error["body"])["error"])
+            trace.emit(error["statusCode"])
+            self._send_body(error["statusCode"], {**error["headers"], REQUEST_ID_HEADER: trace.request_id}, error["body"])
+            return
+        self.send_response(200)
+        for name, value in CORS_HEADERS.items():
+            self.send_header(name, value)
+        self.send_header(REQUEST_ID_HEADER, trace.request_id)
+        self.send_header("Content-Type", "text/event-stream; charset=utf-8")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        self.close_connection = True
+        frames = stream_chat(turn, time.monotonic() + STREAM_TIMEOUT)
+        try:
+            for frame in frames:
+                # 1フレームずつ chunked エンコーディングで送り、すぐに送信する
+                data = frame.encode("utf-8")
+                self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+                self.wfile.flush()
+            self.wfile.write(b"0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            trace.fail("Client disconnected during streaming")
+        finally:
+            # バックエンドへの接続を閉じ、生成を続けさせない
+            frames.close()
+            trace.emit(200)
+
+def request_context_from_headers(headers):
+    """
+    Lambda Web Adapter が渡す x-amzn-request-context ヘッダーから requestContext を復元する
+    (ローカルで起動した場合など、ヘッダーがなければ空の辞書)
+    """
+    value = headers.get("x-amzn-request-context")
+    if not value:
+        return {}
+    try:
+        return json.loads(value)
+    except ValueError:
+        return {}
+
+def run_stream_server(port=STREAM_SERVER_PORT):
+    """ストリーミング用のHTTPサーバーを起動する"""
+    server = ThreadingHTTPServer(("0.0.0.0", port), ChatRequestHandler)
+    print(f"Chat stream server listening on port {port} (backends: {upstream.describe()})")
+    server.serve_forever()
+
+if __name__ == "__main__":
+    run_stream_server()
@@ -0,0 +1,115 @@
+# lambda/tracing.py
+import json
+import random
+import time
+import uuid
+from contextlib import contextmanager
+
+# リクエストIDを LLM APIサーバー (app.py) に渡すヘッダー
+REQUEST_ID_HEADER = "X-Request-ID"
+
+def parse_server_timing(header):
+    """
+    Server-Timing ヘッダーを {段階名: 秒} の辞書にする
+
+    Args:
+        header (str): "queue;dur=12.5, prefill;dur=80.1" の形式 (dur はミリ秒)
+
+    Returns:
+        dict: 段階名と秒数 (ヘッダーがない場合は空の辞書)
+    """
+    stages = {}
+    for item in (header or "").split(","):
+        name, *params = [part.strip() for part in item.split(";")]
+        for param in params:
+            key, _, value = param.partition("=")
+            if name and key == "dur":
+                try:
+                    stages[name] = float(value) / 1000
+                except ValueError:
+                    pass
+    return stages
+
+class RequestTrace:
+    """
+    Lambdaでの1リクエスト分の処理時間の内訳と属性を集め、最後に1行の構造化ログとして出力する
+
+    span で計測した区間と、サーバーが返した段階ごとの所要時間 (server) を合わせて記録する。
+    LLM APIへの要求の時間からサーバーでの合計時間を引いた残りを、ネットワーク (ngrokのトンネルなど) の時間とみなす。
+    ログの本文は出力すると決まった時点で初めて作成する (エラーと遅いリクエストは常に、それ以外は sample_rate の割合で出力する)。
+    """
+
+    def __init__(self, request_id=None, sample_rate=1.0, slow_threshold=None):
+        self.request_id = request_id or uuid.uuid4().hex
+        self.sample_rate = sample_rate
+        self.slow_threshold = slow_threshold
+        self.start = time.monotonic()
+        self.spans = {}
+        self.server = {}
+        self.fields = {}
+        self.error = None
+        self.emitted = False
+
+    @contextmanager
+    def span(self, name):
+        """with の区間の所要時間を name に加算する"""
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.spans[name] = self.spans.get(name, 0.0) + time.monotonic() - start
+
+    def set(self, **fields):
+        """ログに含める属性を記録する (Noneの値は含めない)"""
+        self.fields.update({key: value for key, value in fields.items() if value is not None})
+
+    def set_server_timings(self, timings):
+        """サーバーの段階ごとの所要時間 (秒) を記録する (Server-Timing ヘッダーまたは done イベントの timings)"""
+        if timings:
+            self.server = {name: seconds for name, seconds in timings.items() if seconds is not None}
+
+    def fail(self, error):
+        self.error = str(error)
+
+    def headers(self):
+        """LLM APIへの要求に付けるヘッダー"""
+        return {REQUEST_ID_HEADER: self.request_id}
+
+    def should_log(self, duration):
+        if self.error is not None:
+            return True
+        if self.slow_threshold is not None and duration >= self.slow_threshold:
+            return True
+        return random.random() < self.sample_rate
+
+    def emit(self, status_code):
+        """
+        サンプリングの対象であれば1行のJSONとして出力する (2回目以降の呼び出しは何もしない)
+
+        Args:
+            status_code (int): クライアントに返したステータスコード
+
+        Returns:
+            bool: 出力した場合はTrue
+        """
+        if self.emitted:
+            return False
+        self.emitted = True
+        duration = time.monotonic() - self.start
+        if not self.should_log(duration):
+            return False
+        record = {
+            "requestId": self.request_id,
+            "status": status_code,
+            "duration": round(duration, 4),
+            "spans": {name: round(seconds, 4) for name, seconds in self.spans.items()},
+        }
+        if self.server:
+            record["server"] = {name: round(seconds, 4) for name, seconds in self.server.items()}
+            if "upstream" in self.spans and "total" in self.server:
+                record["network"] = round(max(self.spans["upstream"] - self.server["total"], 0.0), 4)
+        record.update(self.fields)
+        if self.error is not None:
+            record["error"] = self.error
+        print(json.dumps(record, ensure_ascii=False, separators=(",", ":"), default=str))
+        return True
@@ -0,0 +1,354 @@
+# lambda/upstream.py
+import contextlib
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.exceptions import RequestException
+
+# 別のバックエンドで再試行するステータスコード (混雑・モデル読み込み中・ゲートウェイのエラー)
+RETRYABLE_STATUS_CODES = (429, 500, 502, 503, 504)
+
+# ユーザーごとの利用量の上限による429に付くヘッダー
+# (別のバックエンドで再試行すると上限がバックエンドの数だけ増えるため、再試行せずにそのまま返す)
+QUOTA_EXCEEDED_HEADER = "X-Quota-Exceeded"
+
+# 接続の確立を待つ秒数 (応答の待ち時間は期限までの残り時間)
+CONNECT_TIMEOUT = 3.05
+
+class UpstreamError(Exception):
+    """どのバックエンドからも応答を得られなかった"""
+
+    def __init__(self, message, deadline_exceeded=False):
+        super().__init__(message)
+        self.deadline_exceeded = deadline_exceeded
+
+def is_retryable(response):
+    """別のバックエンドで再試行する応答か (利用量の上限による429は再試行しない)"""
+    if response.status_code == 429 and response.headers.get(QUOTA_EXCEEDED_HEADER):
+        return False
+    return response.status_code in RETRYABLE_STATUS_CODES
+
+class Backend:
+    """
+    1台のバックエンドの状態 (処理中の要求数と受動的なヘルスチェック)
+
+    連続して failure_threshold 回失敗するとサーキットを開き、cooldown 秒は要求を送らない。
+    期限が過ぎたら1件だけ試しに送り (半開)、成功すれば閉じ、失敗すれば待ち時間を倍にして再び開く。
+    """
+
+    def __init__(self, url, failure_threshold=3, cooldown=10.0, max_cooldown=60.0):
+        self.url = url.rstrip("/")
+        self.failure_threshold = failure_threshold
+        self.base_cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.cooldown = cooldown
+        self.outstanding = 0
+        self.consecutive_failures = 0
+        self.open_until = None  # サーキットが開いている期限 (閉じている場合はNone)
+        self.probing = False  # 半開状態で試しの要求を送っている
+        self.latency = None  # 応答時間の指数移動平均 (秒)
+        self.stats = {"requests": 0, "failures": 0, "circuit_opens": 0}
+
+    def available(self, now):
+        if self.open_until is None:
+            return True
+        return now >= self.open_until and not self.probing
+
+    def record_success(self, latency):
+        self.consecutive_failures = 0
+        self.open_until = None
+        self.probing = False
+        self.cooldown = self.base_cooldown
+        self.latency = latency if self.latency is None else 0.8 * self.latency + 0.2 * latency
+
+    def record_failure(self, now):
+        self.consecutive_failures += 1
+        self.stats["failures"] += 1
+        if self.probing or self.consecutive_failures >= self.failure_threshold:
+            if self.probing:
+                self.cooldown = min(self.cooldown * 2, self.max_cooldown)
+            self.open_until = now + self.cooldown
+            self.probing = False
+            self.stats["circuit_opens"] += 1
+
+    def summary(self, now):
+        if self.open_until is None:
+            state = "closed"
+        elif now < self.open_until:
+            state = "open"
+        else:
+            state = "half_open"
+        return {
+            "url": self.url,
+            "state": state,
+            "outstanding": self.outstanding,
+            "latency": self.latency,
+            **self.stats,
+        }
+
+class UpstreamClient:
+    """
+    LLM APIサーバー (app.py) への要求を複数のバックエンドに振り分けるクライアント
+
+    モジュールの読み込み時に1回だけ作成し、Lambdaのウォームスタート間で
+    keep-alive の接続を再利用する。要求は処理中の要求が最も少ないバックエンドに送り、
+    失敗した場合は期限の範囲内で別のバックエンドに再試行する。
+    hedge_after 秒経っても応答がない場合は、別のバックエンドにも同じ要求を送り、先に返った応答を使う。
+    server_deadline_margin を指定すると、送るたびに期限までの残り秒数からこの秒数を引いた値を
+    payload の timeout に設定し、サーバーが期限の前に生成を打ち切って途中までの応答を返せるようにする。
+    """
+
+    def __init__(self, base_urls, timeout=30.0, max_attempts=3, hedge_after=0.0,
+                 failure_threshold=3, cooldown=10.0, pool_size=10, session=None, server_deadline_margin=None):
+        if not base_urls:
+            raise ValueError("バックエンドのURLが指定されていません")
+        self.backends = [Backend(url, failure_threshold, cooldown) for url in base_urls]
+        self.timeout = timeout
+        self.server_deadline_margin = server_deadline_margin
+        self.max_attempts = max_attempts
+        self.hedge_after = hedge_after
+        self.session = session or self._create_session(pool_size)
+        self._lock = threading.Lock()
+        # ヘッジする場合に最初の要求とヘッジした要求を並行して送るためのスレッド
+        # (接続プールと同じだけ、バックエンドごとに pool_size 件まで同時に送れるようにする。
+        #  ヘッジしない場合は呼び出し元のスレッドで送るため使わない)
+        self._executor = None
+        if hedge_after > 0:
+            self._executor = ThreadPoolExecutor(max_workers=pool_size * len(self.backends), thread_name_prefix="upstream")
+        self.stats = {"requests": 0, "retries": 0, "hedged": 0, "hedge_wins": 0, "failed": 0}
+
+    @staticmethod
+    def _create_session(pool_size):
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
+
+    def _with_timeout(self, payload, deadline, now):
+        """サーバーに伝える生成の期限 (残り秒数) を設定した payload を返す"""
+        if self.server_deadline_margin is None:
+            return payload
+        # 期限を過ぎていても、サーバーがすぐに打ち切れるよう正の値を送る
+        return {**payload, "timeout": max(deadline - now - self.server_deadline_margin, 0.1)}
+
+    def describe(self):
+        return ", ".join(backend.url for backend in self.backends)
+
+    def post_json(self, path, payload, deadline=None, headers=None):
+        """
+        JSONをPOSTし、応答を返す
+
+        再試行の対象のステータスコードで全ての試行が終わった場合は、最後の応答を返す。
+
+        Args:
+            path (str): "/generate" のようなパス
+            payload (dict): 送信するJSON
+            deadline (float): time.monotonic() 基準の期限 (Noneの場合は timeout 秒後)
+            headers (dict): 追加で送るヘッダー (リクエストIDなど)
+
+        Returns:
+            requests.Response: バックエンドの応答
+
+        Raises:
+            UpstreamError: どのバックエンドからも応答を得られなかった場合
+        """
+        if deadline is None:
+            deadline = time.monotonic() + self.timeout
+        self.stats["requests"] += 1
+        tried = []
+        response = error = None
+        for attempt in range(self.max_attempts):
+            if attempt:
+                delay = self._backoff(attempt, response, deadline)
+                if delay is None:
+                    break
+                self.stats["retries"] += 1
+                time.sleep(delay)
+            backend, response, attempt_error = self._attempt(path, payload, deadline, tried, headers)
+            if response is not None and not is_retryable(response):
+                return response
+            if backend is None:
+                # 送り先がなくなった場合は、直前の試行の失敗理由を残す
+                error = error or attempt_error
+                break
+            error = attempt_error
+            tried.append(backend)
+        if response is not None:
+            return response
+        self.stats["failed"] += 1
+        if time.monotonic() >= deadline:
+            raise UpstreamError(f"期限までにLLM APIから応答がありませんでした ({len(tried)}回試行)", deadline_exceeded=True)
+        raise UpstreamError(f"LLM APIへの要求に失敗しました: {error}")
+
+    def _backoff(self, attempt, response, deadline):
+        """次の試行までの待ち時間。期限までに再試行できない場合はNone"""
+        delay = min(0.1 * 2 ** (attempt - 1), 1.0) * random.uniform(0.5, 1.0)
+        # 他に試せるバックエンドがなく、サーバーが Retry-After を返した場合はそれに従う
+        if response is not None and len(self.backends) == 1:
+            retry_after = response.headers.get("Retry-After")
+            if retry_after and retry_after.isdigit():
+                delay = max(delay, float(retry_after))
+        if time.monotonic() + delay >= deadline:
+            return None
+        return delay
+
+    def _pick(self, exclude):
+        """処理中の要求が最も少ないバックエンドを選ぶ (試していないものを優先する)"""
+        now = time.monotonic()
+        with self._lock:
+            candidates = [backend for backend in self.backends if backend.available(now)]
+            untried = [backend for backend in candidates if backend not in exclude]
+            candidates = untried or candidates
+            if not candidates:
+                return None
+            backend = min(candidates, key=lambda b: (b.outstanding, b.latency or 0.0, random.random()))
+            if backend.open_until is not None:
+                backend.probing = True
+            backend.outstanding += 1
+            backend.stats["requests"] += 1
+            return backend
+
+    def _record(self, backend, start, response):
+        """応答の結果をバックエンドの状態に反映する (応答がない場合は失敗)"""
+        with self._lock:
+            # 5xx はサーバー側の異常、それ以外 (429を含む) はバックエンド自体は正常とみなす
+            if response is None or response.status_code >= 500:
+                backend.record_failure(time.monotonic())
+            else:
+                backend.record_success(time.monotonic() - start)
+
+    def _release(self, backend):
+        with self._lock:
+            backend.outstanding -= 1
+
+    def _send(self, backend, path, payload, deadline, headers=None):
+        """1台のバックエンドに要求を送り、(backend, 応答, 例外) を返す"""
+        start = time.monotonic()
+        try:
+            response = self.session.post(
+                backend.url + path,
+                json=self._with_timeout(payload, deadline, start),
+                headers=headers,
+                timeout=(CONNECT_TIMEOUT, max(deadline - start, 0.1))
+            )
+        except RequestException as e:
+            self._record(backend, start, None)
+            return backend, None, e
+        finally:
+            self._release(backend)
+        self._record(backend, start, response)
+        return backend, response, None
+
+    @contextlib.contextmanager
+    def stream(self, path, payload, deadline=None, headers=None):
+        """
+        本文を逐次受け取る要求を送り、読み終えるまで接続を保持する
+
+        本文を受け取り始めた後は再試行できないため、ヘッジはせず、応答のヘッダーを
+        受け取るまでの失敗だけを別のバックエンドで再試行する。
+
+        Args:
+            path (str): "/generate/stream" のようなパス
+            payload (dict): 送信するJSON
+            deadline (float): time.monotonic() 基準の期限 (Noneの場合は timeout 秒後)
+            headers (dict): 追加で送るヘッダー (リクエストIDなど)
+
+        Yields:
+            requests.Response: stream=True で受け取った応答
+
+        Raises:
+            UpstreamError: どのバックエンドからも応答を得られなかった場合
+        """
+        if deadline is None:
+            deadline = time.monotonic() + self.timeout
+        self.stats["requests"] += 1
+        tried = []
+        backend = response = error = None
+        for attempt in range(self.max_attempts):
+            if attempt:
+                delay = self._backoff(attempt, response, deadline)
+                if delay is None:
+                    break
+                self.stats["retries"] += 1
+                time.sleep(delay)
+            candidate = self._pick(tried)
+            if candidate is None:
+                break
+            if response is not None:
+                # 再試行するため、前の応答を閉じる
+                response.close()
+                self._release(backend)
+            backend, response = candidate, None
+            tried.append(backend)
+            start = time.monotonic()
+            try:
+                response = self.session.post(
+                    backend.url + path,
+                    json=self._with_timeout(payload, deadline, start),
+                    headers=headers,
+                    stream=True,
+                    timeout=(CONNECT_TIMEOUT, max(deadline - start, 0.1))
+                )
+            except RequestException as e:
+                error = e
+                self._record(backend, start, None)
+                self._release(backend)
+                continue
+            self._record(backend, start, response)
+            if not is_retryable(response):
+                break
+        if response is None:
+            self.stats["failed"] += 1
+            if time.monotonic() >= deadline:
+                raise UpstreamError(f"期限までにLLM APIから応答がありませんでした ({len(tried)}回試行)", deadline_exceeded=True)
+            raise UpstreamError(f"LLM APIへの要求に失敗しました: {error or '利用できるバックエンドがありません'}")
+        try:
+            yield response
+        finally:
+            response.close()
+            self._release(backend)
+
+    def _attempt(self, path, payload, deadline, exclude, headers=None):
+        """1回の試行。hedge_after 秒応答がなければ別のバックエンドにも送り、先に成功した応答を返す"""
+        primary = self._pick(exclude)
+        if primary is None:
+            return None, None, UpstreamError("利用できるバックエンドがありません (全てのサーキットが開いています)")
+        if self._executor is None:
+            return self._send(primary, path, payload, deadline, headers)
+        pending = {self._executor.submit(self._send, primary, path, payload, deadline, headers)}
+        hedge_at = time.monotonic() + self.hedge_after if self.hedge_after > 0 else None
+        result = (primary, None, UpstreamError("期限までに応答がありませんでした"))
+        while pending:
+            until = deadline if hedge_at is None else min(deadline, hedge_at)
+            done, pending = wait(pending, timeout=max(until - time.monotonic(), 0), return_when=FIRST_COMPLETED)
+            for future in done:
+                result = future.result()
+                backend, response, _ = result
+                if response is not None and not is_retryable(response):
+                    if backend is not primary:
+                        self.stats["hedge_wins"] += 1
+                    return result
+            if hedge_at is not None and time.monotonic() >= hedge_at:
+                hedge_at = None
+                backup = self._pick(exclude + [primary])
+                if backup is not None and backup is not primary:
+                    self.stats["hedged"] += 1
+                    pending.add(self._executor.submit(self._send, backup, path, payload, deadline, headers))
+                elif backup is primary:
+                    # 他に送り先がない場合は、選んだ分の処理中の数を戻す
+                    with self._lock:
+                        backup.outstanding -= 1
+                        backup.stats["requests"] -= 1
+            elif not done and time.monotonic() >= deadline:
+                break
+        return result
+
+    def summary(self):
+        now = time.monotonic()
+        with self._lock:
+            return {**self.stats, "backends": [backend.summary(now) for backend in self.backends]}
@@ -4,6 +4,7 @@ import { Construct } from 'constructs';
 import * as lambda from 'aws-cdk-lib/aws-lambda';
 import * as apigateway from 'aws-cdk-lib/aws-apigateway';
 import * as iam from 'aws-cdk-lib/aws-iam';
+import * as dynamodb from 'aws-cdk-lib/aws-dynamodb';
 import * as s3 from 'aws-cdk-lib/aws-s3';
 import * as s3deploy from 'aws-cdk-lib/aws-s3-deployment';
 import * as cloudfront from 'aws-cdk-lib/aws-cloudfront';
@@ -21,7 +22,7 @@ export class BedrockChatbotStack extends cdk.Stack {
   constructor(scope: Construct, id: string, props?: BedrockChatbotStackProps) {
     super(scope, id, props);
 
-    const modelId = props?.modelId || 'us.amazon.nova-lite-v1:0';
+    const modelId = props?.modelId || 'local-model';
 
     // Cognito User Poolの作成
     const userPool = new cognito.UserPool(this, 'ChatbotUserPool', {
@@ -148,6 +149,14 @@ export class BedrockChatbotStack extends cdk.Stack {
       resources: ['*']
     }));
 
+    // 会話IDのモードで会話履歴を保持するテーブル (lambda/conversation_store.py の DynamoDBConversationStore)
+    const conversationTable = new dynamodb.Table(this, 'ConversationTable', {
+      partitionKey: { name: 'conversationId', type: dynamodb.AttributeType.STRING },
+      billingMode: dynamodb.BillingMode.PAY_PER_REQUEST,
+      removalPolicy: cdk.RemovalPolicy.DESTROY,
+    });
+    conversationTable.grantReadWriteData(lambdaRole);
+
     // Lambda function
     const chatFunction = new lambda.Function(this, 'ChatFunction', {
       runtime: lambda.Runtime.PYTHON_3_10,
@@ -158,6 +167,7 @@ export class BedrockChatbotStack extends cdk.Stack {
       role: lambdaRole,
       environment: {
         MODEL_ID: modelId,
+        CONVERSATION_STORE: `dynamodb:${conversationTable.tableName}`,
       },
     });
 
@@ -0,0 +1,161 @@
+# tests/conftest.py
+"""
+lambda/ のモジュールを、ローカルで起動したスタブのバックエンドに対して試験するための共通の準備と、
+app.py の推論ワーカーを小さなランダム重みのモデルで試験するための準備
+"""
+import json
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+LAMBDA_DIR = os.path.join(ROOT_DIR, "lambda")
+for path in (LAMBDA_DIR, ROOT_DIR):
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+class StubReply:
+    """
+    スタブのバックエンドが返す応答
+
+    events を指定した場合は、SSEの (イベント名, データ) を interval 秒おきに1つずつ送る。
+    """
+
+    def __init__(self, status=200, body=None, headers=None, delay=0.0, events=None, interval=0.0):
+        self.status = status
+        self.body = body if body is not None else {"generated_text": "こんにちは", "generated_tokens": 3}
+        self.headers = headers or {}
+        self.delay = delay
+        self.events = events
+        self.interval = interval
+
+class StubBackend:
+    """
+    app.py の代わりに要求を受けるHTTPサーバー
+
+    受け取った (パス, JSON) を requests に記録し、reply(path, payload) が返す StubReply で応答する。
+    同時に処理している要求数の最大値を max_in_flight に記録する。
+    """
+
+    def __init__(self):
+        self.requests = []
+        self.reply = lambda path, payload: StubReply()
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._lock = threading.Lock()
+        backend = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                payload = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                with backend._lock:
+                    backend.requests.append((self.path, payload))
+                    backend.in_flight += 1
+                    backend.max_in_flight = max(backend.max_in_flight, backend.in_flight)
+                try:
+                    reply = backend.reply(self.path, payload)
+                    time.sleep(reply.delay)
+                    if reply.events is not None:
+                        self._send_events(reply)
+                    else:
+                        self._send_json(reply)
+                except OSError:
+                    # クライアントが先に接続を閉じた (ヘッジで使われなかった要求など)
+                    pass
+                finally:
+                    with backend._lock:
+                        backend.in_flight -= 1
+
+            def _send_json(self, reply):
+                data = json.dumps(reply.body, ensure_ascii=False).encode("utf-8")
+                self.send_response(reply.status)
+                for name, value in reply.headers.items():
+                    self.send_header(name, value)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _send_events(self, reply):
+                # app.py (uvicorn) と同じく chunked エンコーディングで1イベントずつ送る
+                self.send_response(reply.status)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                for event, data in reply.events:
+                    frame = f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n".encode("utf-8")
+                    self.wfile.write(b"%x\r\n%s\r\n" % (len(frame), frame))
+                    self.wfile.flush()
+                    time.sleep(reply.interval)
+                self.wfile.write(b"0\r\n\r\n")
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.server.server_port}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def paths(self):
+        return [path for path, _ in self.requests]
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+@pytest.fixture
+def stub_backends():
+    """stub_backends(n) で n 台のスタブのバックエンドを起動する (試験の終了時に停止する)"""
+    backends = []
+
+    def start(count=1):
+        started = [StubBackend() for _ in range(count)]
+        backends.extend(started)
+        return started
+
+    yield start
+    for backend in backends:
+        backend.close()
+
+@pytest.fixture
+def dead_url():
+    """接続を受け付けないURL (使われていないポート)"""
+    server = ThreadingHTTPServer(("127.0.0.1", 0), BaseHTTPRequestHandler)
+    url = f"http://127.0.0.1:{server.server_port}"
+    server.server_close()
+    return url
+
+@pytest.fixture(scope="session")
+def tiny_pipe(tmp_path_factory):
+    """
+    ランダム重みの小さなGPT-2と、その場で学習したBPEトークナイザーのpipeline
+
+    モデルをダウンロードせずに app.py の推論ワーカーを動かすために使う (出力の内容に意味はない)。
+    """
+    import torch
+    from tokenizers import Tokenizer, decoders, models, pre_tokenizers, trainers
+    from transformers import GPT2Config, GPT2LMHeadModel, PreTrainedTokenizerFast, pipeline
+
+    tokenizer = Tokenizer(models.BPE())
+    tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer.decoder = decoders.ByteLevel()
+    trainer = trainers.BpeTrainer(vocab_size=300, special_tokens=["<eos>"],
+                                  initial_alphabet=pre_tokenizers.ByteLevel.alphabet())
+    tokenizer.train_from_iterator(["ユーザー: こんにちは\nアシスタント: はい、こんにちは。"] * 20, trainer)
+    fast_tokenizer = PreTrainedTokenizerFast(tokenizer_object=tokenizer, eos_token="<eos>", bos_token="<eos>")
+
+    torch.manual_seed(0)
+    # 初期値の分散を大きくし、ランダム重みでも同じトークンの繰り返しにならず文脈で出力が変わるようにする
+    model_config = GPT2Config(vocab_size=len(fast_tokenizer), n_positions=256, n_embd=32, n_layer=2, n_head=2,
+                              initializer_range=2.0, eos_token_id=0, bos_token_id=0)
+    model_dir = tmp_path_factory.mktemp("tiny-model")
+    fast_tokenizer.save_pretrained(model_dir)
+    GPT2LMHeadModel(model_config).save_pretrained(model_dir)
+    return pipeline("text-generation", model=str(model_dir))
@@ -0,0 +1,98 @@
+# tests/test_app_engine.py
+"""app.py の推論ワーカー (連続バッチングエンジンと逐次推論ワーカー) を小さなランダム重みのモデルで試験する"""
+import pytest
+
+import app
+
+PROMPTS = ["こんにちは", "ユーザー: こんにちは\nアシスタント:", "はい"]
+
+def greedy_request(prompt, max_new_tokens=8, **kwargs):
+    # eos で早く終わらないよう、常に max_new_tokens まで生成させる
+    return app.SimpleGenerationRequest(prompt=prompt, max_new_tokens=max_new_tokens, min_new_tokens=max_new_tokens,
+                                       do_sample=False, **kwargs)
+
+def submit_all(worker, requests):
+    """requests を投入し、(生成したトークンIDを集めるリスト, Future) のリストを返す"""
+    submitted = []
+    for request in requests:
+        tokens = []
+        submitted.append((tokens, worker.submit(request, on_token=tokens.append)))
+    return submitted
+
+def generate_tokens(worker, requests):
+    """requests をまとめて投入し、それぞれが生成したトークンIDのリストを返す"""
+    submitted = submit_all(worker, requests)
+    for _, future in submitted:
+        future.result(timeout=60)
+    return [tokens for tokens, _ in submitted]
+
+@pytest.fixture
+def engine(tiny_pipe):
+    engine = app.ContinuousBatchingEngine(tiny_pipe, max_batch_size=4, max_batched_tokens=1024)
+    yield engine
+    engine.shutdown()
+
+def test_batched_generation_matches_single_requests(engine):
+    # 起動前に投入し、長さの異なるプロンプトを左詰めでパディングした1つのバッチで生成させる
+    submitted = submit_all(engine, [greedy_request(prompt) for prompt in PROMPTS])
+    engine.start()
+    for _, future in submitted:
+        future.result(timeout=60)
+    batched = [tokens for tokens, _ in submitted]
+    assert engine.stats["max_running"] == len(PROMPTS)
+
+    singles = [generate_tokens(engine, [greedy_request(prompt)])[0] for prompt in PROMPTS]
+    assert batched == singles
+    assert all(len(tokens) == 8 for tokens in batched)
+
+def test_request_joining_running_batch_matches_single_request(engine):
+    engine.start()
+    alone = generate_tokens(engine, [greedy_request(PROMPTS[1])])[0]
+
+    # 長い生成の途中で追加したリクエストも、KVキャッシュを結合した後で単独と同じ結果になる
+    long_future = engine.submit(greedy_request(PROMPTS[0], max_new_tokens=200))
+    joined = generate_tokens(engine, [greedy_request(PROMPTS[1])])[0]
+    long_future.result(timeout=60)
+    assert engine.stats["max_running"] == 2
+    assert joined == alone
+
+def test_expired_deadline_is_rejected_before_generation(engine):
+    control = app.GenerationControl(deadline=0)
+    future = engine.submit(greedy_request(PROMPTS[0]), control=control)
+    engine.start()
+
+    with pytest.raises(app.DeadlineExceededError):
+        future.result(timeout=60)
+    assert not control.started
+
+def test_cancelled_generation_stops_and_counts_tokens(engine):
+    engine.start()
+    control = app.GenerationControl()
+    tokens = []
+
+    def cancel_after_three(token_id):
+        tokens.append(token_id)
+        if len(tokens) == 3:
+            control.cancel()
+
+    result = engine.submit(greedy_request(PROMPTS[0], max_new_tokens=50), on_token=cancel_after_three,
+                           control=control).result(timeout=60)
+    assert result.finish_reason == "cancelled"
+    assert len(tokens) < 50
+    assert control.started and control.generated_tokens == len(tokens)
+
+def test_sequential_worker_batches_only_matching_requests(tiny_pipe):
+    worker = app.SequentialInferenceWorker(tiny_pipe, max_batch_size=4, fair_scheduling=False)
+    requests = [greedy_request(prompt, max_new_tokens=6 if i % 2 else 4) for i, prompt in enumerate(PROMPTS * 2)]
+    futures = [worker.submit(request) for request in requests]
+    worker.start()
+    try:
+        for future in futures:
+            future.result(timeout=60)
+    finally:
+        worker.shutdown()
+
+    # max_new_tokens が同じもの同士でだけまとめる (4件と2件の2回の pipeline 呼び出し)
+    assert worker.stats["batches"] == 2
+    assert worker.stats["completed_requests"] == len(requests)
+    assert worker.queue_depth == 0
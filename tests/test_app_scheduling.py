@@ -0,0 +1,108 @@
+# tests/test_app_scheduling.py
+"""app.py の公平キュー (FairQueue) と同一リクエストの相乗り (SingleFlight) を試験する"""
+import asyncio
+
+import app
+
+def push_all(queue, items):
+    for user, name in items:
+        queue.push(name, user)
+
+def test_fair_queue_interleaves_users():
+    queue = app.FairQueue()
+    push_all(queue, [("alice", "a1"), ("alice", "a2"), ("alice", "a3"), ("bob", "b1"), ("bob", "b2")])
+
+    # 先に大量に投入したユーザーの後ろに並ばされず、同じユーザーの中では投入順になる
+    assert [queue.pop() for _ in range(len(queue))] == ["a1", "b1", "a2", "b2", "a3"]
+
+def test_fair_queue_weights_and_costs():
+    queue = app.FairQueue(weights={"bob": 2.0})
+    queue.push("a1", "alice", cost=2)
+    queue.push("a2", "alice", cost=2)
+    queue.push("b1", "bob", cost=2)
+    queue.push("b2", "bob", cost=2)
+
+    # bob は重みが2倍のため、同じコストのリクエストを2件処理する間に alice は1件
+    assert [queue.pop() for _ in range(len(queue))] == ["b1", "a1", "b2", "a2"]
+
+def test_fair_queue_disabled_is_fifo():
+    queue = app.FairQueue(enabled=False)
+    push_all(queue, [("alice", "a1"), ("alice", "a2"), ("bob", "b1")])
+    assert [queue.pop() for _ in range(len(queue))] == ["a1", "a2", "b1"]
+
+def test_pop_matching_leaves_other_items_in_fair_order():
+    queue = app.FairQueue()
+    push_all(queue, [("alice", "a1-x"), ("alice", "a2-y"), ("alice", "a3-x"), ("bob", "b1-y"), ("bob", "b2-x")])
+
+    assert queue.pop_matching(lambda item: item.endswith("x"), 2) == ["a1-x", "b2-x"]
+    assert [queue.pop() for _ in range(len(queue))] == ["b1-y", "a2-y", "a3-x"]
+
+def run_with_single_flight(scenario):
+    """scenario(single_flight) をイベントループで実行し、その結果を返す"""
+    return asyncio.run(scenario(app.SingleFlight()))
+
+def test_follower_extends_leader_deadline_and_shares_result():
+    async def scenario(single_flight):
+        release = asyncio.Event()
+        leader_control = app.GenerationControl(deadline=100.0)
+
+        async def generate():
+            await release.wait()
+            return "応答"
+
+        leader = asyncio.ensure_future(single_flight.run("key", generate, control=leader_control))
+        await asyncio.sleep(0)
+        follower = asyncio.ensure_future(single_flight.run("key", generate, control=app.GenerationControl(200.0)))
+        await asyncio.sleep(0)
+        deadline_after_follower = leader_control.deadline
+        release.set()
+        return await leader, await follower, deadline_after_follower, single_flight.summary()
+
+    leader, follower, deadline, summary = run_with_single_flight(scenario)
+    assert leader == ("応答", False)
+    assert follower == ("応答", True)
+    # 期限の短い先行リクエストに合わせて、相乗りしたリクエストの応答が打ち切られない
+    assert deadline == 200.0
+    assert summary == {"leaders": 1, "coalesced": 1, "abandoned": 0, "in_flight": 0}
+
+def test_leader_disconnect_does_not_cancel_followers():
+    async def scenario(single_flight):
+        release = asyncio.Event()
+        control = app.GenerationControl()
+
+        async def generate():
+            await release.wait()
+            return "応答"
+
+        leader = asyncio.ensure_future(single_flight.run("key", generate, control=control))
+        await asyncio.sleep(0)
+        follower = asyncio.ensure_future(single_flight.run("key", generate, control=app.GenerationControl()))
+        await asyncio.sleep(0)
+        leader.cancel()
+        await asyncio.sleep(0)
+        release.set()
+        return await follower, control.cancelled
+
+    follower, cancelled = run_with_single_flight(scenario)
+    assert follower == ("応答", True)
+    assert not cancelled
+
+def test_abandoned_generation_is_cancelled_and_not_joined():
+    async def scenario(single_flight):
+        control = app.GenerationControl()
+        never = asyncio.Event()
+
+        first = asyncio.ensure_future(single_flight.run("key", never.wait, control=control))
+        await asyncio.sleep(0)
+        first.cancel()
+        await asyncio.sleep(0)
+        # 全員が切断したら生成を中止し、以降の同じリクエストは中止された生成に相乗りしない
+        retry = await asyncio.wait_for(
+            single_flight.run("key", lambda: asyncio.sleep(0, result="応答"), control=app.GenerationControl()), 5
+        )
+        return retry, control.cancelled, single_flight.summary()
+
+    retry, cancelled, summary = run_with_single_flight(scenario)
+    assert retry == ("応答", False)
+    assert cancelled
+    assert summary == {"leaders": 2, "coalesced": 0, "abandoned": 1, "in_flight": 0}
@@ -0,0 +1,59 @@
+# tests/test_app_usage.py
+"""app.py のユーザーごとの利用量の上限 (UserUsageTracker) を試験する"""
+import pytest
+
+import app
+
+def test_reservation_over_limit_is_rejected_with_retry_after():
+    tracker = app.UserUsageTracker(tokens_per_minute=100)
+    tracker.reserve("alice", 80)
+
+    with pytest.raises(app.QuotaExceededError) as e:
+        tracker.reserve("alice", 30)
+    assert 1 <= e.value.retry_after <= tracker.WINDOW + 1
+    # 他のユーザーの利用量には影響しない
+    tracker.reserve("bob", 100)
+    assert tracker.usage("alice")["rejected"] == 1
+
+def test_single_request_over_limit_is_accepted_when_idle():
+    tracker = app.UserUsageTracker(tokens_per_minute=100)
+    tracker.reserve("alice", 500)
+    with pytest.raises(app.QuotaExceededError):
+        tracker.reserve("alice", 1)
+
+def test_settle_replaces_reservation_with_actual_tokens():
+    tracker = app.UserUsageTracker(tokens_per_minute=100, overrides={"alice": 200})
+    reservation = tracker.reserve("alice", 150)
+    tracker.settle(reservation, prompt_tokens=10, generated_tokens=20)
+    tracker.settle(tracker.reserve("alice", 150), prompt_tokens=10, generated_tokens=20, coalesced=True)
+
+    usage = tracker.usage("alice")
+    assert usage["tokens_last_minute"] == 60
+    assert usage["tokens_per_minute_limit"] == 200
+    assert (usage["requests"], usage["coalesced"], usage["prompt_tokens"], usage["generated_tokens"]) == (2, 1, 20, 40)
+
+def test_failed_request_is_settled_at_zero():
+    tracker = app.UserUsageTracker(tokens_per_minute=100)
+    tracker.settle(tracker.reserve(None, 90))
+    assert tracker.usage(app.ANONYMOUS_USER)["tokens_last_minute"] == 0
+    tracker.reserve(None, 90)
+
+def test_expired_windows_are_pruned(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(app.time, "time", lambda: now[0])
+    tracker = app.UserUsageTracker(tokens_per_minute=100)
+    for user in ("alice", "bob", "carol"):
+        tracker.reserve(user, 10)
+
+    # 1分以上経つと、その後リクエストのないユーザーの記録も取り除かれる
+    now[0] += tracker.WINDOW + 1
+    tracker.reserve("dave", 10)
+    assert list(tracker._windows) == ["dave"]
+    assert tracker.usage("alice")["tokens_last_minute"] == 0
+
+def test_totals_keep_only_recent_users():
+    tracker = app.UserUsageTracker(max_users=2)
+    for user in ("alice", "bob", "carol"):
+        tracker.reserve(user, 10)
+
+    assert [usage["user"] for usage in tracker.summary()["users"]] == ["bob", "carol"]
@@ -0,0 +1,49 @@
+# tests/test_conversation_store.py
+"""lambda/conversation_store.py の会話の保存先 (メモリとSQLite) を試験する"""
+import pytest
+
+from conversation_store import (
+    ConversationNotFoundError,
+    ConversationStore,
+    InMemoryConversationStore,
+    SQLiteConversationStore,
+    VersionConflictError,
+)
+
+TURN = [{"role": "user", "content": "こんにちは"}, {"role": "assistant", "content": "こんにちは!"}]
+
+@pytest.fixture(params=["memory", "sqlite"])
+def store(request, tmp_path):
+    if request.param == "memory":
+        return InMemoryConversationStore()
+    return SQLiteConversationStore(str(tmp_path / "conversations.sqlite3"))
+
+def test_interface_cannot_be_instantiated():
+    with pytest.raises(TypeError):
+        ConversationStore()
+
+def test_append_and_load(store):
+    assert store.load("c1", "alice") == ([], 0)
+    assert store.append("c1", TURN, 0, "alice") == 1
+    assert store.append("c1", TURN, 1, "alice") == 2
+    assert store.load("c1", "alice") == (TURN + TURN, 2)
+
+def test_stale_version_is_rejected(store):
+    store.append("c1", TURN, 0, "alice")
+    with pytest.raises(VersionConflictError) as e:
+        store.append("c1", TURN, 0, "alice")
+    assert e.value.current_version == 1
+
+@pytest.mark.parametrize("caller", ["bob", None])
+def test_owned_conversation_is_hidden_from_other_callers(store, caller):
+    store.append("c1", TURN, 0, "alice")
+    with pytest.raises(ConversationNotFoundError):
+        store.load("c1", caller)
+    with pytest.raises(ConversationNotFoundError):
+        store.append("c1", TURN, 1, caller)
+    assert store.load("c1", "alice") == (TURN, 1)
+
+def test_conversation_without_owner_is_shared(store):
+    store.append("c1", TURN, 0, None)
+    assert store.load("c1", None) == (TURN, 1)
+    assert store.load("c1", "alice") == (TURN, 1)
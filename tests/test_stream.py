@@ -0,0 +1,87 @@
+# tests/test_stream.py
+"""lambda/index.py のSSEの中継 (stream_chat と run_stream_server の /chat/stream) を試験する"""
+import json
+import threading
+import time
+from http.server import ThreadingHTTPServer
+
+import pytest
+import requests
+
+import index
+from conftest import StubReply
+from upstream import UpstreamClient
+
+TOKEN_EVENTS = [
+    ("token", {"text": "こん"}),
+    ("token", {"text": "にちは"}),
+    ("done", {"generated_text": "こんにちは", "finish_reason": "stop", "truncated": False, "token_count": 2}),
+]
+
+def parse_frames(text):
+    """SSEの本文を (イベント名, データ) のリストにする"""
+    frames = []
+    for block in text.strip().split("\n\n"):
+        lines = dict(line.split(": ", 1) for line in block.splitlines())
+        frames.append((lines["event"], json.loads(lines["data"])))
+    return frames
+
+@pytest.fixture
+def stream_backend(stub_backends, monkeypatch):
+    backend, = stub_backends(1)
+    backend.reply = lambda path, payload: StubReply(events=TOKEN_EVENTS, interval=0.2)
+    monkeypatch.setattr(index, "upstream", UpstreamClient([backend.url], timeout=5))
+    return backend
+
+@pytest.fixture
+def stream_server(stream_backend):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), index.ChatRequestHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_port}"
+    server.shutdown()
+    server.server_close()
+
+def test_lambda_handler_relays_tokens_and_done(stream_backend):
+    result = index.lambda_handler({"body": json.dumps({"message": "こんにちは", "stream": True})}, None)
+
+    frames = parse_frames(result["body"])
+    assert [event for event, _ in frames] == ["token", "token", "done"]
+    assert "".join(data["text"] for event, data in frames if event == "token") == "こんにちは"
+    done = frames[-1][1]
+    assert done["response"] == "こんにちは"
+    assert done["generatedTokens"] == 2
+    assert done["conversationHistory"][-1] == {"role": "assistant", "content": "こんにちは"}
+    assert stream_backend.paths() == ["/generate/stream"]
+
+def test_stream_server_sends_each_token_as_it_arrives(stream_server):
+    start = time.monotonic()
+    arrivals = []
+    with requests.post(f"{stream_server}/chat/stream", json={"message": "こんにちは"}, stream=True, timeout=5) as response:
+        assert response.status_code == 200
+        assert response.headers["Content-Type"].startswith("text/event-stream")
+        for line in response.iter_lines(decode_unicode=True):
+            if line.startswith("event: "):
+                arrivals.append((line[len("event: "):], time.monotonic() - start))
+
+    assert [event for event, _ in arrivals] == ["token", "token", "done"]
+    # 最初のトークンは生成が終わる前に届く
+    assert arrivals[-1][1] - arrivals[0][1] >= 0.3
+
+def test_stream_relays_upstream_error_event(stream_backend):
+    stream_backend.reply = lambda path, payload: StubReply(events=[("error", {"detail": "生成に失敗しました"})])
+
+    result = index.lambda_handler({"body": json.dumps({"message": "こんにちは", "stream": True})}, None)
+
+    assert parse_frames(result["body"]) == [("error", {"success": False, "error": "生成に失敗しました"})]
+
+def test_stream_reports_upstream_status_and_retry_after(stream_backend):
+    stream_backend.reply = lambda path, payload: StubReply(503, {"detail": "読み込み中"}, {"Retry-After": "5"})
+    index.upstream.max_attempts = 1
+
+    result = index.lambda_handler({"body": json.dumps({"message": "こんにちは", "stream": True})}, None)
+
+    (event, data), = parse_frames(result["body"])
+    assert event == "error"
+    assert data["statusCode"] == 503
+    assert data["retryAfter"] == "5"
@@ -0,0 +1,117 @@
+# tests/test_upstream.py
+"""lambda/upstream.py の UpstreamClient をスタブのバックエンドに対して試験する"""
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import index
+from conftest import StubReply
+from upstream import QUOTA_EXCEEDED_HEADER, UpstreamClient, UpstreamError
+
+def quota_exceeded(path, payload):
+    return StubReply(429, {"detail": "利用量の上限に達しました"}, {"Retry-After": "42", QUOTA_EXCEEDED_HEADER: "true"})
+
+def queue_full(path, payload):
+    return StubReply(429, {"detail": "サーバーが混雑しています"}, {"Retry-After": "1"})
+
+def test_quota_429_is_not_retried_on_other_backends(stub_backends):
+    backends = stub_backends(2)
+    for backend in backends:
+        backend.reply = quota_exceeded
+    client = UpstreamClient([b.url for b in backends], timeout=5, max_attempts=3)
+
+    response = client.post_json("/generate", {"prompt": "こんにちは"})
+
+    assert response.status_code == 429
+    assert sum(len(b.requests) for b in backends) == 1
+    assert client.stats["retries"] == 0
+
+def test_queue_full_429_fails_over_to_another_backend(stub_backends):
+    busy, idle = stub_backends(2)
+    busy.reply = queue_full
+    client = UpstreamClient([busy.url, idle.url], timeout=5, max_attempts=3)
+
+    for _ in range(2):
+        response = client.post_json("/generate", {"prompt": "こんにちは"})
+        assert response.status_code == 200
+    assert len(idle.requests) == 2
+
+def test_lambda_passes_429_through_with_retry_after(stub_backends, monkeypatch):
+    backend, = stub_backends(1)
+    backend.reply = quota_exceeded
+    monkeypatch.setattr(index, "upstream", UpstreamClient([backend.url], timeout=5))
+
+    result = index.lambda_handler({"body": json.dumps({"message": "こんにちは"})}, None)
+
+    assert result["statusCode"] == 429
+    assert result["headers"]["Retry-After"] == "42"
+    assert json.loads(result["body"])["success"] is False
+
+def test_fails_over_from_unreachable_and_failing_backends(stub_backends, dead_url):
+    failing, healthy = stub_backends(2)
+    failing.reply = lambda path, payload: StubReply(500, {"detail": "error"})
+    client = UpstreamClient([dead_url, failing.url, healthy.url], timeout=5, max_attempts=3)
+
+    response = client.post_json("/generate", {"prompt": "こんにちは"})
+
+    assert response.status_code == 200
+    assert len(healthy.requests) == 1
+
+def test_circuit_opens_after_consecutive_failures_and_closes_after_probe(stub_backends):
+    backend, = stub_backends(1)
+    backend.reply = lambda path, payload: StubReply(500, {"detail": "error"})
+    client = UpstreamClient([backend.url], timeout=5, max_attempts=1, failure_threshold=2, cooldown=0.3)
+
+    for _ in range(2):
+        assert client.post_json("/generate", {}).status_code == 500
+    # サーキットが開いている間はバックエンドに送らない
+    with pytest.raises(UpstreamError):
+        client.post_json("/generate", {})
+    assert len(backend.requests) == 2
+    assert client.summary()["backends"][0]["state"] == "open"
+
+    # 待ち時間が過ぎたら1件だけ試しに送り、成功すれば閉じる
+    backend.reply = lambda path, payload: StubReply()
+    time.sleep(0.35)
+    assert client.post_json("/generate", {}).status_code == 200
+    assert client.summary()["backends"][0]["state"] == "closed"
+
+def test_hedged_request_wins_when_primary_is_slow(stub_backends):
+    backends = stub_backends(2)
+    first = threading.Event()
+
+    def slow_first(path, payload):
+        # 最初に届いた要求 (最初に選ばれたバックエンド) だけ遅くする
+        if not first.is_set():
+            first.set()
+            return StubReply(delay=2.0)
+        return StubReply()
+
+    for backend in backends:
+        backend.reply = slow_first
+    client = UpstreamClient([b.url for b in backends], timeout=5, hedge_after=0.1)
+
+    start = time.monotonic()
+    response = client.post_json("/generate", {"prompt": "こんにちは"})
+
+    assert response.status_code == 200
+    assert time.monotonic() - start < 1.0
+    assert client.stats["hedged"] == 1
+    assert client.stats["hedge_wins"] == 1
+
+@pytest.mark.parametrize("hedge_after", [0.0, 5.0])
+def test_concurrent_requests_to_one_backend_are_not_serialized(stub_backends, hedge_after):
+    backend, = stub_backends(1)
+    backend.reply = lambda path, payload: StubReply(delay=0.5)
+    client = UpstreamClient([backend.url], timeout=3, hedge_after=hedge_after, pool_size=10)
+
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        statuses = list(executor.map(lambda _: client.post_json("/generate", {}).status_code, range(8)))
+
+    assert statuses == [200] * 8
+    assert backend.max_in_flight == 8
+    assert time.monotonic() - start < 1.5